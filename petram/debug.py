@@ -25,6 +25,7 @@ from __future__ import print_function
 
 
 import traceback
+import functools
 import six
 
 debug_mode = 1
@@ -148,6 +149,7 @@ else:
 
     
 def use_profiler(method):
+    @functools.wraps(method)
     def method2(self, *args, **kwargs):
         if self.use_profiler:
             import cProfile, pstats
@@ -177,6 +179,7 @@ def use_profiler(method):
     return method2
 
 def flush_stdout(method):
+    @functools.wraps(method)
     def method2(self, *args, **kwargs):
         import sys
         sys.stdout.flush()
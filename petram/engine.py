@@ -25,6 +25,9 @@ from petram.model import Domain, Bdry, Point, Pair
 import petram.debug
 dprint1, dprint2, dprint3 = petram.debug.init_dprints('Engine')
 from petram.helper.matrix_file import write_coo_matrix, write_vector
+from petram.helper.stage_trace import trace_stage
+from petram.helper.partial_assembly import (ActionOperator, is_partial,
+                                            set_partial_assembly)
 
 # if you need to turn a specific warning to exception
 #import scipy.sparse
@@ -76,6 +79,11 @@ class Engine(object):
 
         self.max_bdrattr = -1
         self.max_attr = -1        
+        self.sol_format = 'ascii'    # format of solr/soli ('ascii' or 'binary')
+        self.sol_store = None        # (StoreWriter, case) to save in parametric store
+        self.sol_writer = None       # background writer of solution files
+        self.assembly_level = 'full' # 'full' or 'partial' (matrix-free)
+        self.structure_seq = 0       # changed when sparsity of matrix may change
         self.sol_extra = None
         self.sol = None
 
@@ -104,6 +112,7 @@ class Engine(object):
         self.fecfes_storage = {}  
         self.pp_extra = {}   
         self.alloc_flag = {}
+        self.assembly_plans = {}
 
     stored_data_names = ("is_assembled",
                          "self.is_initialized",
@@ -354,6 +363,7 @@ class Engine(object):
             self.mesh.ReorientTetMesh()
         self.fespaces[phys] = [self.new_fespace(fec) for fec in fecs]
     ''' 
+    @trace_stage('preprocess_modeldata')
     def preprocess_modeldata(self, dir = None):
         '''
         do everything it takes to run a newly built
@@ -668,6 +678,7 @@ class Engine(object):
             for phys in phys_target:
                 self.apply_essential(phys, update=update)
 
+    @trace_stage('run_assemble_mat')
     def run_assemble_mat(self, phys_target, phys_range, update=False):
         #for phys in phys_target:
         #    self.gather_essential_tdof(phys)
@@ -676,6 +687,9 @@ class Engine(object):
         C = len(self.r_dep_vars)        
         self.mask_M = np.array([not update]*R*C*self.n_matrix,
                                 dtype=bool).reshape(-1, R, C)
+        # forms renewed in update mode keep the sparsity given by
+        # FESpace. extra and aux blocks can change it (see below)
+        if not update: self.structure_seq += 1
 
         for phys in phys_target:       
             self.assemble_interp(phys)     ## global interpolation (periodic BC)
@@ -716,6 +730,7 @@ class Engine(object):
                 r = self.dep_var_offset(extra_name)
                 c = self.r_dep_var_offset(dep_name)
                 self.mask_M[j, r, c] = True
+            if len(updated_extra) > 0: self.structure_seq += 1
 
             self.aux_ops = {}
             updated_extra = []            
@@ -726,9 +741,11 @@ class Engine(object):
                 r = self.dep_var_offset(testname)
                 c = self.r_dep_var_offset(trialname)
                 self.mask_M[j, r, c]=True
+            if len(updated_aux_ops) > 0: self.structure_seq += 1
             
         return np.any(self.mask_M) or len(updated_extra) > 0
 
+    @trace_stage('run_assemble_b')
     def run_assemble_b(self, phys_target = None, update=False):
         '''
         assemble only RHS
@@ -1204,6 +1221,7 @@ class Engine(object):
                     mm.add_mix_contribution2(self, bf, r, c, is_trans, is_conj, real=False)
         
     def update_bf(self):
+        self.structure_seq += 1
         fes_vars = self.fes_vars       
         for j in range(self.n_matrix):
             self.access_idx = j
@@ -1350,6 +1368,13 @@ class Engine(object):
         from mfem.common.chypre import MfemVec2PyVec, MfemMat2PyMat    
         from itertools import product
 
+        def a2PyMat(r, i):
+            # partially assembled form is kept as ActionOperator
+            if isinstance(r, ActionOperator):
+                assert i is None, "partial assembly does not support complex"
+                return r
+            return MfemMat2PyMat(r, i)
+
         if update:
             M_changed = False
             R = len(self.dep_vars)
@@ -1379,7 +1404,7 @@ class Engine(object):
                 if update and not self.mask_M[k, r, c]: continue
                                           
                 m = convertElement(self.r_a, self.i_a,
-                                   i, j, MfemMat2PyMat)
+                                   i, j, a2PyMat)
 
                 M[k][r,c] = m if M[k][r,c] is None else M[k][r,c] + m
 
@@ -1617,32 +1642,53 @@ class Engine(object):
     #
     #  step4 : matrix finalization (to form a data being passed to a linear solver)
     #
+    def get_assembly_plan(self, format, mask):
+        '''
+        AssemblyPlan (cached structure of global matrix) for
+        format and block mask. plan.stamp is structure_seq, which
+        is changed when sparsity of blocks may change
+        '''
+        from petram.helper.block_matrix import AssemblyPlan
+        
+        if not hasattr(self, 'assembly_plans'): self.assembly_plans = {}
+        key = (format, tuple(mask[0]), tuple(mask[1]))
+        if not key in self.assembly_plans:
+            self.assembly_plans[key] = AssemblyPlan()
+        plan = self.assembly_plans[key]
+        plan.stamp = getattr(self, 'structure_seq', None)
+        return plan
+     
+    @trace_stage('finalize_matrix')
     def finalize_matrix(self, M_block, mask,is_complex,format = 'coo',
                         verbose=True):
         if verbose: dprint1("A (in finalizie_matrix) \n",  M_block, mask)       
         M_block = M_block.get_subblock(mask[0], mask[1])
+        plan = self.get_assembly_plan(format, mask)
 
         if format == 'coo': # coo either real or complex
-            M = self.finalize_coo_matrix(M_block, is_complex, verbose=verbose)
+            M = self.finalize_coo_matrix(M_block, is_complex, verbose=verbose,
+                                         plan = plan)
             
         elif format == 'coo_real': # real coo converted from complex
             M = self.finalize_coo_matrix(M_block, is_complex,
-                                            convert_real = True, verbose=verbose)
+                                            convert_real = True, verbose=verbose,
+                                            plan = plan)
 
         elif format == 'blk_interleave': # real coo converted from complex
-            M = M_block.get_global_blkmat_interleave()
+            M = M_block.get_global_blkmat_interleave(plan = plan)
             
 
         elif format == 'blk_merged': # real coo converted from complex
-            M = M_block.get_global_blkmat_merged()
+            M = M_block.get_global_blkmat_merged(plan = plan)
             
         elif format == 'blk_merged_s': # real coo converted from complex
-            M = M_block.get_global_blkmat_merged(symmetric = True)
+            M = M_block.get_global_blkmat_merged(symmetric = True, plan = plan)
 
         dprint2('exiting finalize_matrix')
         self.is_assembled = True
         return M
      
+    @trace_stage('finalize_rhs')
     def finalize_rhs(self,  B_blocks, M_block, X_block,
                      mask, is_complex, format = 'coo', verbose=True):
         #
@@ -1694,15 +1740,15 @@ class Engine(object):
         return X
      
     def finalize_coo_matrix(self, M_block, is_complex, convert_real = False,
-                            verbose=True):
+                            verbose=True, plan = None):
         if verbose: dprint1("A (in finalizie_coo_matrix) \n",  M_block)       
         if not convert_real:
             if is_complex:
-                M = M_block.get_global_coo(dtype='complex')           
+                M = M_block.get_global_coo(dtype='complex', plan = plan)
             else:
-                M = M_block.get_global_coo(dtype='float')                          
+                M = M_block.get_global_coo(dtype='float', plan = plan)
         else:
-            M = M_block.get_global_coo(dtype='complex')                      
+            M = M_block.get_global_coo(dtype='complex', plan = plan)
             M = scipy.sparse.bmat([[M.real, -M.imag], [M.imag, M.real]], format='coo')
             # (this one make matrix symmetric, for now it is off to do the samething
             #  as GMRES case)
@@ -1813,9 +1859,19 @@ class Engine(object):
     #  save to file
     #
     
+    @trace_stage('save_sol_to_file')
     def save_sol_to_file(self, phys_target, skip_mesh = False,
                                mesh_only = False,
-                               save_parmesh = False):
+                               save_parmesh = False,
+                               use_store = True):
+        '''
+        use_store : if False, files are written in cwd even when
+                    sol_store is set (such as checkpoint in a case
+                    of parametric scan)
+        '''
+        if use_store and self.sol_store is not None:
+            return self.save_sol_to_store(phys_target, mesh_only = mesh_only,
+                                          save_parmesh = save_parmesh)
         if not skip_mesh:
             mesh_filenames =self.save_mesh()
         if save_parmesh:
@@ -1823,6 +1879,7 @@ class Engine(object):
         if mesh_only: return mesh_filenames
 
         self.access_idx = 0
+        self._solfile_index = []
         for phys in phys_target:
             emesh_idx = phys.emesh_idx
             for name in phys.dep_vars:
@@ -1830,7 +1887,49 @@ class Engine(object):
                 r_x = self.r_x[ifes]
                 i_x = self.i_x[ifes]
                 self.save_solfile_fespace(name, emesh_idx, r_x, i_x)
+        if self.sol_format == 'binary':
+            self.save_solfile_index(self._solfile_index)
+            self._solfile_index = None
+        else:
+            self.clear_solmesh_files('sol_index')
                 
+    def save_sol_to_store(self, phys_target, mesh_only = False,
+                                save_parmesh = False):
+        '''
+        save solution as a row of parametric store. mesh is
+        saved only once.
+        '''
+        store, kcase = self.sol_store
+        store.save_mesh(self, save_parmesh = save_parmesh)
+        if mesh_only: return
+
+        self.access_idx = 0
+        gfs = []
+        for phys in phys_target:
+            emesh_idx = phys.emesh_idx
+            for name in phys.dep_vars:
+                ifes = self.r_ifes(name)
+                fnamer, fnamei = self.solfile_name(name, emesh_idx)
+                gfs.append((fnamer, self.writer_gf(self.r_x[ifes])))
+                if self.i_x[ifes] is not None:
+                    gfs.append((fnamei, self.writer_gf(self.i_x[ifes])))
+        self.write_or_submit(store.write_case, kcase, gfs,
+                             self.solfile_suffix())
+
+    def writer_gf(self, gf):
+        '''
+        when solution is written by background writer, gf is copied
+        since it is overwritten by the next case
+        '''
+        if self.sol_writer is None: return gf
+        return self.copy_gf(gf)
+
+    def write_or_submit(self, func, *args):
+        if self.sol_writer is None:
+            func(*args)
+        else:
+            self.sol_writer.submit(func, *args)
+
     def extrafile_name(self):
         return 'sol_extended.data'
      
@@ -1912,10 +2011,20 @@ class Engine(object):
         
     def run_postprocess(self, postprocess, name = ''):
         self._pp_extra_update = []
-        
-        for pp in postprocess:
-            if not pp.enabled: continue
-            pp.run(self)
+
+        # binary solution files written by postprocess are added
+        # to the index at once
+        self._solfile_index = []
+        try:
+            for pp in postprocess:
+                if not pp.enabled: continue
+                pp.run(self)
+        finally:
+            index = self._solfile_index
+            self._solfile_index = None
+        if self.sol_format == 'binary':
+            # called on all ranks (entries are gathered)
+            self.save_solfile_index(index, append = True)
 
         extra = {n:self.model._parameters[n] for n in self._pp_extra_update}
         extra = {name:extra}
@@ -2142,8 +2251,16 @@ class Engine(object):
         return self.new_lf(fes)
 
     def alloc_bf(self, idx, idx2=None):
+        '''
+        BilinearForm of physics. partial assembly is used only here.
+        forms made directly by new_bf (such as helper.operators) are
+        fully assembled.
+        '''
         fes = self.fespaces[self.fes_vars[idx]]
-        return self.new_bf(fes)
+        bf = self.new_bf(fes)
+        if self.assembly_level == 'partial':
+            set_partial_assembly(bf)
+        return bf
 
     def alloc_mbf(self, idx1, idx2): #row col
         fes1 = self.fespaces[self.fes_vars[idx1]]
@@ -2217,6 +2334,7 @@ class Engine(object):
             m.GetEdgeVertexTable()                                   
             get_extended_connectivity(m)
            
+    @trace_stage('run_mesh')
     def run_mesh(self):
         raise NotImplementedError(
              "you must specify this method in subclass")
@@ -2237,6 +2355,10 @@ class Engine(object):
         raise NotImplementedError(
              "you must specify this method in subclass")
 
+    def copy_gf(self, gf):
+        raise NotImplementedError(
+             "you must specify this method in subclass")
+
     def new_fespace(self, mesh, fec, vdim):
         raise NotImplementedError(
              "you must specify this method in subclass")
@@ -2270,6 +2392,7 @@ class Engine(object):
             if file.startswith('proble'): os.remove(os.path.join(d, file))
             if file.startswith('matrix'): os.remove(os.path.join(d, file))
             if file.startswith('rhs'): os.remove(os.path.join(d, file))
+            if file == 'sol_index.json': os.remove(os.path.join(d, file))
             if file.startswith('SolveStep'): os.remove(os.path.join(d, file))
             if file.startswith('cProfile_'): os.remove(os.path.join(d, file))                        
             if file.startswith('checkpoint_') and os.path.isdir(file):
@@ -2284,6 +2407,9 @@ class Engine(object):
             if file.startswith('case') and os.path.isdir(file):
                print("removing case directory", file)
                shutil.rmtree(os.path.join(d, file))
+            if file == 'parametric_store' and os.path.isdir(file):
+               print("removing parametric store", file)
+               shutil.rmtree(os.path.join(d, file))
        
     def clear_solmesh_files(self, header):
         try:
@@ -2306,12 +2432,56 @@ class Engine(object):
         self.clear_solmesh_files(fnamer)
         self.clear_solmesh_files(fnamei)
         
-        fnamer = fnamer+suffix
-        fnamei = fnamei+suffix
-        
-        r_x.SaveToFile(fnamer, 8)
+        fnamer = os.path.join(os.getcwd(), fnamer+suffix)
+        fnamei = os.path.join(os.getcwd(), fnamei+suffix)
+        r_x = self.writer_gf(r_x)
+        i_x = None if i_x is None else self.writer_gf(i_x)
+        
+        if self.sol_format == 'binary':
+            from petram.sol.binary_solfile import (write_gridfunction,
+                                                   gridfunction_header)
+            index = getattr(self, '_solfile_index', None)
+            # called outside save_sol_to_file and run_postprocess : 
+            # index on disk is already written. new entries are added
+            # to it
+            append = index is None
+            if append: index = []
+            for fname, gf in ((fnamer, r_x), (fnamei, i_x)):
+                if gf is None: continue
+                if self.sol_writer is None:
+                    index.append(write_gridfunction(fname, gf))
+                else:
+                    index.append(gridfunction_header(fname, gf))
+                    self.sol_writer.submit(write_gridfunction, fname, gf)
+            if append:
+                self.save_solfile_index(index, append = True)
+            return
+        self.write_or_submit(r_x.SaveToFile, fnamer, 8)
         if i_x is not None:
-            i_x.SaveToFile(fnamei, 8)
+            self.write_or_submit(i_x.SaveToFile, fnamei, 8)
+
+    def save_solfile_index(self, entries, append = False):
+        '''
+        collect entries of binary solution files from all ranks and
+        write index on root. if append is True, entries are added
+        to the existing index
+        '''
+        try:
+            from mpi4py import MPI
+        except:
+            from petram.helper.dummy_mpi import MPI
+        myid     = MPI.COMM_WORLD.rank
+        nproc    = MPI.COMM_WORLD.size
+
+        if nproc > 1:
+            entries = MPI.COMM_WORLD.gather(entries, root = 0)
+            if myid != 0: return
+            entries = sum(entries, [])
+        # nothing to add
+        if append and len(entries) == 0: return
+
+        from petram.sol.binary_solfile import write_index
+        write_index(os.getcwd(), entries, append = append)
 
     def save_mesh(self):
         mesh_names = []
@@ -2520,7 +2690,14 @@ class Engine(object):
             #           "Use InitSetting to load value from previous SolveStep: ", k)               
             self.model._variables[k] = variables[k]
 
-    def set_update_flag(self, mode):
+    def set_update_flag(self, mode, changed=None):
+        '''
+        mode : 'TimeDependent', 'UpdateAll', 'ParametricRHS' or 'Dependency'
+        changed : (Dependency mode) names in namespace whose values are
+                  changed. only models which depend on them are updated.
+        '''
+        if mode == 'Dependency':
+            changed = set(changed if changed is not None else [])
         for k in self.model['Phys'].keys():
             phys = self.model['Phys'][k]
             for mm in self.model['Phys'][k].walk():
@@ -2550,6 +2727,12 @@ class Engine(object):
                           if mm.has_bf_contribution2(kfes, 0):
                               assert False, "RHS only parametric is not possible for BF :"+mm.name()
                               
+               elif mode == 'Dependency':
+                  if not mm.enabled: continue
+                  dep = mm.get_ns_dependency()
+                  if dep is None or len(dep.intersection(changed)) > 0:
+                      dprint1("update (dependency) : " + mm.fullpath())
+                      mm._update_flag = True
                else:
                   assert False, "update mode not supported: mode = "+mode
                   
@@ -2624,6 +2807,7 @@ class SerialEngine(Engine):
         super(SerialEngine, self).__init__(modelfile = modelfile, model=model)
         self.isParallel = False       
 
+    @trace_stage('run_mesh')
     def run_mesh(self, meshmodel = None, skip_refine=False):
         '''
         skip_refine is for mfem_viewer
@@ -2631,6 +2815,7 @@ class SerialEngine(Engine):
         return self.run_mesh_serial(meshmodel = meshmodel,
                                     skip_refine=skip_refine)
 
+    @trace_stage('run_assemble_mat')
     def run_assemble_mat(self, phys_target, phys_range, update=False):
         self.is_matrix_distributed = False       
         return super(SerialEngine, self).run_assemble_mat(phys_target, phys_range,
@@ -2640,13 +2825,19 @@ class SerialEngine(Engine):
         return  mfem.LinearForm(fes)
 
     def new_bf(self, fes, fes2=None):
-        return  mfem.BilinearForm(fes)
+        bf = mfem.BilinearForm(fes)
+        return bf
 
     def new_mixed_bf(self, fes1, fes2):
         bf = mfem.MixedBilinearForm(fes1, fes2)
         bf._finalized = False
         return bf
      
+    def copy_gf(self, gf):
+        ret = mfem.GridFunction(gf.FESpace())
+        ret.Assign(gf)
+        return ret
+
     def new_gf(self, fes, init = True, gf = None):
         if gf is None:
            gf = mfem.GridFunction(fes)
@@ -2725,6 +2916,8 @@ class SerialEngine(Engine):
             if file.startswith('checkpoint_'): shutil.removetree(os.path.joij(d, file))   
     '''
     def a2A(self, a):  # BilinearSystem to matrix
+        if is_partial(a):
+            return ActionOperator.from_form(a)
         # we dont eliminate essentiaal at this level...                 
         inta = mfem.intArray()
         m = self.new_matrix()
@@ -2784,6 +2977,7 @@ class ParallelEngine(Engine):
         super(ParallelEngine, self).__init__(modelfile = modelfile, model=model)
         self.isParallel = True
 
+    @trace_stage('run_mesh')
     def run_mesh(self, meshmodel = None):
         from mpi4py import MPI
         from petram.mesh.mesh_model import MeshFile, MFEMMesh
@@ -2826,6 +3020,7 @@ class ParallelEngine(Engine):
             m.GetEdgeVertexTable()                                   
             get_extended_connectivity(m)           
 
+    @trace_stage('run_assemble_mat')
     def run_assemble_mat(self, phys_target, phys_range, update=False):
         self.is_matrix_distributed = True       
         return super(ParallelEngine, self).run_assemble_mat(phys_target,
@@ -2836,13 +3031,19 @@ class ParallelEngine(Engine):
         return  mfem.ParLinearForm(fes)
 
     def new_bf(self, fes, fes2=None):
-        return  mfem.ParBilinearForm(fes)
+        bf = mfem.ParBilinearForm(fes)
+        return bf
      
     def new_mixed_bf(self, fes1, fes2):
         bf = mfem.ParMixedBilinearForm(fes1, fes2)
         bf._finalized = False
         return bf
 
+    def copy_gf(self, gf):
+        ret = mfem.ParGridFunction(gf.ParFESpace())
+        ret.Assign(gf)
+        return ret
+
     def new_gf(self, fes, init = True, gf = None):
         if gf is None:
            gf = mfem.ParGridFunction(fes)
@@ -3098,6 +3299,8 @@ class ParallelEngine(Engine):
         MPI.COMM_WORLD.Barrier()
 
     def a2A(self, a):   # BilinearSystem to matrix
+        if is_partial(a):
+            return ActionOperator.from_form(a)
         # we dont eliminate essentiaal at this level...                 
         inta = mfem.intArray()
         m = self.new_matrix()
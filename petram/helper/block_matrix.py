@@ -6,6 +6,7 @@ Hypre with the same interface
 import numpy as np
 import scipy
 from scipy.sparse import coo_matrix, spmatrix, lil_matrix, csc_matrix
+from functools import reduce
 
 from petram.mfem_config import use_parallel
 import mfem.common.chypre as chypre
@@ -21,6 +22,7 @@ else:
    default_kind = 'scipy'
 
 from petram.solver.solver_utils import make_numpy_coo_matrix
+from petram.helper.partial_assembly import ActionOperator
 from petram.helper.matrix_file import write_coo_matrix, write_vector
 
 import petram.debug as debug
@@ -304,6 +306,171 @@ def convert_to_ScipyCoo(mat):
        mat.__class__ = ScipyCoo
     return mat
 
+class DistributedSol(object):
+    '''
+    solution vectors kept distributed (returned from parallel
+    iterative solvers instead of gathering them to root)
+
+       blocks[k][i] : local true dofs of i-th block of k-th solution
+
+    blocks follow the row partitioning of MFEM BlockOperator made
+    from BlockMatrix. (a block which is not distributed, such as an
+    extra variable, is in root and empty in other nodes)
+
+    merged = True : each block is [real, imag] of ComplexOperator
+    '''
+    def __init__(self, blocks, merged=False):
+        self.blocks = blocks
+        self.merged = merged
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def to_complex(self, merged=False):
+        '''
+        convert real value solution to complex. if not merged,
+        blocks are (real, imag) pairs (interleave format)
+        '''
+        ret = []
+        for b in self.blocks:
+            if merged:
+                ret.append([v[:len(v)//2] + 1j*v[len(v)//2:] for v in b])
+            else:
+                ret.append([b[2*i] + 1j*b[2*i+1] for i in range(len(b)//2)])
+        return DistributedSol(ret)
+
+    def gather(self):
+        '''
+        central solution matrix (root only, others get None). this
+        is what gathering solvers used to return
+        '''
+        from mpi4py import MPI
+        myid = MPI.COMM_WORLD.rank
+
+        # all pieces are gathered concurrently
+        pieces = []
+        for b in self.blocks:
+            for v in b:
+                if self.merged:
+                    w = len(v)//2
+                    pieces.extend([v[:w], v[w:]])
+                else:
+                    pieces.append(v)
+        pieces = gather_vectors(pieces)
+        if myid != 0: return None
+
+        sol = []
+        k = 0
+        for b in self.blocks:
+            s = []
+            for v in b:
+                if self.merged:
+                    s.append(np.hstack((pieces[k], pieces[k+1])))
+                    k = k + 2
+                else:
+                    s.append(pieces[k])
+                    k = k + 1
+            sol.append(np.hstack(s))
+        return np.transpose(np.vstack(sol))
+
+class AssemblyPlan(object):
+    '''
+    cached structure of a global matrix made from BlockMatrix.
+    Engine keeps one for each (format, mask). When sparsity
+    structure of all blocks is unchanged, global row/col (and
+    offsets) are reused and only data is filled.
+
+    stamp is given by Engine (structure_seq) and is changed when
+    sparsity of blocks may change. structure key is made from
+    stamp and size of blocks, so that checking it does not
+    depend on nnz. in addition, row/col of blocks are compared
+    with the cached ones at sampled entries (same_pattern), since
+    pattern may change with the same nnz.
+
+    data array is newly allocated every time, unless reuse_data
+    is set by a consumer which does not keep the array (a solver
+    may keep the pointer on C side).
+    '''
+    # number of entries checked in each block
+    pattern_samples = 64
+    reuse_data = False
+
+    def __init__(self):
+        self.key = None
+        self.stamp = None
+        self.row = None
+        self.col = None
+        self.data = None
+        self.offsets = None
+        self.csize = {}
+
+    def structure_key(self, *args):
+        key = [self.stamp]
+        for x in args:
+            if isinstance(x, np.ndarray):
+                x = (x.dtype.str, tuple(x.ravel().tolist()))
+            key.append(x)
+        return tuple(key)
+
+    def check(self, key, collective = False):
+        '''
+        return True if key is the same as the last one. otherwise
+        cached data is cleared and key is updated.
+
+        collective : decision is made on all ranks (cached data is
+                     used only when all ranks have the same key)
+        '''
+        hit = (self.stamp is not None and self.key == key)
+        if collective and use_parallel:
+            from mpi4py import MPI
+            hit = MPI.COMM_WORLD.allreduce(hit, op=MPI.LAND)
+        if hit: return True
+        self.key = key
+        self.row = None
+        self.col = None
+        self.data = None
+        self.offsets = None
+        self.csize = {}
+        return False
+
+    def same_pattern(self, blocks, starts, ends, roffsets, coffsets):
+        '''
+        compare row/col of blocks with cached global row/col at
+        sampled entries.
+           blocks : [(i, j, coo), ...]
+           starts, ends : range of each block in global row/col
+        '''
+        if self.row is None or self.col is None: return False
+        for (i, j, gcoo), s, e in zip(blocks, starts, ends):
+            n = e - s
+            if n == 0: continue
+            idx = np.unique(np.linspace(0, n-1,
+                                        min(n, self.pattern_samples)).astype(int))
+            if not (np.array_equal(gcoo.row[idx] + roffsets[i],
+                                   self.row[s + idx]) and
+                    np.array_equal(gcoo.col[idx] + coffsets[j],
+                                   self.col[s + idx])):
+                return False
+        return True
+
+    def data_buffer(self, size, dtype):
+        '''
+        array to store data of global matrix. the array given last
+        time is reused only when reuse_data is set and no one holds
+        it anymore on Python side (the same check as
+        ndarray.resize(refcheck=True))
+        '''
+        import sys
+        data = self.data
+        self.data = None
+        # references: data (local) and argument of getrefcount
+        if (not self.reuse_data or
+            data is None or data.size != size or data.dtype != dtype or
+            sys.getrefcount(data) > 2):
+            data = np.empty(size, dtype=dtype)
+        self.data = data
+        return data
+
 class BlockMatrix(object):
     def __init__(self, shape, kind = default_kind, complex=False):
         '''
@@ -349,6 +516,8 @@ class BlockMatrix(object):
                 if v.isComplex(): self.complex = True                                      
             elif isinstance(v, chypre.CHypreVec):
                 if v.isComplex(): self.complex = True                       
+            elif isinstance(v, ActionOperator):
+                pass
             elif v is None:
                 pass
             else:
@@ -619,13 +788,18 @@ class BlockMatrix(object):
 
         return ret, P2
 
-    def reformat_central_mat(self, mat, ksol, ret, mask):
+    def reformat_central_mat(self, mat, ksol, ret, mask, bcast=True):
         '''
         reformat central matrix into blockmatrix (columne vector)
         so that matrix can be multiplied from the right of this 
 
         self is a block diagonal matrix
+
+        bcast = False : mat is given in all nodes (no communication)
         '''
+        if isinstance(mat, DistributedSol):
+            return self.reformat_distributed_mat(mat, ksol, ret, mask)
+
         L = []
         idx = 0
         imask = [x for x in range(len(mask[0])) if mask[0][x]]
@@ -644,10 +818,38 @@ class BlockMatrix(object):
             else:
                 v = None   # slave node (will recive data)
             idx = idx + l
-            ret.set_element_from_central_mat(v, j, 0, ref)
+            ret.set_element_from_central_mat(v, j, 0, ref, bcast=bcast)
         return ret
 
-    def set_element_from_central_mat(self, v, i, j, ref):
+    def reformat_distributed_mat(self, mat, ksol, ret, mask):
+        '''
+        reformat DistributedSol into blockmatrix (columne vector).
+        each node uses its local part. only a block which is not
+        distributed is broadcasted from root.
+        '''
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+
+        imask = [x for x in range(len(mask[0])) if mask[0][x]]
+        jmask = [x for x in range(len(mask[1])) if mask[1][x]]
+        for kk, j in enumerate(jmask):
+            for i in imask:
+               if self[i,j] is not None:
+                  ref = self[i,j]
+                  break
+            v = np.ascontiguousarray(mat.blocks[ksol][kk])
+            if ref.isHypre:
+                if np.iscomplexobj(v):
+                    ret[j,0] = chypre.CHypreVec(ToHypreParVec(v.real.copy()),
+                                                ToHypreParVec(v.imag.copy()))
+                else:
+                    ret[j,0] = chypre.CHypreVec(ToHypreParVec(v), None)
+            else:
+                v = comm.bcast(v)
+                ret[j,0] = v.reshape(-1,1)
+        return ret
+
+    def set_element_from_central_mat(self, v, i, j, ref, bcast=True):
         ''' 
         set element using vector in root node
         row partitioning is taken from column partitioning
@@ -667,7 +869,7 @@ class BlockMatrix(object):
                 comm = MPI.COMM_WORLD
 
                 part = ref.GetColPartArray()
-                v = comm.bcast(v)
+                if bcast: v = comm.bcast(v)
                 start_col = part[0]
                 end_col = part[1]
 
@@ -681,7 +883,7 @@ class BlockMatrix(object):
                     self[i,j] = chypre.CHypreVec(rv, None)
             else:
                 #slave node gets the copy
-                v = comm.bcast(v)
+                if bcast: v = comm.bcast(v)
                 self[i, j] = v.reshape(-1,1)
 
     def get_squaremat_from_right(self, r, c):
@@ -801,29 +1003,98 @@ class BlockMatrix(object):
         coffsets = np.hstack([0, np.cumsum(coffset)])
         return roffsets, coffsets
 
-    def get_global_coo(self, dtype = 'float'):
+    def get_global_coo(self, dtype = 'float', plan = None):
+        '''
+        plan : AssemblyPlan. if given, row/col are reused as long as
+               the structure of blocks does not change. (reused row/col
+               are read-only)
+        '''
         roffsets, coffsets = self.get_global_offsets()
-        col = []
-        row = []
-        data = []
         glcoo = coo_matrix((roffsets[-1], coffsets[-1]), dtype = dtype)
         dprint1("roffset(get_global_coo)", roffsets)
+
+        blocks = []
         for i in range(self.shape[0]):
             for j in range(self.shape[1]):
                 if self[i,j] is None: continue
-                gcoo = self[i,j].get_global_coo()
-                row.append(gcoo.row + roffsets[i])                
-                col.append(gcoo.col + coffsets[j])
-                data.append(gcoo.data)
-        glcoo.col = np.hstack(col)
-        glcoo.row = np.hstack(row)
-        glcoo.data = np.hstack(data)
+                blocks.append((i, j, self[i,j].get_global_coo()))
+        if len(blocks) == 0:
+            return glcoo
+        
+        nnz = [len(gcoo.data) for i, j, gcoo in blocks]
+        ends = np.cumsum(nnz)
+        starts = ends - nnz
+
+        key = None
+        if plan is not None:
+            args = [roffsets, coffsets]
+            for (i, j, gcoo), n in zip(blocks, nnz):
+                args.extend([i, j, gcoo.shape, n])
+            key = plan.structure_key(*args)
+        hit = key is not None and plan.check(key) and plan.row is not None
+        if hit and not plan.same_pattern(blocks, starts, ends,
+                                         roffsets, coffsets):
+            dprint1("sparsity pattern is changed (same nnz)")
+            hit = False
+
+        # allocate the result once, instead of hstack of copies
+        data_type = reduce(np.promote_types,
+                           [gcoo.data.dtype for i, j, gcoo in blocks])
+        if hit:
+            data = plan.data_buffer(ends[-1], data_type)
+        else:
+            data = np.empty(ends[-1], dtype=data_type)
+            if plan is not None: plan.data = data
+        for (i, j, gcoo), s, e in zip(blocks, starts, ends):
+            data[s:e] = gcoo.data
+
+        if hit:
+            row = plan.row
+            col = plan.col
+        else:
+            idx_type = reduce(np.promote_types,
+                              [roffsets.dtype, coffsets.dtype] +
+                              [gcoo.row.dtype for i, j, gcoo in blocks] +
+                              [gcoo.col.dtype for i, j, gcoo in blocks])
+            row = np.empty(ends[-1], dtype=idx_type)
+            col = np.empty(ends[-1], dtype=idx_type)
+            for (i, j, gcoo), s, e in zip(blocks, starts, ends):
+                np.add(gcoo.row, roffsets[i], out=row[s:e])
+                np.add(gcoo.col, coffsets[j], out=col[s:e])
+                
+        glcoo.col = col
+        glcoo.row = row
+        glcoo.data = data
+
+        if plan is not None and not hit:
+            # scipy may convert index type. keep what glcoo holds,
+            # so that the same arrays are given next time
+            glcoo.row.flags.writeable = False
+            glcoo.col.flags.writeable = False
+            plan.row = glcoo.row
+            plan.col = glcoo.col
 
         return glcoo
 
     #
     #  methods for distributed csr format
     #
+    def partitioning_key(self, plan, *args):
+        '''
+        structure key of distributed blocks (used with AssemblyPlan).
+        partitioning is rank local. use it with plan.check(key,
+        collective = True)
+        '''
+        sig = list(args)
+        for i in range(self.shape[0]):
+            for j in range(self.shape[1]):
+                if self[i, j] is None: continue
+                sig.extend([i, j, self[i,j].__class__.__name__,
+                            self[i,j].shape,
+                            np.array(self[i,j].GetRowPartArray()),
+                            np.array(self[i,j].GetColPartArray())])
+        return plan.structure_key(*sig)
+
     def get_local_partitioning(self, convert_real = True,
                                      interleave = True,
                                      merge_realimag = False):
@@ -840,7 +1111,7 @@ class BlockMatrix(object):
                        roffset[i] != rp[1] - rp[0]):
                         assert False, 'row partitioning is not consistent'
                    roffset[i] = rp[1] - rp[0]
-                   if use_parallel and not isinstance(self[i,j], chypre.CHypreMat):
+                   if use_parallel and not isinstance(self[i,j], (chypre.CHypreMat, ActionOperator)):
                       from mpi4py import MPI
                       myid = MPI.COMM_WORLD.rank
                       if myid != 0: roffset[i] = 0
@@ -852,7 +1123,7 @@ class BlockMatrix(object):
                        coffset[j] != cp[1] - cp[0]):
                         assert False, 'col partitioning is not consistent'
                    coffset[j] = cp[1] - cp[0]
-                   if use_parallel and not isinstance(self[i,j], chypre.CHypreMat):
+                   if use_parallel and not isinstance(self[i,j], (chypre.CHypreMat, ActionOperator)):
                       if myid != 0: coffset[i] = 0                      
                    
         #coffset = [self[0, j].shape[1] for j in range(self.shape[1])]
@@ -958,15 +1229,24 @@ class BlockMatrix(object):
         return vec
      
 
-    def get_global_blkmat_interleave(self):
+    def get_global_blkmat_interleave(self, plan = None):
         '''
         This routine ordered unkonws in the following order
            FFE1, FES2, 
         If it is complex
            Re FFE1, Im FES1, ReFES2, Im FES2, ...
+
+        plan : AssemblyPlan (offsets are reused)
         '''
-        roffsets, coffsets = self.get_local_partitioning(convert_real=True,
-                                                         interleave=True)
+        if (plan is not None and
+            plan.check(self.partitioning_key(plan, 'interleave', self.complex),
+                       collective = True) and
+            plan.offsets is not None):
+            roffsets, coffsets = plan.offsets
+        else:
+            roffsets, coffsets = self.get_local_partitioning(convert_real=True,
+                                                             interleave=True)
+            if plan is not None: plan.offsets = (roffsets, coffsets)
         dprint1("Generating MFEM BlockMatrix: shape = "+str((len(roffsets)-1, len(coffsets)-1)))
         dprint1("Generating MFEM BlockMatrix: roffset/coffset = ", roffsets, coffsets)
 
@@ -979,7 +1259,10 @@ class BlockMatrix(object):
         for i in range(self.shape[0]):
             jj = 0
             for j in range(self.shape[1]):
-                if self[i,j] is not None:
+                if isinstance(self[i,j], ActionOperator):
+                    # matrix-free block (partial assembly, real only)
+                    glcsr.SetBlock(ii, jj, self[i,j].get_operator())
+                elif self[i,j] is not None:
                     if use_parallel:
                         if isinstance(self[i,j], chypre.CHypreMat):
                             gcsr =  self[i,j]
@@ -1068,15 +1351,23 @@ class BlockMatrix(object):
                 vec.GetBlock(i).Assign(0.0)
         return vec
 
-    def get_global_blkmat_merged(self, symmetric=False):
+    def get_global_blkmat_merged(self, symmetric=False, plan=None):
         '''
         This routine ordered unkonws in the following order
            Re FFE1, Im FES1, ReFES2, Im FES2, ...
         matrix FES1, FES2...
+
+        plan : AssemblyPlan (offsets and column sizes are reused)
         '''
         assert self.complex, "this format is complex only"
         
-        roffsets, coffsets = self.get_local_partitioning()
+        if plan is None: plan = AssemblyPlan()
+        if (plan.check(self.partitioning_key(plan, 'merged'), collective = True) and
+            plan.offsets is not None):
+            roffsets, coffsets = plan.offsets
+        else:
+            roffsets, coffsets = self.get_local_partitioning()
+            plan.offsets = (roffsets, coffsets)
         roffsets = np.sum(np.diff(roffsets).reshape(-1, 2), 1)
         coffsets = np.sum(np.diff(coffsets).reshape(-1, 2), 1)
         roffsets = np.hstack([0, np.cumsum(roffsets)])
@@ -1102,8 +1393,10 @@ class BlockMatrix(object):
                             rsize_local =rp[1] - rp[0]
  
                             if jfirst:                            
-                                csize_local =cp[1] - cp[0]
-                                csize = allgather(csize_local)
+                                if not j in plan.csize:
+                                    csize_local =cp[1] - cp[0]
+                                    plan.csize[j] = allgather(csize_local)
+                                csize = plan.csize[j]
                                 cstarts = np.hstack([0, np.cumsum(csize)])
                                 jfirst = False                                
                             s = self[i,j].shape
@@ -0,0 +1,178 @@
+'''
+   expression_jit
+
+   compile a pure arithmetic expression (such as closed form
+   material profile) to a native kernel using numba.
+
+     fn = jit_expression("sin(x)*exp(-a*y)", ['x', 'y', 'z'], g)
+
+   fn is None if expression uses a construct which is not supported
+   (Variables, subscript, list, keyword args, unknown functions, ...).
+   Otherwise, fn(x, y, z) accepts either scalars or numpy arrays.
+
+   names taken from g (such as "a" above, or time "t") are not
+   folded into the kernel. they are passed to the kernel as
+   arguments and read from g when fn is called, so that fn follows
+   changes of g.
+
+   Set PetraM_JIT=0 to turn off this feature.
+'''
+from __future__ import print_function
+
+import os
+import ast
+import numbers
+
+import numpy as np
+
+import petram.debug as debug
+dprint1, dprint2, dprint3 = debug.init_dprints('ExpressionJIT')
+
+try:
+    import numba
+    has_numba = True
+except ImportError:
+    has_numba = False
+
+enabled = has_numba and os.getenv('PetraM_JIT', '1') != '0'
+
+# function name -> template of native code
+_functions = {'sin': 'np.sin({0})',
+              'cos': 'np.cos({0})',
+              'tan': 'np.tan({0})',
+              'cosd': 'np.cos(({0})*np.pi/180.)',
+              'sind': 'np.sin(({0})*np.pi/180.)',
+              'tand': 'np.tan(({0})*np.pi/180.)',
+              'arctan': 'np.arctan({0})',
+              'arctan2': 'np.arctan2({0}, {1})',
+              'exp': 'np.exp({0})',
+              'log10': 'np.log10({0})',
+              'log': 'np.log({0})',
+              'log2': 'np.log2({0})',
+              'sqrt': 'np.sqrt({0})',
+              'abs': 'np.abs({0})',
+              'conj': '({0}).conjugate()',
+              'real': '({0}).real',
+              'imag': '({0}).imag', }
+
+_binop = {ast.Add: '+', ast.Sub: '-', ast.Mult: '*', ast.Div: '/',
+          ast.Pow: '**', ast.Mod: '%', ast.FloorDiv: '//'}
+_unaryop = {ast.UAdd: '+', ast.USub: '-'}
+
+class NotSupported(Exception):
+    pass
+
+def _const(value):
+    if isinstance(value, bool) or not isinstance(value, numbers.Number):
+        raise NotSupported("not a number")
+    if isinstance(value, numbers.Integral):
+        return repr(int(value))
+    if isinstance(value, numbers.Real):
+        return repr(float(value))
+    value = complex(value)
+    return 'complex(' + repr(value.real) + ', ' + repr(value.imag) + ')'
+
+def _to_source(node, ind_vars, g, used, params):
+    if isinstance(node, ast.Expression):
+        return _to_source(node.body, ind_vars, g, used, params)
+    elif isinstance(node, ast.BinOp):
+        if not type(node.op) in _binop:
+            raise NotSupported("operator")
+        return ('(' + _to_source(node.left, ind_vars, g, used, params) +
+                _binop[type(node.op)] +
+                _to_source(node.right, ind_vars, g, used, params) + ')')
+    elif isinstance(node, ast.UnaryOp):
+        if not type(node.op) in _unaryop:
+            raise NotSupported("operator")
+        return ('(' + _unaryop[type(node.op)] +
+                _to_source(node.operand, ind_vars, g, used, params) + ')')
+    elif hasattr(ast, 'Constant') and isinstance(node, ast.Constant):
+        return _const(node.value)
+    elif hasattr(ast, 'Num') and isinstance(node, ast.Num):
+        return _const(node.n)
+    elif isinstance(node, ast.Name):
+        name = node.id
+        if name in ind_vars:
+            used.add(name)
+            return name
+        if name == 'pi':
+            return 'np.pi'
+        if name in g:
+            _const(g[name])   # check if it is a number
+            params.add(name)
+            return '_p_' + name
+        raise NotSupported("unknown name " + name)
+    elif isinstance(node, ast.Call):
+        if (not isinstance(node.func, ast.Name) or
+            len(getattr(node, 'keywords', [])) != 0 or
+            getattr(node, 'starargs', None) is not None or
+            getattr(node, 'kwargs', None) is not None):
+            raise NotSupported("function call")
+        name = node.func.id
+        if not name in _functions:
+            raise NotSupported("function " + name)
+        # user may overwrite the function in namespace
+        from petram.helper.variables import var_g
+        if name in g and g[name] is not var_g.get(name, None):
+            raise NotSupported("function " + name + " is redefined")
+        args = [_to_source(a, ind_vars, g, used, params) for a in node.args]
+        try:
+            return _functions[name].format(*args)
+        except IndexError:
+            raise NotSupported("wrong number of arguments")
+    else:
+        raise NotSupported(node.__class__.__name__)
+
+class JITKernel(object):
+    '''
+    compiled kernel. namespace values used in expression are
+    read from g at each call
+    '''
+    def __init__(self, kernel, params, g):
+        self.kernel = kernel
+        self.params = params
+        self.g = g
+
+    def __call__(self, *args):
+        args = args + tuple(self.g[n] for n in self.params)
+        return self.kernel(*args)
+
+_kernels = {}
+def jit_expression(expr, ind_vars, g):
+    '''
+    expr : expression (string)
+    ind_vars : list of independent variable names
+    g : namespace. values of names used in expr are read from g
+        when kernel is called
+
+    return compiled kernel or None
+    '''
+    if not enabled: return None
+    try:
+        tree = ast.parse(expr.strip(), mode='eval')
+        used = set()
+        params = set()
+        txt = _to_source(tree, ind_vars, g, used, params)
+    except (NotSupported, SyntaxError) as e:
+        dprint3("jit is not used for", expr, ":", str(e))
+        return None
+    if len(used) == 0:
+        # constant expression is handled without jit
+        return None
+
+    params = sorted(params)
+    args = list(ind_vars) + ['_p_' + n for n in params]
+    src = ("def _kernel(" + ", ".join(args) + "):\n" +
+           "    return " + txt + "\n")
+    if not src in _kernels:
+        ns = {'np': np}
+        try:
+            exec(src, ns)
+            kernel = numba.vectorize(nopython=True)(ns['_kernel'])
+        except Exception as e:
+            dprint1("jit compile failed", expr, ":", str(e))
+            kernel = None
+        _kernels[src] = kernel
+    kernel = _kernels[src]
+    if kernel is None: return None
+    return JITKernel(kernel, params, g)
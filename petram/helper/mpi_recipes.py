@@ -10,66 +10,173 @@ from mfem.common.mpi_debug import nicePrint, niceCall
 
 def allgather(data):
     comm     = MPI.COMM_WORLD     
-    num_proc = MPI.COMM_WORLD.size
-    myid     = MPI.COMM_WORLD.rank
-    data = comm.allgather(data)
-    MPI.COMM_WORLD.Barrier()           
-    return data
+    return comm.allgather(data)
 
-def allgather_vector(data, mpi_data_type = None):
-    from mfem.common.mpi_dtype import  get_mpi_datatype       
-    if mpi_data_type is None:
-       mpi_data_type = get_mpi_datatype(data)
+#
+#  layout (counts and displacements) of distributed vector
+#
+class Layout(object):
+    '''
+    counts and displacements of a vector distributed on comm.
+    counts are number of elements (including trailing dimensions)
+    '''
+    def __init__(self, rows, tail=(), rank=0):
+        self.rows = np.array(rows, dtype=int)
+        self.tail = tuple(tail)
+        self.rank = rank
+        w = int(np.prod(self.tail)) if len(self.tail) > 0 else 1
+        self.counts = self.rows*w
+        self.displs = np.hstack((0, np.cumsum(self.counts)))[:-1]
+        self.size = int(np.sum(self.counts))
 
-    myid     = MPI.COMM_WORLD.rank
-    rcounts = data.shape[0]
-    rcounts = np.array(MPI.COMM_WORLD.allgather(rcounts))
+    @property
+    def local_shape(self):
+        return (int(self.rows[self.rank]),) + self.tail
 
-    for x in data.shape[1:]: rcounts = rcounts * x        
-    cm = np.hstack((0, np.cumsum(rcounts)))
-    disps = list(cm[:-1])        
-    length =  cm[-1]
-    recvbuf = np.empty([length], dtype=data.dtype)
-    recvdata = [recvbuf, rcounts, disps, mpi_data_type]
-    senddata = [data.flatten(), data.flatten().shape[0]]        
-    MPI.COMM_WORLD.Allgatherv(senddata, recvdata)
-    return recvbuf.reshape(-1, *data.shape[1:])
-
-def gather_vector(data, mpi_data_type = None, root=0):
+    def reshape(self, buf):
+        return buf.reshape(-1, *self.tail)
+
+_layouts = {}
+
+def get_layout(shape, comm=None, key=None):
     '''
-    gather vector to root node. 
-    B: Vector to be collected 
+    layout of a vector whose local shape is shape. 
+
+    key : name of a fixed distribution (such as a true dof vector
+          of a FESpace). if it is given, layout is cached per
+          (communicator, key) and the count exchange is skipped
+          in the following calls. It must be used by all ranks
+          consistently. call clear_layouts if distribution changes.
+    '''
+    comm = MPI.COMM_WORLD if comm is None else comm
+    shape = tuple(shape)
+    if key is not None:
+        ckey = (comm.py2f(), key)
+        if ckey in _layouts:
+            layout = _layouts[ckey]
+            if layout.local_shape != shape:
+                assert False, "layout "+str(key)+" changed. call clear_layouts"
+            return layout
+    layout = Layout(comm.allgather(shape[0]), shape[1:], rank=comm.rank)
+    if key is not None: _layouts[ckey] = layout
+    return layout
+
+def get_layouts(shapes, comm=None):
+    '''
+    layouts of several vectors using one count exchange
+    '''
+    comm = MPI.COMM_WORLD if comm is None else comm
+    rows = comm.allgather([s[0] for s in shapes])
+    return [Layout([r[k] for r in rows], tuple(s[1:]), rank=comm.rank)
+            for k, s in enumerate(shapes)]
+
+def clear_layouts(key=None):
+    if key is None:
+        _layouts.clear()
+    else:
+        for k in [k for k in _layouts if k[1] == key]: del _layouts[k]
+
+def _send_spec(data, mpi_data_type):
+    '''
+    flat send buffer, its spec and datatype of receive buffer
     '''
     from mfem.common.mpi_dtype import  get_mpi_datatype
+    senddata = np.ascontiguousarray(data).reshape(-1)
+    send_type = get_mpi_datatype(senddata)
     if mpi_data_type is None:
-       mpi_data_type = get_mpi_datatype(data)
+       mpi_data_type = send_type
+    return senddata, [senddata, send_type], mpi_data_type
 
-    myid     = MPI.COMM_WORLD.rank
-    rcounts = data.shape[0]
-    rcounts = MPI.COMM_WORLD.gather(rcounts, root = root)
-    cm = np.hstack((0, np.cumsum(rcounts)))
-    disps = list(cm[:-1])        
-    recvdata = None
-    senddata = [data, data.shape[0]]
+class PendingVector(object):
+    '''
+    result of non-blocking collective. wait() returns the received
+    vector (None on non-root rank of gather).
+    '''
+    def __init__(self, request, recvbuf, layout, senddata):
+        self.request = request
+        self.recvbuf = recvbuf
+        self.layout = layout
+        self._senddata = senddata  # keep it until completion
+
+    def test(self):
+        if self.request is None: return True
+        return self.request.Test()
+
+    def wait(self):
+        if self.request is not None:
+            self.request.Wait()
+            self.request = None
+            self._senddata = None
+        if self.recvbuf is None: return None
+        return self.layout.reshape(self.recvbuf)
+
+def waitall(pendings):
+    requests = [p.request for p in pendings if p.request is not None]
+    if len(requests) > 0: MPI.Request.Waitall(requests)
+    for p in pendings:
+        p.request = None
+        p._senddata = None
+    return [p.wait() for p in pendings]
+
+def allgather_vector(data, mpi_data_type = None, layout = None,
+                     comm = None):
+    comm = MPI.COMM_WORLD if comm is None else comm
+    if layout is None: layout = get_layout(data.shape, comm)
+    senddata, sendspec, mpi_data_type = _send_spec(data, mpi_data_type)
+
+    recvbuf = np.empty([layout.size], dtype=data.dtype)
+    recvdata = [recvbuf, layout.counts, layout.displs, mpi_data_type]
+    comm.Allgatherv(sendspec, recvdata)
+    return layout.reshape(recvbuf)
+
+def iallgather_vector(data, mpi_data_type = None, layout = None,
+                      comm = None):
+    '''
+    non-blocking allgather_vector. returns PendingVector
+    '''
+    comm = MPI.COMM_WORLD if comm is None else comm
+    if layout is None: layout = get_layout(data.shape, comm)
+    senddata, sendspec, mpi_data_type = _send_spec(data, mpi_data_type)
 
-    if myid ==root:
-        length =  cm[-1]
-        recvbuf = np.empty([length], dtype=data.dtype)
-        recvdata = [recvbuf, rcounts, disps, mpi_data_type]       
+    recvbuf = np.empty([layout.size], dtype=data.dtype)
+    recvdata = [recvbuf, layout.counts, layout.displs, mpi_data_type]
+    req = comm.Iallgatherv(sendspec, recvdata)
+    return PendingVector(req, recvbuf, layout, senddata)
+
+def igather_vector(data, mpi_data_type = None, root = 0, layout = None,
+                   comm = None):
+    '''
+    non-blocking gather_vector (intra-communicator). returns
+    PendingVector
+    '''
+    comm = MPI.COMM_WORLD if comm is None else comm
+    if layout is None: layout = get_layout(data.shape, comm)
+    senddata, sendspec, mpi_data_type = _send_spec(data, mpi_data_type)
+
+    if comm.rank == root:
+        recvbuf = np.empty([layout.size], dtype=data.dtype)
+        recvdata = [recvbuf, layout.counts, layout.displs, mpi_data_type]
     else:
-        recvdata = [None, rcounts, disps, mpi_data_type]
         recvbuf = None
-    MPI.COMM_WORLD.Barrier()           
-    MPI.COMM_WORLD.Gatherv(senddata, recvdata,  root = root)
-    if myid == root:
-        #print 'collected'
-        MPI.COMM_WORLD.Barrier()
-        return np.array(recvbuf)
-    MPI.COMM_WORLD.Barrier()
-    return None
+        recvdata = None
+    req = comm.Igatherv(sendspec, recvdata, root = root)
+    return PendingVector(req, recvbuf, layout, senddata)
+
+def gather_vectors(datas, roots = 0, comm = None):
+    '''
+    gather several vectors (to roots). counts are exchanged once
+    and gathers are performed concurrently.
+    returns list of gathered vectors (None on non-root)
+    '''
+    comm = MPI.COMM_WORLD if comm is None else comm
+    if np.isscalar(roots): roots = [roots]*len(datas)
+    layouts = get_layouts([d.shape for d in datas], comm)
+    pendings = [igather_vector(d, root = r, layout = l, comm = comm)
+                for d, r, l in zip(datas, roots, layouts)]
+    return waitall(pendings)
 
 def gather_vector(data, mpi_data_type = None, parent = False,
-                  world = MPI.COMM_WORLD, root=0):
+                  world = MPI.COMM_WORLD, root=0, layout = None):
     '''
     gather vector to root
     B: Vector to be collected 
@@ -82,18 +189,21 @@ def gather_vector(data, mpi_data_type = None, parent = False,
        root group should call with data to tell the data type, like np.array(2)
        world should be specified
 
+    layout (intra-communication only) : Layout of data. if it is
+    not given, counts are exchanged.
     '''
     from mfem.common.mpi_dtype import  get_mpi_datatype
     myid     = world.rank    
 
+    if world.Is_intra():
+        return igather_vector(data, mpi_data_type = mpi_data_type,
+                              root = root, layout = layout,
+                              comm = world).wait()
+
     if mpi_data_type is None:
        mpi_data_type = get_mpi_datatype(data)
     
-    if world.Is_intra():
-        if myid == root: parent = True
-        rcounts = data.shape[0]
-        senddata = [data, data.shape[0]]            
-    elif parent:
+    if parent:
         root = MPI.ROOT if myid == root else MPI.PROC_NULL
         rcounts = 0
         senddata = [np.array(()), 0]
@@ -113,14 +223,10 @@ def gather_vector(data, mpi_data_type = None, parent = False,
     else:
         recvdata = [None, rcounts, disps, mpi_data_type]
         recvbuf = None
-    world.Barrier()           
     world.Gatherv(senddata, recvdata,  root = root)
     if parent:
-        #print 'collected'
-        world.Barrier()
         return np.array(recvbuf)
     else:
-        world.Barrier()
         return None
 
 def scatter_vector(vector, mpi_data_type, rcounts):
@@ -139,7 +245,6 @@ def scatter_vector(vector, mpi_data_type, rcounts):
         sol = np.array(vector, dtype="float64")
         senddata = [sol, rcountss, disps, mpi_data_type]
     MPI.COMM_WORLD.Scatterv(senddata, recvdata, root = 0)
-    MPI.COMM_WORLD.Barrier()        
     return recvdata
 
 def scatter_vector2(vector, mpi_data_type, rcounts = None):
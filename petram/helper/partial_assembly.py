@@ -0,0 +1,312 @@
+'''
+   partial_assembly:
+      matrix-free (action only) block element used when bilinear
+      forms are assembled with AssemblyLevel.PARTIAL.
+
+   ActionOperator keeps a list of (scale, mfem.Operator) acting on
+   true dofs, the assembled diagonal and the constrained (essential)
+   dofs. It provides the subset of the PyMat interface used between
+   Engine.fill_M_B_blocks and finalize_matrix (+, -, scalar *,
+   eliminate_RowsCols, dot with a vector, partitioning). Rows and
+   columns of essential dofs are replaced by identity, which is what
+   eliminate_RowsCols does to an assembled matrix.
+
+   Since the operator is never formed, only preconditioners built
+   from its diagonal (DiagonalInverse) can be used with it.
+
+   limitation:
+      real value only
+      only diagonal blocks of bilinear forms (mixed forms, extra and
+      projection/periodicity (rap) need assembled matrices)
+'''
+from __future__ import print_function
+
+import numpy as np
+
+from petram.mfem_config import use_parallel
+if use_parallel:
+   import mfem.par as mfem
+   from mpi4py import MPI
+else:
+   import mfem.ser as mfem
+import mfem.common.chypre as chypre
+
+import petram.debug as debug
+dprint1, dprint2, dprint3 = debug.init_dprints('PartialAssembly')
+
+def set_partial_assembly(bf):
+    '''
+    set assembly level of (Par)BilinearForm. it needs to be called
+    before integrators are assembled
+    '''
+    bf.SetAssemblyLevel(mfem.AssemblyLevel_PARTIAL)
+    bf._partial = True
+    return bf
+
+def is_partial(bf):
+    return getattr(bf, '_partial', False)
+
+def _true_vsize(fes):
+    if use_parallel:
+        return fes.TrueVSize()
+    else:
+        return fes.GetTrueVSize()
+
+def _partitioning(n):
+    '''
+    (start, end, global size) of local true dofs
+    '''
+    if not use_parallel:
+        return np.array([0, n, n], dtype=int)
+    sizes = MPI.COMM_WORLD.allgather(n)
+    start = sum(sizes[:MPI.COMM_WORLD.rank])
+    return np.array([start, start + n, sum(sizes)], dtype=int)
+
+class DiagonalInverse(mfem.PyOperator):
+    '''
+    Jacobi (diagonal scaling) preconditioner
+    '''
+    def __init__(self, diag):
+        mfem.PyOperator.__init__(self, len(diag))
+        d = np.array(diag, dtype=float, copy=True)
+        if np.any(d == 0.0):
+            assert False, "diagnal element of matrix is zero"
+        self._dinv = 1.0/d
+        self.iterative_mode = False
+
+    def SetOperator(self, opr):
+        pass
+
+    def Mult(self, x, y):
+        y.Assign(x.GetDataArray()*self._dinv)
+
+class PAOperator(mfem.PyOperator):
+    '''
+    mfem.Operator to give ActionOperator to mfem (BlockOperator and
+    Krylov solvers)
+    '''
+    def __init__(self, action):
+        mfem.PyOperator.__init__(self, action.local_size)
+        self.action = action
+
+    def Mult(self, x, y):
+        self.action.mult(x, y)
+
+    def diagonal_inverse(self):
+        return DiagonalInverse(self.action.diagonal())
+
+class ActionOperator(object):
+    def __init__(self, terms, diag, part, ess_tdof=None, lift_tdof=None):
+        '''
+        terms : list of (scale, mfem.Operator). a term may carry the
+                object which owns the operator as the 3rd element
+        diag  : diagonal (numpy array of local true dofs)
+        part  : (start, end, global size) of local true dofs
+        '''
+        self.terms = terms
+        self.diag = diag
+        self.part = part
+        self.ess_tdof = (np.array([], dtype=int) if ess_tdof is None
+                         else np.array(ess_tdof, dtype=int))
+        # if lift_tdof is set, this operator returns A*x where x is
+        # restricted on lift_tdof (Ae in elimination)
+        self.lift_tdof = lift_tdof
+        self._opr = None
+        self._work = None
+
+    @classmethod
+    def from_form(cls, a):
+        '''
+        make ActionOperator from partially assembled BilinearForm
+        '''
+        fes = a.ParFESpace() if use_parallel else a.FESpace()
+        n = _true_vsize(fes)
+
+        inta = mfem.intArray()
+        handle = mfem.OperatorPtr()
+        a.FormSystemMatrix(inta, handle)
+
+        diag = mfem.Vector(n)
+        a.AssembleDiagonal(diag)
+        diag = np.array(diag.GetDataArray(), copy=True)
+
+        return cls([(1.0, handle.Ptr(), (a, handle))], diag, _partitioning(n))
+
+    def __repr__(self):
+        return ("ActionOperator(" + str(len(self.terms)) + " terms, " +
+                str(self.shape) + ")")
+
+    @property
+    def local_size(self):
+        return int(self.part[1] - self.part[0])
+
+    @property
+    def shape(self):
+        return (int(self.part[2]), int(self.part[2]))
+
+    @property
+    def nnz(self):
+        return 0
+
+    def true_nnz(self):
+        return 0
+
+    @property
+    def isHypre(self):
+        return use_parallel
+
+    def isComplex(self):
+        return False
+
+    def GetColPartArray(self):
+        return self.part
+
+    def GetRowPartArray(self):
+        return self.part
+    GetPartitioningArray = GetRowPartArray
+
+    def diagonal(self):
+        d = self.diag.copy()
+        if len(self.ess_tdof) > 0: d[self.ess_tdof] = 1.0
+        return d
+
+    def _copy(self, terms=None, diag=None):
+        return ActionOperator(self.terms if terms is None else terms,
+                              self.diag if diag is None else diag,
+                              self.part,
+                              ess_tdof=self.ess_tdof,
+                              lift_tdof=self.lift_tdof)
+    #
+    #  arithmetic
+    #
+    def _check_unconstrained(self):
+        if len(self.ess_tdof) > 0 or self.lift_tdof is not None:
+            assert False, "can not combine operator after elimination"
+
+    def _to_terms(self, other):
+        '''
+        assembled matrix is added as an operator term
+        '''
+        if isinstance(other, ActionOperator):
+            other._check_unconstrained()
+            return other.terms, other.diag
+
+        if isinstance(other, chypre.CHypreMat):
+            assert other[1] is None, "partial assembly does not support complex"
+            m = other[0]
+        elif hasattr(other, "get_mfem_sparsemat"):
+            m, mi = other.get_mfem_sparsemat()
+            assert mi is None, "partial assembly does not support complex"
+        else:
+            assert False, "can not add " + str(type(other))
+        d = mfem.Vector()
+        m.GetDiag(d)
+        return [(1.0, m, other)], np.array(d.GetDataArray(), copy=True)
+
+    def __add__(self, other):
+        self._check_unconstrained()
+        terms, diag = self._to_terms(other)
+        return self._copy(self.terms + terms, self.diag + diag)
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return self + (-other)
+
+    def __rsub__(self, other):
+        return (-self) + other
+
+    def __mul__(self, other):
+        if not np.isscalar(other) or np.iscomplexobj(other):
+            assert False, "ActionOperator can only be scaled by real number"
+        terms = [(t[0]*other,) + tuple(t[1:]) for t in self.terms]
+        return self._copy(terms, self.diag*other)
+    __rmul__ = __mul__
+
+    def __neg__(self):
+        return self*(-1.0)
+    #
+    #  elimination
+    #
+    def eliminate_RowsCols(self, tdof, inplace=True):
+        '''
+        return (Ae, A), where A has identity for rows/cols of tdof
+        and Ae.dot(x) gives the lifting term
+        '''
+        self._check_unconstrained()
+        tdof = np.array(tdof, dtype=int)
+        Ae = ActionOperator(self.terms, self.diag, self.part,
+                            lift_tdof=tdof)
+        A = ActionOperator(self.terms, self.diag, self.part,
+                           ess_tdof=tdof)
+        return Ae, A
+
+    def resetRow(self, rows, inplace=True):
+        assert False, "partial assembly operator can be used only in diagonal block"
+
+    resetCol = resetRow
+
+    def rap(self, P):
+        assert False, "projection (rap) is not supported with partial assembly"
+    #
+    #  action
+    #
+    def _get_work(self):
+        if self._work is None:
+            n = self.local_size
+            self._work = (mfem.Vector(n), mfem.Vector(n))
+        return self._work
+
+    def mult(self, x, y):
+        '''
+        y = A x  (x, y : mfem.Vector of local true dofs)
+        '''
+        src, tmp = self._get_work()
+        xx = x.GetDataArray()
+        if self.lift_tdof is not None:
+            src.Assign(0.0)
+            src.GetDataArray()[self.lift_tdof] = xx[self.lift_tdof]
+        elif len(self.ess_tdof) > 0:
+            src.Assign(x)
+            src.GetDataArray()[self.ess_tdof] = 0.0
+        else:
+            src = x
+
+        y.Assign(0.0)
+        for t in self.terms:
+            t[1].Mult(src, tmp)
+            y.Add(t[0], tmp)
+
+        if self.lift_tdof is None and len(self.ess_tdof) > 0:
+            y.GetDataArray()[self.ess_tdof] = xx[self.ess_tdof]
+
+    def dot(self, other):
+        if isinstance(other, chypre.CHypreVec):
+            assert other[1] is None, "partial assembly does not support complex"
+            x = other[0]
+            y = mfem.HypreParVector(x)
+            self.mult(x, y)
+            return chypre.CHypreVec(y, None)
+
+        if hasattr(other, "toarray"):
+            other = other.toarray()
+        other = np.asarray(other)
+        if other.ndim == 2 and other.shape[1] != 1:
+            assert False, "ActionOperator can not be multiplied to matrix"
+        if np.iscomplexobj(other):
+            assert False, "partial assembly does not support complex"
+
+        x = mfem.Vector(np.ascontiguousarray(other.flatten(), dtype=float))
+        y = mfem.Vector(self.local_size)
+        self.mult(x, y)
+
+        from petram.helper.block_matrix import convert_to_ScipyCoo
+        return convert_to_ScipyCoo(
+                   np.array(y.GetDataArray(), copy=True).reshape(-1, 1))
+
+    def get_operator(self):
+        '''
+        mfem.Operator used in BlockOperator
+        '''
+        if self._opr is None:
+            self._opr = PAOperator(self)
+        return self._opr
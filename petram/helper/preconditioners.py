@@ -71,6 +71,7 @@
 
 
 '''
+import time
 import weakref
 
 from petram.mfem_config import use_parallel
@@ -86,6 +87,12 @@ if use_parallel:
    from mfem.common.mpi_debug import nicePrint
 else:
    import mfem.ser as mfem
+
+from petram.helper.partial_assembly import PAOperator
+
+import petram.debug as debug
+dprint1, dprint2, dprint3 = debug.init_dprints('Preconditioner')
+from petram.helper.stage_trace import trace_stage
    
 class PreconditionerBlock(object):
     def __init__(self, func):
@@ -267,6 +274,10 @@ def mfem_smoother(name, **kwargs):
     row = prc.get_row_by_name(blockname)
     col = prc.get_col_by_name(blockname)
     mat = prc.get_operator_block(row, col)
+    if isinstance(mat, PAOperator):
+        # matrix-free block. only diagonal is available
+        dprint1(name + " is replaced by diagonal scaling (partial assembly)")
+        return mat.diagonal_inverse()
     if use_parallel:
         smoother = mfem.HypreSmoother(mat)
         smoother.SetType(getattr(mfem.HypreSmoother, name))
@@ -557,3 +568,117 @@ class GenericPreconditioner(mfem.Solver, PrcCommon):
 
      
 
+
+#
+#  preconditioner cache
+#
+def parse_reuse_policy(txt):
+    '''
+    reuse policy of preconditioner blocks
+       none    : rebuild when operator is changed (default)
+       always  : reuse as long as the setting and block size are same
+       every N : rebuild after N operators
+       iter R  : rebuild when number of iterations exceeds R times
+                 that of the first solve after the last rebuild
+
+    "name: policy" sets the policy of a block. items are separated
+    by ",".  (example) "every 10, E: iter 1.5"
+    '''
+    policy = {None: ('none', 0)}
+    for item in txt.split(','):
+        item = item.strip()
+        if item == '': continue
+        if item.find(':') != -1:
+            n, p = [x.strip() for x in item.split(':', 1)]
+        else:
+            n, p = None, item
+        w = p.split()
+        if len(w) == 1 and w[0] in ('none', 'always'):
+            policy[n] = (w[0], 0)
+        elif len(w) == 2 and w[0] == 'every':
+            policy[n] = ('every', int(w[1]))
+        elif len(w) == 2 and w[0] == 'iter':
+            policy[n] = ('iter', float(w[1]))
+        else:
+            assert False, "unknown preconditioner reuse policy: " + item
+    return policy
+
+class PrcCache(object):
+    '''
+    keeps preconditioner blocks across operators. A reused block
+    approximates the inverse of the operator it was built from,
+    which is kept alive together with the block.
+
+       cache.set_operator(A)              # when operator is given
+       blk = cache.get(name, setting, size, build)
+       cache.record_iterations(niter)     # after each solve
+    '''
+    def __init__(self, policy=''):
+        self.policy = parse_reuse_policy(policy)
+        self.entries = {}
+        self._opr = None
+
+    def get_policy(self, name):
+        return self.policy.get(name, self.policy[None])
+
+    def set_operator(self, opr):
+        if opr is self._opr: return False
+        self._opr = opr
+        for e in self.entries.values():
+            e['age'] += 1
+        return True
+
+    def _rebuild_reason(self, name, e, setting, size):
+        if e is None: return 'new'
+        if e['setting'] != setting: return 'setting changed'
+        if e['size'] != size: return 'size changed'
+        if e['age'] == 0: return None
+        mode, value = self.get_policy(name)
+        if mode == 'none': return 'operator changed'
+        if mode == 'every' and e['age'] >= value:
+            return 'reached ' + str(value) + ' operators'
+        if mode == 'iter' and e['stale']:
+            return 'iteration count degraded'
+        return None
+
+    def get(self, name, setting, size, build, k=None):
+        '''
+        name    : block name (used to select policy)
+        setting : preconditioner setting (text in GUI)
+        size    : block size
+        build   : function to make a new block
+        k       : block index (if blocks of the same name are
+                  not shared)
+        '''
+        e = self.entries.get((k, name), None)
+        reason = self._rebuild_reason(name, e, setting, size)
+        if reason is None:
+            e['nreuse'] += 1
+            dprint1("preconditioner " + name + " (" + setting + ") is reused",
+                    "age=" + str(e['age']), "reuse=" + str(e['nreuse']))
+            return e['blk']
+
+        t0 = time.time()
+        blk = trace_stage('prc_setup')(build)()
+        t = time.time() - t0
+        dprint1("preconditioner " + name + " (" + setting + ") is built : " +
+                reason, "setup=%.3fs" % t)
+        self.entries[(k, name)] = {'blk': blk, 'opr': self._opr,
+                                   'setting': setting, 'size': size,
+                                   'age': 0, 'ref_iter': None,
+                                   'stale': False, 'nreuse': 0,
+                                   'setup_time': t}
+        return blk
+
+    def record_iterations(self, niter):
+        for (k, name), e in self.entries.items():
+            if e['ref_iter'] is None:
+                e['ref_iter'] = niter
+                continue
+            mode, value = self.get_policy(name)
+            if mode != 'iter' or e['stale']: continue
+            if niter > value*max(e['ref_iter'], 1):
+                e['stale'] = True
+                dprint1("preconditioner " + name + " : iterations " + str(niter) +
+                        " > " + str(value) + " x " + str(e['ref_iter']) +
+                        ", rebuild at next operator")
@@ -0,0 +1,195 @@
+'''
+   stage_trace:
+      low overhead per-stage instrumentation of Engine pipeline
+
+   wall time, cpu time and resident memory (change during the stage
+   and peak) are accumulated for each stage decorated by trace_stage.
+
+      @trace_stage('finalize_matrix')
+      def finalize_matrix(self, ...):
+
+   write_report gathers the records of all ranks and writes
+   min/max/mean of each quantity to stage_trace.json and
+   stage_trace.csv.
+
+   tracing is turned on by PetraM_TRACE=1 (or enable()). When it is
+   off, decorator costs one global lookup per call.
+'''
+from __future__ import print_function
+
+import os
+import time
+import json
+import resource
+import sys
+
+import petram.debug as debug
+dprint1, dprint2, dprint3 = debug.init_dprints('StageTrace')
+
+REPORT_FILE = 'stage_trace'
+
+enabled = os.getenv('PetraM_TRACE', '0') not in ('0', '')
+
+if hasattr(time, 'process_time'):
+    cpu_time = time.process_time
+else:
+    cpu_time = time.clock
+
+_page_size = resource.getpagesize()
+_rusage_denom = 1024.*1024. if sys.platform == 'darwin' else 1024.
+
+def rss_mb():
+    '''
+    current resident set size (MB). falls back to peak RSS
+    when /proc is not available
+    '''
+    try:
+        with open('/proc/self/statm', 'r') as fid:
+            return int(fid.read().split()[1])*_page_size/1024./1024.
+    except (IOError, OSError, IndexError, ValueError):
+        return peak_rss_mb()
+
+def peak_rss_mb():
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss /
+            _rusage_denom/1024.)
+
+# name -> [count, wall, cpu, rss_delta, peak_rss]
+_records = {}
+_order = []
+_active = set()
+
+def enable(flag=True):
+    globals()['enabled'] = flag
+
+def reset():
+    _records.clear()
+    del _order[:]
+
+def local_records():
+    '''
+    records of this process as a list of dict (in the order of
+    first appearance)
+    '''
+    ret = []
+    for n in _order:
+        r = _records[n]
+        ret.append({'stage': n, 'count': r[0], 'wall': r[1], 'cpu': r[2],
+                    'rss_delta_mb': r[3], 'peak_rss_mb': r[4]})
+    return ret
+
+def record(name, wall, cpu, drss, peak):
+    if not name in _records:
+        _records[name] = [0, 0.0, 0.0, 0.0, 0.0]
+        _order.append(name)
+    r = _records[name]
+    r[0] += 1
+    r[1] += wall
+    r[2] += cpu
+    r[3] += drss
+    r[4] = max(r[4], peak)
+
+def trace_stage(name):
+    '''
+    decorator to record a stage. nested call of the same stage
+    (such as overwritten method calling super) is counted once.
+    '''
+    def wrapper(method):
+        def method2(*args, **kwargs):
+            if not enabled or name in _active:
+                return method(*args, **kwargs)
+            _active.add(name)
+            m0 = rss_mb()
+            c0 = cpu_time()
+            t0 = time.time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                t1 = time.time()
+                c1 = cpu_time()
+                m1 = rss_mb()
+                _active.discard(name)
+                record(name, t1 - t0, c1 - c0, m1 - m0, peak_rss_mb())
+        method2.__name__ = method.__name__
+        method2.__doc__ = method.__doc__
+        return method2
+    return wrapper
+
+_quantities = ('wall', 'cpu', 'rss_delta_mb', 'peak_rss_mb')
+
+def _summarize(all_records, all_orders):
+    order = []
+    for o in all_orders:
+        for n in o:
+            if not n in order: order.append(n)
+
+    stages = []
+    for n in order:
+        data = [r[n] for r in all_records if n in r]
+        entry = {'stage': n,
+                 'nrank': len(data),
+                 'count': max([d[0] for d in data])}
+        for k, q in enumerate(_quantities):
+            values = [d[k+1] for d in data]
+            mean = sum(values)/len(values)
+            entry[q] = {'min': min(values),
+                        'max': max(values),
+                        'mean': mean}
+        wall = entry['wall']
+        entry['imbalance'] = (wall['max']/wall['mean']
+                              if wall['mean'] > 0 else 1.0)
+        stages.append(entry)
+    return stages
+
+def write_report(path=None, filename=REPORT_FILE):
+    '''
+    collect records from all ranks and write report (root only).
+    this is a collective call in parallel run.
+    '''
+    if not enabled: return None
+
+    from petram.mfem_config import use_parallel
+    if use_parallel:
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+        nproc = comm.size
+        myid = comm.rank
+    else:
+        nproc = 1
+        myid = 0
+
+    if nproc > 1:
+        all_records = comm.gather(dict(_records), root=0)
+        all_orders = comm.gather(list(_order), root=0)
+    else:
+        all_records = [dict(_records)]
+        all_orders = [list(_order)]
+    if myid != 0: return None
+
+    stages = _summarize(all_records, all_orders)
+    if path is None: path = os.getcwd()
+
+    report = {'nproc': nproc,
+              'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'stages': stages}
+    with open(os.path.join(path, filename + '.json'), 'w') as fid:
+        json.dump(report, fid, indent=1)
+
+    with open(os.path.join(path, filename + '.csv'), 'w') as fid:
+        head = ['stage', 'nrank', 'count', 'imbalance']
+        for q in _quantities:
+            head.extend([q + '_min', q + '_max', q + '_mean'])
+        fid.write(','.join(head) + '\n')
+        for s in stages:
+            line = [s['stage'], str(s['nrank']), str(s['count']),
+                    '%.4g' % s['imbalance']]
+            for q in _quantities:
+                line.extend(['%.6g' % s[q][x]
+                             for x in ('min', 'max', 'mean')])
+            fid.write(','.join(line) + '\n')
+
+    for s in stages:
+        dprint1(s['stage'], 'count=' + str(s['count']),
+                'wall(max)=%.3fs' % s['wall']['max'],
+                'imbalance=%.2f' % s['imbalance'],
+                'peak=%.1fMB' % s['peak_rss_mb']['max'])
+    return report
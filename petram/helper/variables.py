@@ -96,6 +96,85 @@ def eval_code(co, g, l, flag = None):
     if callable(a): return a()
     return a
 
+class NotVectorizable(ValueError):
+    pass
+
+def eval_on_arrays(co, g, names, values, size, check=True):
+    '''
+    evaluate compiled code once on whole arrays
+
+       names  : names of local variables
+       values : their values. first axis runs over points
+       size   : number of points
+
+    a value of each point (scalar, vector, matrix) is placed in
+    the leading axes and points in the last axis during evaluation,
+    so that an expression written for a single point (such as E[0]
+    or abs(E)**2) broadcasts naturally.
+
+    returns an array whose first axis runs over points.
+    raises NotVectorizable if the expression can not be evaluated on
+    arrays. when check is True, the result is compared with pointwise
+    evaluation at a few sample points.
+    '''
+    l = {}
+    for n, v in zip(names, values):
+        v = np.asarray(v)
+        if v.ndim == 0 or v.shape[0] != size:
+            raise NotVectorizable(n + " does not have a value per point")
+        l[n] = np.moveaxis(v, 0, -1)
+    try:
+        value = np.asarray(eval(co, g, l))
+    except Exception as e:
+        raise NotVectorizable(e.__class__.__name__ + ": " + str(e))
+
+    if value.dtype == object:
+        raise NotVectorizable("expression returns an object array")
+    if value.ndim == 0:
+        value = np.array([value]*size)
+    elif value.shape[-1] != size:
+        raise NotVectorizable("shape of result " + str(value.shape) +
+                              " does not match number of points")
+    else:
+        value = np.moveaxis(value, -1, 0)
+
+    if check and size > 0:
+        for i in sorted(set([0, size//2, size-1])):
+            ref = np.asarray(eval(co, g, {n: v[i] for n, v in zip(names, values)}))
+            if (ref.shape != value[i].shape or
+                not np.allclose(ref, value[i], equal_nan=True)):
+                raise NotVectorizable("result differs from pointwise evaluation")
+    return value
+
+def eval_on_points(co, g, names, values, size, expr=None):
+    '''
+    evaluate compiled code on arrays (first axis of values runs over
+    points). 
+
+    if expression does not involve Variables, it is evaluated only once
+    and broadcasted. if the expression is not vectorizable, it falls 
+    back to pointwise evaluation. if it fails too, ValueError is raised.
+    (expr is the expression text used in the error message)
+    '''
+    if len(values) == 0:
+        val = np.asarray(eval(co, g))
+        return np.repeat(val[np.newaxis, ...], size, axis=0)
+
+    try:
+        return eval_on_arrays(co, g, names, values, size)
+    except NotVectorizable as e:
+        reason = str(e)
+        dprint2("pointwise evaluation is used", reason)
+    try:
+        return np.array([eval(co, g, dict(zip(names, v)))
+                         for v in zip(*values)])
+    except Exception as e:
+        expr = co.co_filename if expr is None else expr
+        raise ValueError("can not evaluate expression '" + expr + "'\n" +
+                         "  (vectorized)  : " + reason + "\n" +
+                         "  (pointwise)   : " + e.__class__.__name__ +
+                         ": " + str(e))
+
 cosd =  lambda x : np.cos(x*np.pi/180.)
 sind =  lambda x : np.sin(x*np.pi/180.)
 tand =  lambda x : np.tan(x*np.pi/180.)
@@ -231,6 +310,13 @@ class Variable(object):
         if idx is None: idx = []
         return idx
 
+    def ns_dependency(self):
+        '''
+        names in namespace which the value of this variable depends on.
+        None means it is not known.
+        '''
+        return None
+
     def make_callable(self):
         raise NotImplementedError("Subclass need to implement")
     
@@ -272,6 +358,9 @@ class Constant(Variable):
         
     def __repr__(self):
         return "Constant("+str(self.value)+")"
+
+    def ns_dependency(self):
+        return set()
         
     def set_point(self,T, ip, g, l, t = None):
         self.x = T.Transform(ip)        
@@ -314,6 +403,9 @@ class CoordVariable(Variable):
         
     def __repr__(self):
         return "Coordinates"
+
+    def ns_dependency(self):
+        return set()
         
     def set_point(self,T, ip, g, l, t = None):
         self.x = T.Transform(ip)        
@@ -361,6 +453,9 @@ class ExpressionVariable(Variable):
         #print 'Check Expression', expr.__repr__(), names
     def __repr__(self):
         return "Expression("+self.expr + ")"
+
+    def ns_dependency(self):
+        return set(self.names).difference(self.ind_vars)
     
     def set_point(self,T, ip, g, l, t = None):
         self.x = T.Transform(ip)        
@@ -412,8 +507,7 @@ class ExpressionVariable(Variable):
             elif (n in g):
                 var_g2[n] = g[n]
         if len(ll_name) > 0:
-            value = np.array([eval(self.co, var_g2, dict(zip(ll_name, v)))
-                        for v in zip(*ll_value)])
+            value = self._eval_on_points(var_g2, ll_name, ll_value, locs, size)
         else:
             for k, name in enumerate(self.ind_vars):
                 l[name] = locs[...,k]
@@ -426,6 +520,20 @@ class ExpressionVariable(Variable):
 
         ret = multi(ret, value)
         return ret
+
+    def _eval_on_points(self, var_g2, ll_name, ll_value, locs, size):
+        '''
+        evaluate expression which depends on other Variables. 
+        independent variables are also made available from locs
+        '''
+        ll_name = list(ll_name)
+        ll_value = list(ll_value)
+        if locs is not None:
+            for k, name in enumerate(self.ind_vars):
+                if name in ll_name or k >= locs.shape[-1]: continue
+                ll_name.append(name)
+                ll_value.append(locs[..., k])
+        return eval_on_points(self.co, var_g2, ll_name, ll_value, size)
     
     def _ncx_values(self, method, ifaces = None, irs = None, gtypes = None,
                       g=None, attr1 = None, attr2 = None, locs = None,
@@ -453,8 +561,7 @@ class ExpressionVariable(Variable):
                 var_g2[n] = g[n]
                 
         if len(ll_name) > 0:
-            value = np.array([eval(self.co, var_g2, dict(zip(ll_name, v)))
-                        for v in zip(*ll_value)])
+            value = self._eval_on_points(var_g2, ll_name, ll_value, locs, size)
         else:
             for k, name in enumerate(self.ind_vars):
                 l[name] = locs[...,k]
@@ -474,14 +581,9 @@ class ExpressionVariable(Variable):
                            mesh = None, int_points = None, g = None,
                            knowns = None):
 
+        size = counts
         dtype = np.complex if self.complex else np.float
-
-        
-        for kk, m, loc in zip(iele, el2v, elvertloc):
-            if kk < 0: continue
-            for pair, xyz in zip(m, loc):
-                idx = pair[1]
-                ret[idx] = 1
+        ret = np.ones(size, dtype = dtype)
 
         l = {}
         ll_name = []
@@ -492,14 +594,13 @@ class ExpressionVariable(Variable):
                 l[n] = g[n].point_values(counts = counts, locs = locs, points = points,
                                          attrs = attrs, elem_ids = elem_ids,
                                          mesh = mesh, int_points = int_points,  g = g,
-                                         knowns = knows)
+                                         knowns = knowns)
                 ll_name.append(n)
                 ll_value.append(l[n])
             elif (n in g):
                 var_g2[n] = g[n]
         if len(ll_name) > 0:
-            value = np.array([eval(self.co, var_g2, dict(zip(ll_name, v)))
-                        for v in zip(*ll_value)])
+            value = self._eval_on_points(var_g2, ll_name, ll_value, locs, size)
         else:
             for k, name in enumerate(self.ind_vars):
                 l[name] = locs[...,k]
@@ -527,6 +628,14 @@ class DomainVariable(Variable):
                                                   complex = complex)
     def __repr__(self):
         return "DomainVariable"
+
+    def ns_dependency(self):
+        names = set()
+        for v in self.domains.values():
+            dep = v.ns_dependency()
+            if dep is None: return None
+            names.update(dep)
+        return names
         
     def add_expression(self, expr, ind_vars, domains, gdomain, complex = False):
         domains = sorted(domains)
@@ -886,22 +995,75 @@ class CoefficientVariable(Variable):
         return call_eval
         
             
+def resolve_gf(gf):
+    '''
+    return mfem.GridFunction. LazyGridFunction (sol.solsets) is 
+    read from file here.
+    '''
+    if hasattr(gf, 'resolve'): return gf.resolve()
+    return gf
+
+def points_by_element(attrs, elem_ids, int_points):
+    '''
+    group points found by Mesh::FindPoints by element
+
+    yields (element id, rows, IntegrationRule), where rows is the
+    index of points in the array of found points (attrs != -1)
+    '''
+    valid = np.where(np.array(attrs) != -1)[0]
+    if len(valid) == 0: return
+    ids = np.array(elem_ids)[valid]
+    order = np.argsort(ids, kind='mergesort')
+    uids, start = np.unique(ids[order], return_index=True)
+    end = np.hstack((start[1:], len(order)))
+    for iele, s, e in zip(uids, start, end):
+        rows = order[s:e]
+        ir = mfem.IntegrationRule(len(rows))
+        for k, r in enumerate(rows):
+            ip = int_points[valid[r]]
+            ir.IntPoint(k).Set(ip.x, ip.y, ip.z, ip.weight)
+        yield int(iele), rows, ir
+
 class GridFunctionVariable(Variable):
     def __init__(self, gf_real, gf_imag = None, comp = 1,
                  deriv = None, complex = False):
 
         complex = not (gf_imag is None)
         super(GridFunctionVariable, self).__init__(complex = complex)
-        self.dim = gf_real.VectorDim()
+        self._dim = None
         self.comp = comp
         self.isGFSet= False
         self.isDerived = False
         self.deriv = deriv if deriv is not None else self._def_deriv
         self.deriv_args = (gf_real, gf_imag)
+        self._resolved_args = None
         
     def _def_deriv(self, *args):
         return args[0], args[1], None
 
+    def resolved_args(self):
+        '''
+        deriv_args as mfem.GridFunction. they are kept by this
+        variable, so that GridFunction (and FESpace returned from
+        it) lives during evaluation.
+        '''
+        if self._resolved_args is None:
+            self._resolved_args = tuple(resolve_gf(x)
+                                        for x in self.deriv_args)
+        return self._resolved_args
+
+    @property
+    def dim(self):
+        # evaluated when it is needed, so that GridFunction is not
+        # read from file until it is used (see sol.solsets)
+        if self._dim is None:
+            self._dim = self.resolved_args()[0].VectorDim()
+        return self._dim
+
+    @dim.setter
+    def dim(self, value):
+        self._dim = value
+
     def get_gf_real(self):
         if not self.isGFSet: self.set_gfr_gfi()
         return self.gfr
@@ -911,7 +1073,8 @@ class GridFunctionVariable(Variable):
         return self.gfi
     
     def set_gfr_gfi(self):
-        gf_real, gf_imag, extra = self.deriv(*self.deriv_args)
+        args = self.resolved_args()
+        gf_real, gf_imag, extra = self.deriv(*args)
         self.gfr = gf_real
         self.gfi = gf_imag
         self.extra = extra
@@ -953,7 +1116,7 @@ class GridFunctionVariable(Variable):
         return idx
     
     def FESpace(self, check_parallel = True):
-        gf_real, gf_imag = self.deriv_args        
+        gf_real, gf_imag = self.resolved_args()
         if gf_real is not None:
             if hasattr(gf_real, "ParFESpace"):
                 return gf_real.ParFESpace()
@@ -1174,7 +1337,7 @@ class GFScalarVariable(GridFunctionVariable):
         else:
             isVector = False
             
-        d = mfem.Vector()
+        d = mfem.DenseMatrix()
 
         if self.complex:
             dtype = complex
@@ -1185,31 +1348,21 @@ class GFScalarVariable(GridFunctionVariable):
             
         data = np.zeros(counts, dtype=dtype)
 
-        jj = 0
-        for i in range(len(attrs)):
-            if attrs[i] == -1: continue
-
-            ip = int_points[i]
-            iele = elem_ids[i]
-
-            val = val * 0.
-            
-            if self.gfr is not None:
+        # points are processed element by element. shape functions
+        # are evaluated once for all points in an element, and real
+        # and imaginary parts are evaluated in the same pass.
+        vals = mfem.Vector()
+        tr = mfem.DenseMatrix()
+        for iele, rows, ir in points_by_element(attrs, elem_ids, int_points):
+            for gf, fac in ((self.gfr, 1.0), (self.gfi, 1j)):
+                if gf is None: continue
                 if isVector:
-                    self.gfr.GetVectorValue(iele, ip, d)
-                    val = d[self.comp-1]
+                    gf.GetVectorValues(iele, ir, d, tr)
+                    v = d.GetDataArray()[self.comp-1]
                 else:
-                    val = self.gfr.GetValue(iele, ip, self.comp-1)
-
-            if self.gfi is not None:            
-                if isVector:
-                    self.gfi.GetVectorValue(iele, ip, d)
-                    val += 1j*d[self.comp-1]
-                else:
-                    val += 1j*self.gfi.GetValue(iele, ip, self.comp-1)
-                    
-            data[jj] = val
-            jj = jj + 1
+                    gf.GetValues(iele, ir, vals, self.comp)
+                    v = vals.GetDataArray()
+                data[rows] += fac*v
 
         return data
             
@@ -1352,7 +1505,7 @@ class GFVectorVariable(GridFunctionVariable):
             isVector = False
             vdim = gf.VectorDim()            
 
-        d = mfem.Vector()
+        d = mfem.DenseMatrix()
 
         if self.complex:
             dtype = complex
@@ -1362,26 +1515,12 @@ class GFVectorVariable(GridFunctionVariable):
             
         data = np.zeros((counts,vdim), dtype=dtype)
 
-        jj = 0
-        for i in range(len(attrs)):
-            if attrs[i] == -1: continue
-
-            ip = int_points[i]
-            iele = elem_ids[i]
-
-            val = 0.0
-            
-            if self.gfr is not None:
-                self.gfr.GetVectorValue(iele, ip, d)                
-                val = d.GetDataArray().copy()
-                
-            if self.gfi is not None:
-                self.gfi.GetVectorValue(iele, ip, d)
-                dd = 1j*d.GetDataArray().copy()
-                val = val + dd
-                    
-            data[jj,:] = val
-            jj = jj + 1
+        tr = mfem.DenseMatrix()
+        for iele, rows, ir in points_by_element(attrs, elem_ids, int_points):
+            for gf, fac in ((self.gfr, 1.0), (self.gfi, 1j)):
+                if gf is None: continue
+                gf.GetVectorValues(iele, ir, d, tr)
+                data[rows, :] += fac*d.GetDataArray().transpose()
 
         return data
 '''
@@ -147,7 +147,8 @@ def find_edge_corner(mesh):
         comm  = MPI.COMM_WORLD
         
         from mfem.common.mpi_debug import nicePrint, niceCall        
-        from petram.helper.mpi_recipes import allgather, allgather_vector, gather_vector
+        from petram.helper.mpi_recipes import (allgather, allgather_vector,
+                                               gather_vector, gather_vectors)
         from petram.mesh.mesh_utils import distribute_shared_entity        
         if not hasattr(mesh, "shared_info"):
             mesh.shared_info = distribute_shared_entity(mesh)
@@ -170,14 +171,16 @@ def find_edge_corner(mesh):
     
 
     if use_parallel:
-        offset = np.hstack([0, np.cumsum(allgather(mesh.GetNEdges()))])
-        offsetf = np.hstack([0, np.cumsum(allgather(mesh.GetNFaces()))])
-        offsetv = np.hstack([0, np.cumsum(allgather(mesh.GetNV()))])
+        counts = np.array(allgather((mesh.GetNEdges(), mesh.GetNFaces(),
+                                     mesh.GetNV(), nattr)), dtype=int)
+        offset = np.hstack([0, np.cumsum(counts[:, 0])])
+        offsetf = np.hstack([0, np.cumsum(counts[:, 1])])
+        offsetv = np.hstack([0, np.cumsum(counts[:, 2])])
         myoffset = offset[myid]
         myoffsetf = offsetf[myid]
         myoffsetv = offsetv[myid]                
-        nattr = max(allgather(nattr))
-        ne = sum(allgather(mesh.GetNEdges()))
+        nattr = max(counts[:, 3])
+        ne = sum(counts[:, 0])
     else:
         myoffset  = np.array(0, dtype=int)
         myoffsetf = np.array(0, dtype=int)
@@ -211,6 +214,7 @@ def find_edge_corner(mesh):
         # collect edges using master edge number
         # and gather it to a node.
         edgesc = {}
+        datas = []
         ld, md = mesh.shared_info        
         for j in range(1, nattr+1):
             if j in edges:
@@ -223,7 +227,9 @@ def find_edge_corner(mesh):
                        data[iii] = me
             else:
                 data = np.atleast_1d([]).astype(int)
-            data = gather_vector(data, root = j % nprc)
+            datas.append(data)
+        datas = gather_vectors(datas, [j % nprc for j in range(1, nattr+1)])
+        for j, data in zip(range(1, nattr+1), datas):
             if data is not None: edgesc[j] = data
         edges = edgesc
 
@@ -246,14 +252,12 @@ def find_edge_corner(mesh):
 
     if use_parallel:
         # send attribute to owner of edges
+        datas = []
         for j in range(nprc):
             idx = np.logical_and(M >= offset[j], M < offset[j+1])
-            Mpart = M[idx]
-            Npart = N[idx]
-            Mpart = gather_vector(Mpart, root = j)
-            Npart = gather_vector(Npart, root = j)
-            if j==myid: M2, N2 = Mpart, Npart
-        M, N = M2, N2
+            datas.extend([M[idx], N[idx]])
+        datas = gather_vectors(datas, sum([[j, j] for j in range(nprc)], []))
+        M, N = datas[2*myid], datas[2*myid+1]
         
     #nicePrint('unique edge', len(np.unique(M)))
     #nicePrint('N', len(N))    
@@ -323,8 +327,9 @@ def find_edge_corner(mesh):
                    data[iii] = me
             ivert[k] = data
         ivertc = {}
-        for j, k in enumerate(sorted_key):
-            data = gather_vector(ivert[k], root = j % nprc)
+        datas = gather_vectors([ivert[k] for k in sorted_key],
+                               [j % nprc for j in range(len(sorted_key))])
+        for k, data in zip(sorted_key, datas):
             if data is not None:
                 ivertc[k] = data
         ivert = ivertc
@@ -363,8 +368,7 @@ def find_edge_corner(mesh):
     else:
         vtx = np.atleast_1d([]).reshape(-1, sdim)
     if use_parallel:
-        u_own = gather_vector(u_own)
-        vtx   = gather_vector(vtx.flatten())
+        u_own, vtx = gather_vectors([u_own, vtx.flatten()])
 
     # sort vertex  
     if myid == 0:
@@ -506,7 +510,8 @@ def find_corner(mesh):
         comm  = MPI.COMM_WORLD
         
         from mfem.common.mpi_debug import nicePrint, niceCall        
-        from petram.helper.mpi_recipes import allgather, allgather_vector, gather_vector
+        from petram.helper.mpi_recipes import (allgather, allgather_vector,
+                                               gather_vector, gather_vectors)
         from petram.mesh.mesh_utils import distribute_shared_entity        
         if not hasattr(mesh, "shared_info"):
             mesh.shared_info = distribute_shared_entity(mesh)
@@ -531,14 +536,16 @@ def find_corner(mesh):
         return {}, {}, {}
 
     if use_parallel:
-        offset = np.hstack([0, np.cumsum(allgather(mesh.GetNEdges()))])
-        offsetf = np.hstack([0, np.cumsum(allgather(mesh.GetNFaces()))])
-        offsetv = np.hstack([0, np.cumsum(allgather(mesh.GetNV()))])
+        counts = np.array(allgather((mesh.GetNEdges(), mesh.GetNFaces(),
+                                     mesh.GetNV(), nattr)), dtype=int)
+        offset = np.hstack([0, np.cumsum(counts[:, 0])])
+        offsetf = np.hstack([0, np.cumsum(counts[:, 1])])
+        offsetv = np.hstack([0, np.cumsum(counts[:, 2])])
         myoffset = offset[myid]
         myoffsetf = offsetf[myid]
         myoffsetv = offsetv[myid]                
-        nattr = max(allgather(nattr))
-        ne = sum(allgather(mesh.GetNEdges()))
+        nattr = max(counts[:, 3])
+        ne = sum(counts[:, 0])
     else:
         myoffset  = np.array(0, dtype=int)
         myoffsetf = np.array(0, dtype=int)
@@ -605,8 +612,7 @@ def find_corner(mesh):
     else:
         vtx = np.atleast_1d([])
     if use_parallel:
-        vtx = gather_vector(vtx)
-        u_own = gather_vector(u_own)
+        vtx, u_own = gather_vectors([vtx, u_own])
 
     # sort vertex  
     if myid == 0:
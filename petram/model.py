@@ -744,6 +744,9 @@ class Model(RestorableOrderedDict):
         script.append('for s in solvers:')
         script.append('    s.run(eng, is_first=is_first)')
         script.append('    is_first=False')
+        script.append('')
+        script.append('import petram.helper.stage_trace as stage_trace')
+        script.append('stage_trace.write_report()')
         script.append('')        
         script.append('if myid == 0:')
         script.append('    print("End Time " + ')
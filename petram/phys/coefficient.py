@@ -77,6 +77,7 @@ def MCoeff(dim, exprs, ind_vars, l, g, return_complex=False, **kwargs):
         def Eval(self, K, T, ip):
             for n, v in self.variables:
                 v.set_point(T, ip, self.g, self.l)
+            self._batch_lookup(T, ip)
             x = T.Transform(ip)
             val = Coefficient_Evaluator.EvalValue(self, x)
             val = val.reshape(self.height, self.width)
@@ -220,6 +221,7 @@ def VCoeff(dim, exprs, ind_vars, l, g, return_complex=False, **kwargs):
         def Eval(self, V, T, ip):
             for n, v in self.variables:
                 v.set_point(T, ip, self.g, self.l)
+            self._batch_lookup(T, ip)
             x = T.Transform(ip)
             val = Coefficient_Evaluator.EvalValue(self, x)
             return self.proc_value(val)            
@@ -319,6 +321,7 @@ def SCoeff(exprs, ind_vars, l, g, return_complex=False, **kwargs):
         def Eval(self, T, ip):
             for n, v in self.variables:
                 v.set_point(T, ip, self.g, self.l)
+            self._batch_lookup(T, ip)
             x = T.Transform(ip)
             val = Coefficient_Evaluator.EvalValue(self, x)
             if len(self.co) == 1 and len(val) == 1:
@@ -67,7 +67,39 @@ def try_eval(exprs, l, g):
     except:
        return False, exprs
    
+_batch_ipmaps = {}
+def _batch_ipmap(geom, order):
+    '''
+    {(ip.x, ip.y, ip.z): index} of IntRules.Get(geom, order)
+    '''
+    key = (geom, order)
+    if not key in _batch_ipmaps:
+        try:
+            ir = mfem.IntRules.Get(geom, order)
+        except Exception:
+            ir = None
+        if ir is None:
+            _batch_ipmaps[key] = None
+        else:
+            ipmap = {}
+            for j in range(ir.GetNPoints()):
+                ip = ir.IntPoint(j)
+                ipmap[(ip.x, ip.y, ip.z)] = j
+            _batch_ipmaps[key] = ipmap
+    return _batch_ipmaps[key]
+
 class Coefficient_Evaluator(object):
+    # class level switch to turn off batch evaluation
+    batch_eval = True
+    # maximum integration order searched when matching integration point
+    batch_max_order = 40
+    # batch evaluation is turned off when this many ips are not
+    # found in IntRules
+    batch_max_miss = 1000
+
+    # use compiled kernel when it is available
+    use_jit = True
+
     def __init__(self,  exprs,  ind_vars, l, g, real=True):
         ''' 
         this is complicated....
@@ -133,16 +165,181 @@ class Coefficient_Evaluator(object):
         self.flags = [isinstance(co, types.CodeType) for co in self.co]
         self.variables_dd = dict(self.variables)
 
+        # native kernel (expression_jit) for pure arithmetic expressions.
+        # it is used only for batch evaluation (calling it for each
+        # scalar point is slower than eval)
+        self.kernels = [None]*len(self.co)
+        if self.use_jit and self.batch_eval and len(self.variables) == 0:
+            from petram.helper.expression_jit import jit_expression
+            self.kernels = [jit_expression(expr, self.ind_vars, self.g)
+                            if flag else None
+                            for expr, flag in zip(self.exprs, self.flags)]
+
+        # batch evaluation is used only when expression depends
+        # on spatial coordinates alone (Variables needs set_point
+        # at each integration point)
+        self._batch_ok = (self.batch_eval and len(self.variables) == 0
+                          and any(self.flags))
+        self._batch_value = None
+        self._batch_key = None
+        # namespace values used in expressions. batch data is made
+        # again when one of them is replaced (such as time 't')
+        self._batch_ns_names = sorted(set([n for co in self.co
+                                           if isinstance(co, types.CodeType)
+                                           for n in co.co_names
+                                           if n in self.g]))
+        self._batch_ns = None
+        self._batch_data = None
+        self._batch_ipmap = None
+        self._batch_order = {}
+        self._batch_miss = set()
+        self._batch_checked = False
+
+    def EvalValueBatch(self, x):
+        '''
+        evaluate expressions on many points at once.
+           x : (npts, sdim) array
+        returns (npts, ncomp) array. each row is the same as what
+        Coefficient_Evaluator.EvalValue returns for the point.
+
+        raises ValueError if expression does not return an array
+        aligned with the points.
+        '''
+        x = np.atleast_2d(x)
+        npts = x.shape[0]
+        l = {}
+        for k, name in enumerate(self.ind_vars):
+           if k < x.shape[1]:
+               l[name] = x[:, k]
+        val = []
+        for k, (co, flag) in enumerate(zip(self.co, self.flags)):
+           v = np.asarray(self.eval_code(k, l, batch=True))
+           if v.dtype == object:
+               raise ValueError("expression is not vectorizable")
+           if v.ndim == 0:
+               v = np.array([v]*npts)
+           elif v.ndim != 1 or v.shape[0] != npts:
+               raise ValueError("expression is not vectorizable")
+           val.append(v.reshape(-1, 1))
+        return np.hstack(val)
+
+    def eval_code(self, k, l, batch=False):
+        '''
+        evaluate k-th expression. compiled kernel is used for
+        batch evaluation if possible
+        '''
+        kernel = self.kernels[k] if batch else None
+        if kernel is not None:
+            try:
+                return kernel(*[l[n] for n in self.ind_vars])
+            except Exception:
+                dprint1("compiled kernel failed, fall back to eval",
+                        self.exprs[k])
+                self.kernels[k] = None
+        return eval_code(self.co[k], self.g, l, flag=self.flags[k])
+
+    def _find_batch_rule(self, T, ip):
+        '''
+        find IntRules integration rule which contains ip.
+        returns rule order or None. ip which is not found is
+        remembered, so that rules are not scanned again for it.
+        '''
+        geom = T.GetGeometryType()
+        ipkey = (ip.x, ip.y, ip.z)
+        if (geom, ipkey) in self._batch_miss: return None, None
+
+        orders = list(range(self.batch_max_order))
+        if geom in self._batch_order:
+            orders = [self._batch_order[geom]] + orders
+
+        for order in orders:
+            ipmap = _batch_ipmap(geom, order)
+            if ipmap is None: continue
+            if ipkey in ipmap:
+                self._batch_order[geom] = order
+                return order, ipmap
+
+        self._batch_miss.add((geom, ipkey))
+        if len(self._batch_miss) > self.batch_max_miss:
+            # ips are not from IntRules in general
+            dprint2("batch evaluation is not used (ip is not in IntRules)",
+                    self.exprs)
+            self._batch_ok = False
+        return None, None
+
+    def _batch_lookup(self, T, ip):
+        '''
+        prepare self._batch_value for (T, ip). When a new element
+        is visited, expression is evaluated on all integration points
+        of the element in one shot.
+
+        returns True if the value is ready
+        '''
+        self._batch_value = None
+        if not self._batch_ok: return False
+
+        mesh = getattr(T, 'mesh', None)
+        if mesh is not None:
+            # mesh is identified by pointer and its sequence number
+            # (changed by refinement)
+            mesh = (int(mesh.this), mesh.GetSequence())
+        key = (T.ElementNo, getattr(T, 'ElementType', -1), mesh)
+        ipkey = (ip.x, ip.y, ip.z)
+        ns = tuple(self.g.get(n, None) for n in self._batch_ns_names)
+        if (key == self._batch_key and ipkey in self._batch_ipmap and
+            all(a is b for a, b in zip(ns, self._batch_ns))):
+            self._batch_value = self._batch_data[self._batch_ipmap[ipkey]]
+            return True
+
+        order, ipmap = self._find_batch_rule(T, ip)
+        if order is None:
+            # ip is not from IntRules (such as face integration point).
+            # fall back to pointwise evaluation
+            return False
+
+        ir = mfem.IntRules.Get(T.GetGeometryType(), order)
+        npt = ir.GetNPoints()
+        ptx = np.vstack([T.Transform(ir.IntPoint(j)) for j in range(npt)])
+        try:
+            data = self.EvalValueBatch(ptx)
+        except Exception:
+            dprint2("batch evaluation is not used for", self.exprs)
+            self._batch_ok = False
+            return False
+
+        if not self._batch_checked:
+            # compare the first element with pointwise evaluation once
+            self._batch_checked = True
+            for x, v in zip(ptx, data):
+                v0 = Coefficient_Evaluator.EvalValue(self, x)
+                if (v0.shape != v.shape or
+                    not np.allclose(v0, v, equal_nan=True)):
+                    dprint1("batch evaluation disagrees, disabled", self.exprs)
+                    self._batch_ok = False
+                    return False
+
+        self._batch_key = key
+        # values are kept (not id) so that id is not reused
+        self._batch_ns = ns
+        self._batch_data = data
+        self._batch_ipmap = ipmap
+        self._batch_value = data[ipmap[ipkey]]
+        return True
+
     def EvalValue(self, x):
+        if self._batch_value is not None:
+           val = self._batch_value
+           self._batch_value = None
+           return val
+
         for k, name in enumerate(self.ind_vars):
            self.l[name] = x[k]
         for n, v in self.variables:
            kwargs = {nn: self.variables_dd[nn]() for nn in v.dependency}
            self.l[n] = v(**kwargs)
 
-        val = [eval_code(co, self.g, self.l, flag=flag)
-               for co, flag in zip(self.co, self.flags)]
-        return np.array(val, copy=False).flatten()
+        val = [self.eval_code(k, self.l) for k in range(len(self.co))]
+        return np.asarray(val).flatten()
         #return np.array(val, copy=False).ravel()  ## this may be okay
 
 class PhysCoefficient(mfem.PyCoefficient, Coefficient_Evaluator):
@@ -158,6 +355,7 @@ class PhysCoefficient(mfem.PyCoefficient, Coefficient_Evaluator):
     def Eval(self, T, ip):
         for n, v in self.variables:
            v.set_point(T, ip, self.g, self.l)
+        self._batch_lookup(T, ip)
         return super(PhysCoefficient, self).Eval(T, ip)
 
     def EvalValue(self, x):
@@ -188,6 +386,7 @@ class VectorPhysCoefficient(mfem.VectorPyCoefficient, Coefficient_Evaluator):
         if isinstance(ip, mfem.IntegrationPoint):
             for n, v in self.variables:
                 v.set_point(T, ip, self.g, self.l)    
+            self._batch_lookup(T, ip)
             return super(VectorPhysCoefficient, self).Eval(V, T, ip)
         elif isinstance(ip, mfem.IntegrationRule):       
             M = V; ir=ip
@@ -198,6 +397,7 @@ class VectorPhysCoefficient(mfem.VectorPyCoefficient, Coefficient_Evaluator):
                 ip = ir.IntPoint(k)
                 for n, v in self.variables:
                    v.set_point(T, ip, self.g, self.l)    
+                self._batch_lookup(T, ip)
                 super(VectorPhysCoefficient, self).Eval(Mi, T, ip)
 
     def EvalValue(self, x):
@@ -215,6 +415,7 @@ class MatrixPhysCoefficient(mfem.MatrixPyCoefficient, Coefficient_Evaluator):
     def Eval(self, K, T, ip):
         for n, v in self.variables:
            v.set_point(T, ip, self.g, self.l)
+        self._batch_lookup(T, ip)
         return super(MatrixPhysCoefficient, self).Eval(K, T, ip)
 
     def EvalValue(self, x):
@@ -372,6 +573,79 @@ class Phys(Model, Vtable_mixin, NS_mixin):
         called everytime it assembles either matrix or rhs
         '''
         pass
+
+    def get_vt_expression_names(self):
+        '''
+        names used in expressions of all Vtables of this model
+        (vt, vt3, vt_coeff, ..., and Vtables held by the object).
+        None if an expression can not be inspected.
+        '''
+        vts = []
+        for name in dir(self):
+            if not name.startswith('vt'): continue
+            try:
+                v = getattr(self, name)
+            except Exception:
+                return None
+            if isinstance(v, Vtable):
+                vts.append(v)
+            elif isinstance(v, (list, tuple)):
+                if not all([isinstance(x, Vtable) for x in v]): return None
+                vts.extend(v)
+            elif callable(v):
+                continue
+            else:
+                return None
+        for v in self.__dict__.values():
+            if isinstance(v, Vtable) and not any([v is x for x in vts]):
+                vts.append(v)
+
+        names = set()
+        for vt in vts:
+            try:
+                n = vt.expression_names(self)
+            except AttributeError:
+                return None
+            if n is None: return None
+            names.update(n)
+        return names
+
+    def get_ns_dependency(self):
+        '''
+        names in namespace which parameters of this model depend on.
+        Variables and their dependency are expanded. 
+        None means it is not known (model needs to be always updated)
+        '''
+        import types
+        from petram.helper.variables import Variable
+
+        # parameters of parent physics (such as frequency) are used
+        # by child models
+        names = set()
+        p = self
+        while isinstance(p, Phys):
+            n = p.get_vt_expression_names()
+            if n is None: return None
+            names.update(n)
+            p = p.parent
+
+        g = self._global_ns if self._global_ns is not None else {}
+        l = self._local_ns if self._local_ns is not None else {}
+        done = set()
+        todo = list(names)
+        while len(todo) > 0:
+            n = todo.pop()
+            if n in done: continue
+            done.add(n)
+            v = l[n] if n in l else g.get(n, None)
+            if isinstance(v, Variable):
+                dep = v.ns_dependency()
+                if dep is None: return None
+                todo.extend(dep)
+            elif isinstance(v, types.FunctionType):
+                # python function may refer any global
+                return None
+        return done
      
     def postprocess_extra(self, sol, flag, sol_extra):
         '''
@@ -51,6 +51,18 @@ from collections import OrderedDict
 import petram.debug as debug
 dprint1, dprint2, dprint3 = debug.init_dprints('Vtable')
 
+def expression_names(txt):
+    '''
+    names used in an expression text (None if it can not be parsed)
+    '''
+    txt = str(txt).strip()
+    if txt.startswith('='): txt = '='.join(txt.split('=')[1:]).strip()
+    if txt == '': return set()
+    try:
+        return set(compile(txt, '<string>', 'eval').co_names)
+    except SyntaxError:
+        return None
+
 
 class VtableElement(object):
     def __init__(self, name, type = '', 
@@ -342,6 +354,33 @@ class VtableElement(object):
                    f_name.append(f_name0)
             return f_name
         
+    def expression_names(self, obj):
+        '''
+        names used in the expressions of this element.
+        None if unknown
+        '''
+        if self.name is None: return set()
+        if self.type in ('bool', 'string'): return set()
+        
+        if self.type == 'selectable':
+            choice = getattr(obj, self.name + '_select')
+            idx = self.choices.index(choice)
+            return self.vtables[idx].expression_names(obj)
+        
+        if len(self.shape) == 0:
+            txts = [getattr(obj, self.name + '_txt')]
+        elif getattr(obj, 'use_m_'+self.name):
+            txts = [getattr(obj, self.name + '_m_txt')]
+        else:
+            txts = [getattr(obj, self.name + '_' + x + '_txt')
+                    for x in self.suffix]
+        names = set()
+        for txt in txts:
+            n = expression_names(txt)
+            if n is None: return None
+            names.update(n)
+        return names
+            
     def panel_tip(self):
         if self.name is None: return None                       
         return self.tip
@@ -380,6 +419,15 @@ class Vtable(OrderedDict):
         keys = keys if keys is not None else self.keys()
         return [self[key].make_value_or_expression(obj) for key in keys]
 
+    def expression_names(self, obj, keys = None):
+        keys = keys if keys is not None else self.keys()
+        names = set()
+        for key in keys:
+            n = self[key].expression_names(obj)
+            if n is None: return None
+            names.update(n)
+        return names
+
 
     
 class Vtable_mixin(object):
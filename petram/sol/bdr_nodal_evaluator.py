@@ -125,6 +125,7 @@ def eval_at_nodals(obj, expr, solvars, phys):
     '''
 
     from petram.helper.variables import Variable, var_g, NativeCoefficientGenBase, CoefficientVariable
+    from petram.helper.variables import eval_on_points
     
     if len(obj.iverts) == 0: return None
     variables = []
@@ -181,13 +182,8 @@ def eval_at_nodals(obj, expr, solvars, phys):
        elif (n in g):
            var_g2[n] = g[n]
 
-    if len(ll_value) > 0:
-        val = np.array([eval(code, var_g2, dict(zip(ll_name, v)))
-                    for v in zip(*ll_value)])
-    else:
-        # if expr does not involve Varialbe, evaluate code once
-        # and generate an array 
-        val = np.array([eval(code, var_g2)]*len(obj.locs))
+    val = eval_on_points(code, var_g2, ll_name, ll_value,
+                         len(obj.locs), expr=expr)
     return val
 
 class BdrNodalEvaluator(EvaluatorAgent):
@@ -214,6 +210,11 @@ class BdrNodalEvaluator(EvaluatorAgent):
             getelement = mesh.GetElement            
         else:
             assert False, "BdrNodal Evaluator is not supported for this dimension"
+
+        cache_params = (battrs, decimate)
+        if self.load_geometry_cache(mesh, cache_params):
+            self.emesh_idx = emesh_idx
+            return
             
         x = [getarray(battr) for battr in battrs]
         if np.sum([len(xx) for xx in x]) == 0: return
@@ -234,6 +235,9 @@ class BdrNodalEvaluator(EvaluatorAgent):
         for k in list(data):
             setattr(self, k, data[k])
         self.emesh_idx = emesh_idx
+
+        self.save_geometry_cache(mesh, cache_params,
+                                 ['ibeles', 'iverts'] + list(data))
         
     def eval(self, expr, solvars, phys, **kwargs):
         emesh_idx = get_emesh_idx(self, expr, solvars, phys)
@@ -0,0 +1,173 @@
+'''
+   binary_solfile:
+      binary format of solution vector (solr_*, soli_*)
+
+   file layout:
+      magic (16 bytes)
+      length of header (8 bytes, little endian unsigned int)
+      header (json)
+      padding to 64 bytes boundary
+      data (raw array)
+
+   header carries information to rebuild FiniteElementSpace on
+   the mesh (fec name, vdim, ordering) and how data is stored
+   (dtype, size, offset). data can be memory-mapped directly.
+
+   Engine writes one file per variable and per rank, using the same
+   names as text format, and an index (sol_index.json) of all files
+   written in the directory.
+'''
+from __future__ import print_function
+
+import os
+import json
+import struct
+import numpy as np
+
+MAGIC = b'PETRAM_BINSOL_1\n'
+INDEX_FILE = 'sol_index.json'
+ALIGN = 64
+
+def is_binary_solfile(path):
+    try:
+        with open(path, 'rb') as fid:
+            return fid.read(len(MAGIC)) == MAGIC
+    except IOError:
+        return False
+
+def read_header(path, magic=MAGIC):
+    '''
+    return header (dict)
+    '''
+    with open(path, 'rb') as fid:
+        if fid.read(len(magic)) != magic:
+            assert False, path + " is not a binary solution file"
+        l = struct.unpack('<Q', fid.read(8))[0]
+        header = json.loads(fid.read(l).decode())
+    return header
+
+def pack_header(header, magic=MAGIC):
+    '''
+    return bytes written before data (magic, length, header and
+    padding). header['offset'] is set to the beginning of data.
+    if header has 'arrays', offset of each array is set from its
+    'rel_offset' (position relative to the beginning of data).
+    '''
+    # offset depends on header length. iterate until it is settled
+    offset = 0
+    while True:
+        header['offset'] = offset
+        if 'arrays' in header:
+            for info in header['arrays'].values():
+                info['offset'] = offset + info['rel_offset']
+        txt = json.dumps(header, sort_keys=True).encode()
+        l = len(magic) + 8 + len(txt)
+        new_offset = ((l + ALIGN - 1)//ALIGN)*ALIGN
+        if new_offset == offset: break
+        offset = new_offset
+    return magic + struct.pack('<Q', len(txt)) + txt + b'\0'*(offset - l)
+
+def array_header(data, **kwargs):
+    '''
+    header of 1D array (and bytes written before data)
+    '''
+    header = dict(kwargs)
+    header['dtype'] = data.dtype.str
+    header['size'] = int(data.size)
+    return header, pack_header(header)
+
+def write_array(path, data, **kwargs):
+    '''
+    write 1D array with header. kwargs are stored in header
+    '''
+    data = np.ascontiguousarray(data)
+    header, txt = array_header(data, **kwargs)
+
+    with open(path, 'wb') as fid:
+        fid.write(txt)
+        data.tofile(fid)
+    return header
+
+def read_array(path, mmap=True):
+    '''
+    return data. by default it is np.memmap (read-only, zero-copy)
+    '''
+    header = read_header(path)
+    if mmap:
+        return np.memmap(path, dtype=np.dtype(header['dtype']), mode='r',
+                         offset=header['offset'], shape=(header['size'],))
+    with open(path, 'rb') as fid:
+        fid.seek(header['offset'])
+        return np.fromfile(fid, dtype=np.dtype(header['dtype']),
+                           count=header['size'])
+
+def _fespace_info(gf):
+    fes = gf.FESpace()
+    return {'fec': fes.FEColl().Name(),
+            'vdim': fes.GetVDim(),
+            'ordering': fes.GetOrdering()}
+
+def write_gridfunction(path, gf):
+    '''
+    write (Par)GridFunction (local data) and return index entry
+    '''
+    header = write_array(path, gf.GetDataArray(), **_fespace_info(gf))
+    header['file'] = os.path.basename(path)
+    return header
+
+def gridfunction_header(path, gf):
+    '''
+    index entry of (Par)GridFunction without writing it
+    (the same as returned by write_gridfunction)
+    '''
+    header, txt = array_header(np.ascontiguousarray(gf.GetDataArray()),
+                               **_fespace_info(gf))
+    header['file'] = os.path.basename(path)
+    return header
+
+def read_gridfunction(mesh, path):
+    '''
+    build mfem.GridFunction on mesh from binary file
+    '''
+    return make_gridfunction(mesh, read_header(path), read_array(path))
+
+def make_gridfunction(mesh, header, data):
+    '''
+    build mfem.GridFunction on mesh. header gives fec, vdim and
+    ordering
+    '''
+    import mfem.ser as mfem
+
+    fec = mfem.FiniteElementCollection.New(str(header['fec']))
+    fes = mfem.FiniteElementSpace(mesh, fec, int(header['vdim']),
+                                  int(header['ordering']))
+    assert fes.GetVSize() == data.size, "size does not match"
+
+    gf = mfem.GridFunction(fes)
+    gf.Assign(np.array(data, dtype=float))
+    # keep them alive
+    gf._fec = fec
+    gf._fes = fes
+    return gf
+
+def write_index(path, entries, append = False):
+    '''
+    entries : list of headers returned from write_gridfunction
+              (collected from all ranks)
+    append  : add entries to the existing index (if any)
+    '''
+    index = read_index(path) if append else None
+    if index is None:
+        index = {'format': 'binary', 'files': {}}
+    index['files'].update({e['file']: e for e in entries})
+    with open(os.path.join(path, INDEX_FILE), 'w') as fid:
+        json.dump(index, fid, sort_keys=True, indent=1)
+
+def read_index(path):
+    '''
+    return index (dict) or None if directory has no index
+    '''
+    fname = os.path.join(path, INDEX_FILE)
+    if not os.path.exists(fname): return None
+    with open(fname, 'r') as fid:
+        return json.load(fid)
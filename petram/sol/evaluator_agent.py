@@ -2,6 +2,8 @@ import weakref
 from weakref import WeakKeyDictionary as WKD
 from weakref import WeakValueDictionary as WVD
 
+import numpy as np
+
 class EvaluatorAgent(object):
     def __init__(self):
         object.__init__(self)
@@ -18,6 +20,23 @@ class EvaluatorAgent(object):
     def preprocess_geometry(self, *args, **kwargs):
         raise NotImplementedError("subclass needs to implelment this")
 
+    def load_geometry_cache(self, mesh, params):
+        '''
+        set attributes from persistent geometry cache.
+        returns True if cache is found
+        '''
+        from petram.sol.geometry_cache import load_geometry
+        data = load_geometry(mesh, self.__class__.__name__, params)
+        if data is None: return False
+        for k in data:
+            setattr(self, k, data[k])
+        return True
+
+    def save_geometry_cache(self, mesh, params, names):
+        from petram.sol.geometry_cache import save_geometry
+        data = {n: getattr(self, n) for n in names}
+        save_geometry(mesh, self.__class__.__name__, params, data)
+
     def eval(self, expr, solvars, phys):    
         raise NotImplementedError("subclass needs to implelment this")        
     
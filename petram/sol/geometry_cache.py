@@ -0,0 +1,199 @@
+'''
+   geometry_cache:
+      persistent cache of preprocessed geometry data of evaluator
+      agents.
+
+   data is stored in a directory named by a hash of mesh file contents,
+   refine level, evaluator kind and evaluator parameters. numpy arrays
+   are saved as .npy and memory-mapped back. others are pickled.
+
+   the cache is off unless $PetraM_GEOM_CACHE is set.
+      PetraM_GEOM_CACHE=soldir : .geom_cache in the solution directory
+      PetraM_GEOM_CACHE=<path> : <path>
+   total size is limited by $PetraM_GEOM_CACHE_MB (default 1024).
+   least recently used entries are removed when it is exceeded.
+
+   cache directory is created private (0700). data is not read from a
+   directory which is writable by other users, since it is unpickled.
+'''
+from __future__ import print_function
+
+import os
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import six
+from six.moves import cPickle as pickle
+
+import petram.debug as debug
+dprint1, dprint2, dprint3 = debug.init_dprints('GeometryCache')
+
+def cache_dir(mesh=None):
+    path = os.getenv('PetraM_GEOM_CACHE', '')
+    if path == '' or path.lower() == 'none': return None
+    if path.lower() == 'soldir':
+        solfile = getattr(mesh, '_solfile', None)
+        if solfile is None: return None
+        return os.path.join(os.path.dirname(os.path.abspath(solfile)),
+                            '.geom_cache')
+    return path
+
+def cache_size_limit():
+    return int(float(os.getenv('PetraM_GEOM_CACHE_MB', '1024'))*1024*1024)
+
+def is_private(path):
+    '''
+    True if path is owned by the user and not writable by others
+    '''
+    if not hasattr(os, 'getuid'): return True
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    if st.st_uid != os.getuid(): return False
+    return (st.st_mode & 0o022) == 0
+
+def _entry_size(path):
+    size = 0
+    for n in os.listdir(path):
+        try:
+            size = size + os.path.getsize(os.path.join(path, n))
+        except OSError:
+            pass
+    return size
+
+def evict(top, limit=None):
+    '''
+    remove least recently used entries until total size is
+    below limit (bytes)
+    '''
+    if limit is None: limit = cache_size_limit()
+    entries = []
+    for n in os.listdir(top):
+        path = os.path.join(top, n)
+        index = os.path.join(path, 'index')
+        if not os.path.exists(index): continue
+        entries.append((os.path.getmtime(index), _entry_size(path), path))
+    entries = sorted(entries)
+    total = sum([x[1] for x in entries])
+    while total > limit and len(entries) > 0:
+        t, size, path = entries.pop(0)
+        shutil.rmtree(path, ignore_errors=True)
+        total = total - size
+        dprint2("geometry cache is removed", path)
+
+_file_hashes = {}
+def file_hash(path):
+    '''
+    sha1 of file contents (memorized using mtime and size)
+    '''
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_mtime, st.st_size)
+    if not key in _file_hashes:
+        h = hashlib.sha1()
+        with open(path, 'rb') as fid:
+            while True:
+                chunk = fid.read(1 << 20)
+                if not chunk: break
+                h.update(chunk)
+        _file_hashes[key] = h.hexdigest()
+    return _file_hashes[key]
+
+def _update_hash(h, value):
+    if isinstance(value, np.ndarray):
+        h.update(str((value.dtype.str, value.shape)).encode())
+        h.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, (list, tuple)):
+        h.update(('(' + str(len(value))).encode())
+        for v in value: _update_hash(h, v)
+        h.update(b')')
+    elif isinstance(value, (set, frozenset)):
+        _update_hash(h, sorted(value))
+    elif isinstance(value, dict):
+        _update_hash(h, sorted(value.items()))
+    else:
+        h.update(repr(value).encode())
+
+def cache_key(mesh, kind, params):
+    '''
+    mesh needs to know its file (_solfile, _refine are set by Solsets)
+    '''
+    solfile = getattr(mesh, '_solfile', None)
+    if solfile is None or not os.path.exists(solfile): return None
+
+    h = hashlib.sha1()
+    h.update(file_hash(solfile).encode())
+    _update_hash(h, (getattr(mesh, '_refine', 0), kind, params))
+    return kind + '_' + h.hexdigest()
+
+def load_geometry(mesh, kind, params):
+    '''
+    return dictionary of cached data or None
+    '''
+    top = cache_dir(mesh)
+    if top is None: return None
+    key = cache_key(mesh, kind, params)
+    if key is None: return None
+
+    path = os.path.join(top, key)
+    index = os.path.join(path, 'index')
+    if not os.path.exists(index): return None
+    if not (is_private(top) and is_private(path)):
+        dprint1("geometry cache is not used (not private)", path)
+        return None
+
+    try:
+        with open(index, 'rb') as fid:
+            arrays, objects = pickle.load(fid)
+        data = {}
+        for n in arrays:
+            data[n] = np.load(os.path.join(path, n + '.npy'), mmap_mode='r')
+        data.update(objects)
+        # mtime of index is used as last access time
+        os.utime(index, None)
+    except Exception:
+        dprint1("failed to read geometry cache", path)
+        return None
+    dprint1("geometry cache is used", key)
+    return data
+
+def save_geometry(mesh, kind, params, data):
+    '''
+    data : dictionary of data to be stored
+    '''
+    top = cache_dir(mesh)
+    if top is None: return
+    key = cache_key(mesh, kind, params)
+    if key is None: return
+
+    path = os.path.join(top, key)
+    if os.path.exists(path): return
+
+    try:
+        if not os.path.exists(top): os.makedirs(top, 0o700)
+        if not is_private(top):
+            dprint1("geometry cache is not used (not private)", top)
+            return
+        # write to temporary directory and rename it, so that other
+        # processes don't see incomplete data
+        tmp = tempfile.mkdtemp(dir=top)
+        arrays = []
+        objects = {}
+        for n in data:
+            v = data[n]
+            if isinstance(v, np.ndarray) and v.dtype != object:
+                np.save(os.path.join(tmp, n + '.npy'), v)
+                arrays.append(n)
+            else:
+                objects[n] = v
+        with open(os.path.join(tmp, 'index'), 'wb') as fid:
+            pickle.dump((arrays, objects), fid, protocol=2)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # someone else stored the same data
+            shutil.rmtree(tmp, ignore_errors=True)
+        evict(top)
+    except Exception:
+        dprint1("failed to write geometry cache", path)
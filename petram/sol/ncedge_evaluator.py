@@ -29,7 +29,7 @@ def eval_on_edges(obj, expr, solvars, phys):
 
     to be done : obj should be replaced by a dictionary
     '''
-    from petram.helper.variables import Variable, var_g
+    from petram.helper.variables import Variable, var_g, eval_on_points
 
     if len(obj.ifaces) == 0: return None
     variables = []
@@ -74,13 +74,8 @@ def eval_on_edges(obj, expr, solvars, phys):
        elif (n in g):
            var_g2[n] = g[n]
 
-    if len(ll_value) > 0:
-        val = np.array([eval(code, var_g2, dict(zip(ll_name, v)))
-                    for v in zip(*ll_value)])
-    else:
-        # if expr does not involve Varialbe, evaluate code once
-        # and generate an array 
-        val = np.array([eval(code, var_g2)]*len(obj.ptx))
+    val = eval_on_points(code, var_g2, ll_name, ll_value,
+                         len(obj.ptx), expr=expr)
     return val
 
 class NCEdgeEvaluator(EvaluatorAgent):
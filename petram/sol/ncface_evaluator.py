@@ -30,7 +30,7 @@ def eval_on_faces(obj, expr, solvars, phys):
 
     to be done : obj should be replaced by a dictionary
     '''
-    from petram.helper.variables import Variable, var_g
+    from petram.helper.variables import Variable, var_g, eval_on_points
 
     if len(obj.ifaces) == 0: return None
     variables = []
@@ -75,13 +75,8 @@ def eval_on_faces(obj, expr, solvars, phys):
        elif (n in g):
            var_g2[n] = g[n]
 
-    if len(ll_value) > 0:
-        val = np.array([eval(code, var_g2, dict(zip(ll_name, v)))
-                    for v in zip(*ll_value)])
-    else:
-        # if expr does not involve Varialbe, evaluate code once
-        # and generate an array 
-        val = np.array([eval(code, var_g2)]*len(obj.ptx))
+    val = eval_on_points(code, var_g2, ll_name, ll_value,
+                         len(obj.ptx), expr=expr)
     return val
 
 class NCFaceEvaluator(EvaluatorAgent):
@@ -121,6 +116,14 @@ class NCFaceEvaluator(EvaluatorAgent):
             getattr2 = lambda x: -1
         else:
             assert False, "NCFace Evaluator is not supported for this dimension"
+
+        cache_params = (battrs, self.refine)
+        if self.load_geometry_cache(mesh, cache_params):
+            # IntegrationRules are not stored. take them from refiner
+            self.irs = {gtype: GR.Refine(int(gtype), self.refine).RefPts
+                        for gtype in np.unique(self.gtypes)}
+            self.emesh_idx = emesh_idx
+            return
             
         x = [getarray(battr) for battr in battrs]
         if np.sum([len(xx) for xx in x]) == 0: return
@@ -171,6 +174,10 @@ class NCFaceEvaluator(EvaluatorAgent):
         self.ifaces = np.hstack(ifaces)
 
         self.emesh_idx = emesh_idx
+
+        self.save_geometry_cache(mesh, cache_params,
+                                 ['ibeles', 'gtypes', 'elattr1', 'elattr2',
+                                  'ptx', 'ridx', 'ifaces'])
         
     def eval(self, expr, solvars, phys, **kwargs):
         refine = kwargs.pop("refine", 1)        
@@ -0,0 +1,321 @@
+'''
+   parametric_store:
+      compact container of parametric scan results
+
+   instead of writing mesh and solution files in caseN/ directories,
+   Parametric writes them in one directory.
+
+      parametric_store/
+         store.json          : scanner names, parameters and status
+                               of each case (written by root)
+         solmesh_<idx><sfx>  : mesh (written once)
+         store<sfx>          : solutions of all cases (one file per
+                               rank, <sfx> = solfile suffix)
+         store_<n><sfx>      : solutions of another solve step
+
+   store<sfx> uses the layout of binary_solfile (magic, json header,
+   aligned data). data consists of a 2D array (ncase x size) for
+   each solution vector (solr_<name>_<idx>, soli_<name>_<idx>).
+   since a case is a contiguous row, one case can be memory-mapped
+   without reading others, and a quantity across cases can be
+   computed using (ncase x size) array.
+
+   the data file is allocated when the first case is written. cases
+   can be written in any order and from forked processes (access is
+   serialized by a lock file). when solve steps in a scan save
+   different sets of solution vectors, each set has its own data
+   file (store, store_1, store_2, ...). if a vector is in several
+   files, the one in the later file is used (as if it is overwritten).
+
+      store = ParametricStore(path)
+      store.params                   # list of scanner parameters
+      store.array('solr_E_0')        # (ncase x size) np.memmap
+      store.case(3, 'solr_E_0')      # 1D np.memmap
+      solfiles = find_solfiles(path, idx = 3) # Solfiles of a case
+'''
+from __future__ import print_function
+
+import os
+import json
+import fcntl
+from contextlib import contextmanager
+import numpy as np
+
+from petram.sol.binary_solfile import (pack_header, read_header,
+                                       make_gridfunction)
+
+import petram.debug as debug
+dprint1, dprint2, dprint3 = debug.init_dprints('ParametricStore')
+
+MAGIC = b'PETRAM_PSTORE_1\n'
+STORE_DIR = 'parametric_store'
+MANIFEST_FILE = 'store.json'
+DATA_FILE = 'store'
+
+def is_store(path):
+    return os.path.exists(os.path.join(path, MANIFEST_FILE))
+
+def _to_json(x):
+    if hasattr(x, 'item'): x = x.item()
+    if isinstance(x, complex): return str(x)
+    if isinstance(x, (int, float, str, bool)) or x is None: return x
+    return str(x)
+
+def split_data_file(x):
+    '''
+    'store_1.000002' -> (1, '.000002')
+    '''
+    suffix = x[x.index('.'):] if '.' in x else ''
+    part = x[len(DATA_FILE):len(x)-len(suffix)]
+    return (0 if part == '' else int(part[1:])), suffix
+
+def data_file_name(part, suffix):
+    return DATA_FILE + ('' if part == 0 else '_' + str(part)) + suffix
+
+def mesh_files(path, suffix):
+    return [x for x in os.listdir(path)
+            if x.startswith('solmesh') and
+               ((suffix == '' and len(x.split('.')) == 1) or
+                (suffix != '' and x.endswith(suffix)))]
+
+class StoreWriter(object):
+    def __init__(self, path, ncase, names):
+        self.path = path
+        self.ncase = ncase
+        self.names = list(names)
+        self._headers = {}    # (suffix, keys) -> (data file, header)
+        self._mesh_saved = set()
+
+    def data_file(self, suffix='', part=0):
+        return os.path.join(self.path, data_file_name(part, suffix))
+
+    @contextmanager
+    def lock(self, suffix=''):
+        with open(self.data_file(suffix) + '.lock', 'w') as fid:
+            fcntl.flock(fid, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fid, fcntl.LOCK_UN)
+
+    def save_mesh(self, engine, save_parmesh=False):
+        '''
+        write mesh files in store directory (once)
+        '''
+        suffix = engine.solfile_suffix()
+        if suffix in self._mesh_saved: return
+        od = os.getcwd()
+        os.chdir(self.path)
+        try:
+            with self.lock(suffix):
+                if len(mesh_files(self.path, suffix)) == 0:
+                    engine.save_mesh()
+                    if save_parmesh: engine.save_parmesh()
+        finally:
+            os.chdir(od)
+        self._mesh_saved.add(suffix)
+
+    def _allocate(self, suffix, gfs):
+        '''
+        find data file for the set of keys in gfs (it may be made by
+        other process), or create a new one.
+        returns (data file, header)
+        '''
+        keys = sorted([key for key, gf in gfs])
+        part = 0
+        while True:
+            fname = self.data_file(suffix, part)
+            if not os.path.exists(fname): break
+            header = read_header(fname, magic=MAGIC)
+            if sorted(header['arrays']) == keys:
+                for key, gf in gfs:
+                    if header['arrays'][key]['shape'][1] != gf.Size():
+                        assert False, "size of " + key + " changed in parametric scan"
+                return fname, header
+            part = part + 1
+
+        arrays = {}
+        pos = 0
+        for key, gf in gfs:
+            fes = gf.FESpace()
+            size = int(gf.Size())
+            arrays[key] = {'rel_offset': pos,
+                           'shape': [self.ncase, size],
+                           'fec': fes.FEColl().Name(),
+                           'vdim': fes.GetVDim(),
+                           'ordering': fes.GetOrdering()}
+            pos = pos + self.ncase*size*8
+        header = {'dtype': np.dtype(np.float64).str,
+                  'ncase': self.ncase,
+                  'names': self.names,
+                  'arrays': arrays}
+        txt = pack_header(header, magic=MAGIC)
+        with open(fname, 'wb') as fid:
+            fid.write(txt)
+            fid.truncate(len(txt) + pos)
+        # offsets are set by pack_header
+        return fname, header
+
+    def write_case(self, kcase, gfs, suffix=''):
+        '''
+        gfs : list of (key, (Par)GridFunction)
+        '''
+        hkey = (suffix, tuple(sorted([key for key, gf in gfs])))
+        if not hkey in self._headers:
+            with self.lock(suffix):
+                self._headers[hkey] = self._allocate(suffix, gfs)
+        fname, header = self._headers[hkey]
+
+        with open(fname, 'r+b') as fid:
+            for key, gf in gfs:
+                info = header['arrays'][key]
+                fid.seek(info['offset'] + kcase*info['shape'][1]*8)
+                data = np.ascontiguousarray(gf.GetDataArray(),
+                                            dtype=np.float64)
+                data.tofile(fid)
+
+    def write_manifest(self, params, status=None):
+        '''
+        params : list of scanner parameters (scanner.list_data())
+        status : list of case status (dict)
+        '''
+        if status is None:
+            status = [{'case': k, 'status': 'done'} for k in range(self.ncase)]
+        files = sorted([x for x in os.listdir(self.path)
+                        if x.startswith(DATA_FILE) and not x.endswith('.lock')
+                        and x != MANIFEST_FILE])
+        manifest = {'names': self.names,
+                    'ncase': self.ncase,
+                    'params': [[_to_json(x) for x in p] for p in params],
+                    'status': status,
+                    'files': files}
+        with open(os.path.join(self.path, MANIFEST_FILE), 'w') as fid:
+            json.dump(manifest, fid, indent=1)
+        for x in os.listdir(self.path):
+            if x.endswith('.lock'): os.remove(os.path.join(self.path, x))
+
+class StoreRef(str):
+    '''
+    reference to a solution vector in parametric store. it is a
+    path of data file, so that it can be used as a solution file
+    name in Solfiles/Solsets.
+    '''
+    def __new__(cls, path, key, kcase, emesh_idx):
+        obj = str.__new__(cls, path)
+        obj.key = key
+        obj.kcase = kcase
+        obj.emesh_idx = emesh_idx
+        return obj
+
+    @property
+    def cache_key(self):
+        return (str(self), self.key, self.kcase)
+
+    def load(self, mesh):
+        header = read_header(self, magic=MAGIC)
+        return make_gridfunction(mesh, header['arrays'][self.key],
+                                 read_row(self, header, self.key, self.kcase))
+
+def read_row(path, header, key, kcase):
+    info = header['arrays'][key]
+    size = info['shape'][1]
+    return np.memmap(path, dtype=np.dtype(header['dtype']), mode='r',
+                     offset=info['offset'] + kcase*size*8,
+                     shape=(size,))
+
+class ParametricStore(object):
+    '''
+    reader of parametric store
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST_FILE), 'r') as fid:
+            self.manifest = json.load(fid)
+        self._headers = {}
+
+    @property
+    def names(self):
+        return self.manifest['names']
+
+    @property
+    def params(self):
+        return self.manifest['params']
+
+    @property
+    def status(self):
+        return self.manifest['status']
+
+    def __len__(self):
+        return self.manifest['ncase']
+
+    @property
+    def suffixes(self):
+        return sorted(set([split_data_file(x)[1]
+                           for x in self.manifest['files']]))
+
+    def data_files(self, suffix=''):
+        '''
+        data files of suffix (in the order of part number)
+        '''
+        files = [split_data_file(x) + (x,) for x in self.manifest['files']]
+        files = sorted([(part, x) for part, s, x in files if s == suffix])
+        return [os.path.join(self.path, x) for part, x in files]
+
+    def header(self, fname):
+        if not fname in self._headers:
+            self._headers[fname] = read_header(fname, magic=MAGIC)
+        return self._headers[fname]
+
+    def _key_map(self, suffix):
+        '''
+        key -> (data file, header). later data file wins
+        '''
+        ret = {}
+        for fname in self.data_files(suffix):
+            header = self.header(fname)
+            for key in header['arrays']:
+                ret[key] = (fname, header)
+        return ret
+
+    def keys(self, suffix=''):
+        return sorted(self._key_map(suffix))
+
+    def array(self, key, suffix=''):
+        '''
+        (ncase x size) array of key (memory-mapped)
+        '''
+        fname, header = self._key_map(suffix)[key]
+        info = header['arrays'][key]
+        return np.memmap(fname,
+                         dtype=np.dtype(header['dtype']), mode='r',
+                         offset=info['offset'], shape=tuple(info['shape']))
+
+    def case(self, kcase, key, suffix=''):
+        '''
+        solution vector of one case (memory-mapped)
+        '''
+        fname, header = self._key_map(suffix)[key]
+        return read_row(fname, header, key, kcase)
+
+    def solfiles(self, kcase):
+        '''
+        list of [meshes, {name: (solr, soli)}] for each suffix, in
+        the format of Solfiles.set
+        '''
+        solfiles = []
+        for s in self.suffixes:
+            meshes = [os.path.join(self.path, x)
+                      for x in mesh_files(self.path, s)]
+            keymap = self._key_map(s)
+            sol = {}
+            for key in sorted(keymap):
+                if not key.startswith('solr_'): continue
+                n = key[5:]
+                idx = int(n.split('_')[-1])
+                solr = StoreRef(keymap[key][0], key, kcase, idx)
+                soli = (StoreRef(keymap['soli_' + n][0], 'soli_' + n,
+                                 kcase, idx)
+                        if ('soli_' + n) in keymap else None)
+                sol[n] = (solr, soli)
+            solfiles.append([meshes, sol])
+        return solfiles
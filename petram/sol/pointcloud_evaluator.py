@@ -17,6 +17,25 @@ from petram.sol.evaluator_agent import EvaluatorAgent
 from petram.sol.bdr_nodal_evaluator import process_iverts2nodals
 from petram.sol.bdr_nodal_evaluator import eval_at_nodals, get_emesh_idx
 
+def intpoints2array(int_points):
+    '''
+    IntegrationPoints (or None) -> (n, 4) array (x, y, z, weight)
+    '''
+    ret = np.zeros((len(int_points), 4)) + np.nan
+    for k, ip in enumerate(int_points):
+        if ip is None: continue
+        ret[k] = (ip.x, ip.y, ip.z, ip.weight)
+    return ret
+
+def array2intpoints(arr):
+    int_points = [None]*len(arr)
+    for k, v in enumerate(arr):
+        if np.isnan(v[0]): continue
+        ip = mfem.IntegrationPoint()
+        ip.Set(v[0], v[1], v[2], v[3])
+        int_points[k] = ip
+    return int_points
+
 class PointcloudEvaluator(EvaluatorAgent):
     def __init__(self, attrs, pc_type=None, pc_param=None):
         '''
@@ -64,6 +83,13 @@ class PointcloudEvaluator(EvaluatorAgent):
 
         mesh = self.mesh()[emesh_idx]
 
+        cache_params = (sorted(self.attrs), self.points)
+        if self.load_geometry_cache(mesh, cache_params):
+            self.int_points = array2intpoints(self.int_points)
+            self.emesh_idx = emesh_idx
+            self.knowns = WKD()
+            return
+
         v = mfem.Vector()
         mesh.GetVertices(v)
         vv = v.GetDataArray()
@@ -103,8 +129,14 @@ class PointcloudEvaluator(EvaluatorAgent):
         self.emesh_idx = emesh_idx
         self.knowns = WKD()        
 
+        names = ['elem_ids', 'masked_attrs', 'counts', 'locs', 'valid_idx']
+        self.int_points = intpoints2array(int_points)
+        self.save_geometry_cache(mesh, cache_params, names + ['int_points'])
+        self.int_points = int_points
+
     def eval_at_points(self, expr, solvars, phys):
         from petram.helper.variables import Variable, var_g, NativeCoefficientGenBase, CoefficientVariable
+        from petram.helper.variables import eval_on_points
     
         variables = []
         st = parser.expr(expr)
@@ -156,13 +188,8 @@ class PointcloudEvaluator(EvaluatorAgent):
            elif (n in g):
                var_g2[n] = g[n]
 
-        if len(ll_value) > 0:
-            val = np.array([eval(code, var_g2, dict(zip(ll_name, v)))
-                        for v in zip(*ll_value)])
-        else:
-            # if expr does not involve Varialbe, evaluate code once
-            # and generate an array 
-            val = np.array([eval(code, var_g2)]*len(self.locs))
+        val = eval_on_points(code, var_g2, ll_name, ll_value,
+                             len(self.locs), expr=expr)
         return val
 
 
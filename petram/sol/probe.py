@@ -1,7 +1,33 @@
+'''
+   probe:
+      time (or parameter) trace of DoFs
+
+   format 0, 1 : text
+   format 2    : binary (append-only)
+        "format : 2\n"
+        header (json, one line, padded to 64 bytes boundary)
+        records of [x (xsize), y (ysize)]
+
+      records are appended as they are flushed. a reader can memory-map
+      the data and uses only complete records, so that a file can be read
+      while it is still written.
+
+      once records are written, they are dropped from memory. a long
+      time stepping keeps only records after the last flush.
+
+      when a later record needs a wider data type (such as complex
+      after real), the file is rewritten with the new data type.
+'''
 import numpy as np
 import os
+import json
+from functools import reduce
 
 from petram.mfem_config import use_parallel
+
+import petram.debug as debug
+dprint1, dprint2, dprint3 = debug.init_dprints('Probe')
+
 if use_parallel:
     from mpi4py import MPI                               
     num_proc = MPI.COMM_WORLD.size
@@ -24,8 +50,17 @@ def list_probes(dir):
     return filenames, probenames
     
 def load_probe(name):
+    with open(name, 'rb') as fid:
+        format = int(fid.readline().decode().split(':')[-1])
+
+    if format == 2:
+        # binary records. file is not read in text mode
+        xdata, ydata, names = load_format_2(name)
+        xdata = {n:xdata[k] for k, n in enumerate(names)}
+        return xdata, ydata
+
     fid = open(name, 'r')
-    format = int(fid.readline().split(':')[-1])
+    fid.readline()
 
     if format == 0:
         value = load_format_0(fid)
@@ -70,6 +105,52 @@ def load_format_1(fid):
     
     return xdata, ydata, xnames
     
+def read_format_2_header(fid):
+    '''
+    fid is placed after format line. return header and record dtype
+    '''
+    header = json.loads(fid.readline().decode())
+    dtype = np.dtype([('x', header['xdtype'], (header['xsize'],)),
+                      ('y', header['ydtype'], (header['ysize'],))])
+    return header, dtype
+
+def load_format_2(name, mmap=True):
+    with open(name, 'rb') as fid:
+        fid.readline()
+        header, dtype = read_format_2_header(fid)
+        offset = fid.tell()
+    # incomplete record at the end (file is being written) is ignored
+    nrec = (os.path.getsize(name) - offset)//dtype.itemsize
+
+    if nrec == 0:
+        data = np.zeros(0, dtype=dtype)
+    elif mmap:
+        data = np.memmap(name, dtype=dtype, mode='r', offset=offset,
+                         shape=(nrec,))
+    else:
+        with open(name, 'rb') as fid:
+            fid.seek(offset)
+            data = np.fromfile(fid, dtype=dtype, count=nrec)
+
+    xdata = data['x'].transpose()
+    ydata = data['y'].transpose()
+    return xdata, ydata, header['xnames']
+
+def _result_type(arrays):
+    return reduce(np.promote_types, [np.asarray(x).dtype for x in arrays])
+
+def write_format_2_header(fid, xnames, xsize, ysize, xdtype, ydtype):
+    header = {'xnames': list(xnames),
+              'xsize': int(xsize),
+              'ysize': int(ysize),
+              'xdtype': np.dtype(xdtype).str,
+              'ydtype': np.dtype(ydtype).str}
+    txt = json.dumps(header).encode()
+    l = len(b"format : 2\n") + len(txt) + 1
+    pad = (-l) % 64
+    # written at once, so that a reader does not see a partial header
+    fid.write(b"format : 2\n" + txt + b' '*pad + b"\n")
+
 class Probe(object):
     def __init__(self, name, idx=-1, xnames = None):
         '''
@@ -82,14 +163,22 @@ class Probe(object):
         self.t = []        
         self.idx = idx
         self.finalized = False
+        self._written = 0        # number of records in file
+        self._filename = None
+        self._dtypes = None
+
+    def write_file(self, filename = None, format=2):
+        if filename is None:
+            filename = 'probe_'+self.name + smyid
+
+        if format == 2:
+            if self._write_format_2(filename): return
+            # non-numeric data. fall back to text
+            format = 1
 
-    def write_file(self, filename = None, format=1):
         valid = self.finalize()
         if not valid: return
         
-        if filename is None:
-            filename = 'probe_'+self.name + smyid
-            
         fid = open(filename, 'w')
 
         if format == 0:
@@ -105,6 +194,91 @@ class Probe(object):
            fid.write(txt1 + ', '+ txt2 +"\n")
         fid.close()
 
+    def _write_format_2(self, filename):
+        '''
+        append records which are not written yet.
+        '''
+        if filename != self._filename:
+            self._written = 0
+        sig = self.sig
+        t = self.t
+        if self._written == 0 and len(sig) == 0: return True
+
+        if self._written == 0:
+            xdtype = _result_type(t)
+            ydtype = _result_type(sig)
+            if xdtype.kind not in 'biuf' or ydtype.kind not in 'biufc':
+                return False
+            if ydtype.kind in 'biu': ydtype = np.dtype(float)
+            if xdtype.kind in 'biu': xdtype = np.dtype(float)
+            self._dtypes = (xdtype, ydtype)
+
+            fid = open(filename, 'wb')
+            write_format_2_header(fid, self.xnames, t[0].size, sig[0].size,
+                                  xdtype, ydtype)
+            fid.flush()
+            fid.close()
+            self._filename = filename
+        elif len(sig) > 0:
+            # data type may change (such as real to complex). in this
+            # case, records already written are converted
+            xdtype, ydtype = self._dtypes
+            new_xdtype = np.promote_types(xdtype, _result_type(t))
+            new_ydtype = np.promote_types(ydtype, _result_type(sig))
+            if (new_xdtype.kind not in 'biuf' or
+                new_ydtype.kind not in 'biufc'):
+                assert False, "probe "+self.name+" changed its data type"
+            if new_xdtype != xdtype or new_ydtype != ydtype:
+                self._convert_format_2(filename, new_xdtype, new_ydtype)
+
+        if len(sig) > 0:
+            xdtype, ydtype = self._dtypes
+            tt = np.vstack([x.flatten() for x in t]).astype(xdtype)
+            ss = np.vstack([x.flatten() for x in sig]).astype(ydtype)
+            dtype = np.dtype([('x', xdtype, (tt.shape[1],)),
+                              ('y', ydtype, (ss.shape[1],))])
+            data = np.empty(len(sig), dtype=dtype)
+            data['x'] = tt
+            data['y'] = ss
+            fid = open(filename, 'ab')
+            data.tofile(fid)
+            fid.close()
+            self._written += len(sig)
+            self.sig = []
+            self.t = []
+        return True
+
+    def _convert_format_2(self, filename, xdtype, ydtype):
+        '''
+        rewrite format 2 file with new data type
+        '''
+        dprint1("probe " + self.name + " : data type is changed to",
+                xdtype, ydtype)
+        xdata, ydata, xnames = load_format_2(filename, mmap=False)
+        dtype = np.dtype([('x', xdtype, (xdata.shape[0],)),
+                          ('y', ydtype, (ydata.shape[0],))])
+        data = np.empty(xdata.shape[1], dtype=dtype)
+        data['x'] = xdata.transpose()
+        data['y'] = ydata.transpose()
+
+        # written to a new file first, so that a reader does not see
+        # a partially converted file
+        tmp = filename + '.tmp'
+        fid = open(tmp, 'wb')
+        write_format_2_header(fid, xnames, xdata.shape[0], ydata.shape[0],
+                              xdtype, ydtype)
+        data.tofile(fid)
+        fid.close()
+        getattr(os, 'replace', os.rename)(tmp, filename)
+        self._dtypes = (xdtype, ydtype)
+        self._written = len(data)
+
+    def pending(self):
+        '''
+        number of records not yet written
+        '''
+        return len(self.sig)
+
     def append_sol(self, sol, t=0.0):
         self.sig.append(np.atleast_1d(sol[self.idx].toarray().flatten()))
         self.t.append(np.atleast_1d(t))
@@ -46,6 +46,11 @@ class SliceEvaluator(EvaluatorAgent):
         axyz = self.plane[:3]
         c    = self.plane[-1]
 
+        cache_params = (attrs, plane)
+        if self.load_geometry_cache(mesh, cache_params):
+            self.emesh_idx = emesh_idx
+            return
+
         attr = mesh.GetAttributeArray()
         x = [np.where(attr == a)[0] for a in attrs]
         if np.sum([len(xx) for xx in x]) == 0: return
@@ -141,6 +146,10 @@ class SliceEvaluator(EvaluatorAgent):
         self.interp_mat = mat
 
         self.emesh_idx = emesh_idx
+
+        self.save_geometry_cache(mesh, cache_params,
+                                 ['ibeles', 'iverts', 'vertices',
+                                  'interp_mat'] + list(data))
         
     def set_plane(self, a, b, c, d):
         '''
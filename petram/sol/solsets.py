@@ -3,6 +3,10 @@ from __future__ import print_function
 import os
 import six
 import numpy as np
+from functools import partial
+from collections import OrderedDict
+from weakref import WeakValueDictionary as WVD
+from weakref import ref as weakref
 
 class Solfiles(object):
     '''
@@ -43,43 +47,204 @@ class Solfiles(object):
         return False
         
 class MeshDict(dict):
-    pass
+    '''
+    emesh_idx -> mfem.Mesh
+
+    a mesh registered by set_loader is read when it is accessed
+    first
+    '''
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._loaders = {}
+
+    def set_loader(self, key, loader):
+        dict.__setitem__(self, key, None)
+        self._loaders[key] = loader
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if value is None and key in self._loaders:
+            value = self._loaders[key]()
+            dict.__setitem__(self, key, value)
+        return value
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def values(self):
+        return [self[k] for k in self]
+
+    def items(self):
+        return [(k, self[k]) for k in self]
+
+# meshes are shared among Solsets (checkpoints, parametric cases)
+# as long as someone holds it. recently used meshes are kept alive
+# so that it is not read again when moving to the next checkpoint.
+_mesh_cache = WVD()
+_mesh_recent = OrderedDict()
+mesh_keep_alive = 4
+
+def load_mesh(path, emesh_idx, refine=0):
+    from petram.sol.geometry_cache import file_hash
+    import mfem.ser as mfem
+
+    key = (file_hash(path), refine, emesh_idx)
+    m = _mesh_cache.get(key, None)
+    if m is None:
+        fix_orientation=False
+        m = mfem.Mesh(str(path), 1, refine, fix_orientation)
+        m._emesh_idx = emesh_idx
+        # used as a key of geometry_cache
+        m._solfile = str(path)
+        m._refine = refine
+        _mesh_cache[key] = m
+    _mesh_recent.pop(key, None)
+    _mesh_recent[key] = m
+    while len(_mesh_recent) > mesh_keep_alive:
+        _mesh_recent.popitem(last=False)
+    return m
+
+class GridFunctionLRU(object):
+    '''
+    keep recently used GridFunctions up to memory budget (bytes).
+    a GridFunction pushed out from LRU is still reused if someone 
+    (such as Variable) holds it.
+    '''
+    def __init__(self, budget):
+        self.budget = budget
+        self.data = OrderedDict()
+        self.nbytes = 0
+        self.alive = WVD()
+
+    def set_budget(self, budget):
+        self.budget = budget
+        self.evict()
+
+    def get(self, key, loader):
+        if key in self.data:
+            gf, nbytes = self.data.pop(key)
+            self.data[key] = (gf, nbytes)
+            return gf
+        gf = self.alive.get(key, None)
+        if gf is None:
+            gf = loader()
+            self.alive[key] = gf
+        nbytes = gf.Size()*8
+        self.data[key] = (gf, nbytes)
+        self.nbytes = self.nbytes + nbytes
+        self.evict()
+        return gf
+
+    def evict(self):
+        while self.nbytes > self.budget and len(self.data) > 1:
+            key, (gf, nbytes) = self.data.popitem(last=False)
+            self.nbytes = self.nbytes - nbytes
+
+    def clear(self):
+        self.data = OrderedDict()
+        self.nbytes = 0
+
+gf_cache = GridFunctionLRU(int(os.getenv('PetraM_GF_CACHE_MB', '2048'))*1024*1024)
+
+def set_gf_cache_budget(mbytes):
+    gf_cache.set_budget(int(mbytes*1024*1024))
+
+class LazyGridFunction(object):
+    '''
+    proxy of mfem.GridFunction. it is read from file when it is used
+    first and kept in gf_cache. attribute access is forwarded to
+    GridFunction.
+
+    resolve() (helper.variables.resolve_gf) checks the file timestamp
+    and returns GridFunction. caller should keep it during evaluation.
+    attribute access reuses the last resolved GridFunction as long as
+    it is alive.
+
+    when SWIG's "this" is requested (the proxy is passed to mfem), 
+    GridFunction is pinned to the proxy, so that it is not freed
+    after it is pushed out from gf_cache.
+    '''
+    def __init__(self, meshes, emesh_idx, path):
+        self._meshes = meshes
+        self._emesh_idx = emesh_idx
+        # StoreRef (parametric store) is kept as it is
+        self._path = path if hasattr(path, 'load') else str(path)
+        self._last = None
+        self._pinned = None
+
+    def __repr__(self):
+        return "LazyGridFunction(" + self._path + ")"
+
+    def _load(self):
+        import mfem.ser as mfem
+        from petram.sol.binary_solfile import (is_binary_solfile,
+                                               read_gridfunction)
+        m = self._meshes[self._emesh_idx]
+        if hasattr(self._path, 'load'):
+            gf = self._path.load(m)
+        elif is_binary_solfile(self._path):
+            gf = read_gridfunction(m, self._path)
+        else:
+            gf = mfem.GridFunction(m, self._path)
+        gf._emesh_idx = self._emesh_idx
+        gf._mesh = m   # mesh should live longer than gf
+        return gf
+
+    def resolve(self):
+        m = self._meshes[self._emesh_idx]
+        key = (getattr(self._path, 'cache_key', self._path),
+               os.path.getmtime(self._path), id(m))
+        gf = gf_cache.get(key, self._load)
+        self._last = weakref(gf)
+        return gf
+
+    def _current(self):
+        if self._pinned is not None:
+            return self._pinned
+        gf = self._last() if self._last is not None else None
+        if gf is None:
+            gf = self.resolve()
+        return gf
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        gf = self._current()
+        if name in ('this', 'thisown'):
+            self._pinned = gf
+        return getattr(gf, name)
         
 class Solsets(object):
     '''
     Solsets: bundle of GridFunctions
 
       methes: names, meshes, gfr, gfi
+
+      meshes and GridFunctions are read when they are accessed
+      first. (GridFunction is given as LazyGridFunction)
     '''
     def __init__(self, solfiles, refine=0):
         def fname2idx(t):
+           if hasattr(t, 'emesh_idx'): return t.emesh_idx
            i = int(os.path.basename(t).split('.')[0].split('_')[-1])
            return i
         solfiles = solfiles.set
         object.__init__(self)
         self.set = []
-        import mfem.ser as mfem
 
-        fix_orientation=False
-        
-        for meshes, solf, in solfiles:
-            idx = [fname2idx(x) for x in meshes]
-            meshes = {i:  mfem.Mesh(str(x), 1, refine, fix_orientation) for i, x in zip(idx, meshes)}
-            meshes=MeshDict(meshes) # to make dict weakref-able
+        for mfiles, solf, in solfiles:
+            idx = [fname2idx(x) for x in mfiles]
+            meshes=MeshDict() # to make dict weakref-able
             ### what is this refine = 0 !?
-            for i in idx:
-                #meshes[i].ReorientTetMesh()
-                meshes[i]._emesh_idx = i
+            for i, x in zip(idx, mfiles):
+                meshes.set_loader(i, partial(load_mesh, x, i, refine))
             s = {}
             for key in six.iterkeys(solf):
                fr, fi =  solf[key]
                i = fname2idx(fr)
-               m = meshes[i]
 
-               solr = (mfem.GridFunction(m, str(fr)) if fr is not None else None)
-               soli = (mfem.GridFunction(m, str(fi)) if fi is not None else None)
-               if solr is not None: solr._emesh_idx = i
-               if soli is not None: soli._emesh_idx = i
+               solr = (LazyGridFunction(meshes, i, fr) if fr is not None else None)
+               soli = (LazyGridFunction(meshes, i, fi) if fi is not None else None)
 
                s[key] = (solr, soli)
             self.set.append((meshes, s))
@@ -109,6 +274,14 @@ class Solsets(object):
 def find_solfiles(path, idx = None):
     import os
 
+    # parametric store : idx selects case
+    from petram.sol.parametric_store import is_store, ParametricStore
+    if is_store(path):
+        store = ParametricStore(path)
+        ret = Solfiles(store.solfiles(0 if idx is None else idx))
+        ret.store_timestamps()
+        return ret
+
     files = os.listdir(path)
     mfiles = [x for x in files if x.startswith('solmesh')]
     if len(mfiles) == 0:
@@ -116,6 +289,13 @@ def find_solfiles(path, idx = None):
     solrfile = [x for x in files if x.startswith('solr')]
     solifile = [x for x in files if x.startswith('soli')]
 
+    # if binary files are written, index lists files of the last save
+    from petram.sol.binary_solfile import read_index
+    index = read_index(path)
+    if index is not None:
+        solrfile = [x for x in solrfile if x in index['files']]
+        solifile = [x for x in solifile if x in index['files']]
+
     if len(mfiles) == 0:
         '''
         mesh file may exist one above...shared among parametric
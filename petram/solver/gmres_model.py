@@ -3,6 +3,7 @@ import numpy as np
 
 import petram.debug as debug
 dprint1, dprint2, dprint3 = debug.init_dprints('GMRESModel')
+from petram.helper.stage_trace import trace_stage
 
 from petram.mfem_config import use_parallel
 if use_parallel:
@@ -22,6 +23,8 @@ else:
    default_kind = 'scipy'
 
 from petram.solver.mumps_model import MUMPSPreconditioner   
+from petram.helper.partial_assembly import PAOperator
+from petram.helper.block_matrix import DistributedSol
 SparseSmootherCls = {"Jacobi": (mfem.DSmoother, 0),
                      "l1Jacobi": (mfem.DSmoother, 1),
                      "lumpedJacobi": (mfem.DSmoother, 2),
@@ -45,7 +48,10 @@ class GMRES(LinearSolverModel):
                 ["abs. tol.",   self.abstol,  300, {}],
                 ["restart(kdim)", self.kdim,     400, {}],
                 [None, None, 99, {"UI":WidgetSmoother, "span":(1,2)}],
-                ["write matrix",  self.write_mat,   3, {"text":""}],]     
+                ["write matrix",  self.write_mat,   3, {"text":""}],
+                [None, self.use_partial_assembly,  3,
+                 {"text":"partial assembly (matrix-free, real only)"}],
+                ["prc. reuse", self.prc_reuse, 0, {}],]     
     
     def get_panel1_value(self):
         # this will set _mat_weight
@@ -71,7 +77,8 @@ class GMRES(LinearSolverModel):
         
         return (int(self.log_level), int(self.maxiter),
                 self.reltol, self.abstol, int(self.kdim),
-                self.preconditioners, self.write_mat)
+                self.preconditioners, self.write_mat,
+                self.use_partial_assembly, self.prc_reuse)
     
     def import_panel1_value(self, v):
         self.log_level = int(v[0])
@@ -81,6 +88,8 @@ class GMRES(LinearSolverModel):
         self.kdim = int(v[4])
         self.preconditioners = v[5]
         self.write_mat = int(v[6])
+        self.use_partial_assembly = bool(v[7])
+        self.prc_reuse = str(v[8])
         
     def attribute_set(self, v):
         v = super(GMRES, self).attribute_set(v)
@@ -93,9 +102,14 @@ class GMRES(LinearSolverModel):
         v['preconditioner'] = ''
         v['preconditioners'] = []        
         v['write_mat'] = False        
+        v['use_partial_assembly'] = False
+        v['prc_reuse'] = 'none'
         return v
     
     def verify_setting(self):
+        if (self.use_partial_assembly and
+            any([phys.is_complex() for phys in self.get_phys()])):
+            return False, "Partial assembly is only for real value problem.", "Turn off partial assembly for a complex problem"
         if not self.parent.assemble_real:
             for phys in self.get_phys():
                 if phys.is_complex():
@@ -109,6 +123,8 @@ class GMRES(LinearSolverModel):
 
 
     def real_to_complex(self, solall, M):
+        if isinstance(solall, DistributedSol):
+            return solall.to_complex()
         if use_parallel:
            from mpi4py import MPI
            myid     = MPI.COMM_WORLD.rank
@@ -163,12 +179,16 @@ class GMRESSolver(LinearSolver):
         self.abstol = abstol
         self.reltol = reltol
         self.kdim = kdim
+        from petram.helper.preconditioners import PrcCache
+        self.prc_cache = PrcCache(getattr(gui, 'prc_reuse', 'none'))
         LinearSolver.__init__(self, gui, engine)
 
+    @trace_stage('SetOperator')
     def SetOperator(self, opr, dist=False, name = None):
         self.Aname = name
         self.A = opr                     
                              
+    @trace_stage('Mult')
     def Mult(self, b, x=None, case_base=0):
         if use_parallel:
             return self.solve_parallel(self.A, b, x)
@@ -179,7 +199,6 @@ class GMRESSolver(LinearSolver):
         from mpi4py import MPI
         myid     = MPI.COMM_WORLD.rank
         nproc    = MPI.COMM_WORLD.size
-        from petram.helper.mpi_recipes import gather_vector
         
         def get_block(Op, i, j):
             try:
@@ -208,6 +227,8 @@ class GMRESSolver(LinearSolver):
               
 
         M = mfem.BlockDiagonalPreconditioner(offset)
+        self.prc_cache.set_operator(A)
+        of = offset.ToList()
         
         prcs = dict(self.gui.preconditioners)
         name = self.Aname
@@ -223,43 +244,50 @@ class GMRESSolver(LinearSolver):
            A0 = get_block(A, k, k)
            if A0 is None and not name.startswith('schur'): continue
 
-           if hasattr(mfem.HypreSmoother, prc):
-               invA0 = mfem.HypreSmoother(A0)
-               invA0.SetType(getattr(mfem.HypreSmoother, prc))
-           elif prc == 'ams':
-               depvar = self.engine.r_dep_vars[k]
-               dprint1("setting up AMS for ", depvar)
-               prec_fespace = self.engine.fespaces[depvar]
-               invA0 = mfem.HypreAMS(A0, prec_fespace)
-               invA0.SetSingularProblem()
-           elif name == 'MUMPS':
-               cls = SparseSmootherCls[name][0]
-               invA0 = cls(A0, gui=self.gui[prc], engine=self.engine)
-           elif name.startswith('schur'):
-               args = name.split("(")[-1].split(")")[0].split(",")
-               dprint1("setting up schur for ", args)
-               if len(args) > 1:
-                   assert False, "not yet supported"
-               for arg in args:
-                    r1 = self.engine.dep_var_offset(arg.strip())
-                    c1 = self.engine.r_dep_var_offset(arg.strip())                    
-                    B  = get_block(A, k, c1)
-                    Bt = get_block(A, r1, k).Transpose()
-                    Bt = Bt.Transpose()
-                    B0 = get_block(A, r1, c1)
-                    Md = mfem.HypreParVector(MPI.COMM_WORLD,
-                                             B0.GetGlobalNumRows(),
-                                             B0.GetColStarts())
-                    B0.GetDiag(Md)
-                    Bt.InvScaleRows(Md)
-                    S = mfem.ParMult(B, Bt)
-                    invA0 = mfem.HypreBoomerAMG(S)
-                    invA0.iterative_mode = False
-           else:
-               cls = SparseSmootherCls[name][0]
-               invA0 = cls(A0, gui=self.gui[prc])
+           def build(k=k, prc=prc, name=name, A0=A0):
+               if isinstance(A0, PAOperator):
+                   # matrix-free block. only diagonal is available
+                   dprint1(prc + " is replaced by diagonal scaling (partial assembly)")
+                   invA0 = A0.diagonal_inverse()
+               elif hasattr(mfem.HypreSmoother, prc):
+                   invA0 = mfem.HypreSmoother(A0)
+                   invA0.SetType(getattr(mfem.HypreSmoother, prc))
+               elif prc == 'ams':
+                   depvar = self.engine.r_dep_vars[k]
+                   dprint1("setting up AMS for ", depvar)
+                   prec_fespace = self.engine.fespaces[depvar]
+                   invA0 = mfem.HypreAMS(A0, prec_fespace)
+                   invA0.SetSingularProblem()
+               elif name == 'MUMPS':
+                   cls = SparseSmootherCls[name][0]
+                   invA0 = cls(A0, gui=self.gui[prc], engine=self.engine)
+               elif name.startswith('schur'):
+                   args = name.split("(")[-1].split(")")[0].split(",")
+                   dprint1("setting up schur for ", args)
+                   if len(args) > 1:
+                       assert False, "not yet supported"
+                   for arg in args:
+                        r1 = self.engine.dep_var_offset(arg.strip())
+                        c1 = self.engine.r_dep_var_offset(arg.strip())                    
+                        B  = get_block(A, k, c1)
+                        Bt = get_block(A, r1, k).Transpose()
+                        Bt = Bt.Transpose()
+                        B0 = get_block(A, r1, c1)
+                        Md = mfem.HypreParVector(MPI.COMM_WORLD,
+                                                 B0.GetGlobalNumRows(),
+                                                 B0.GetColStarts())
+                        B0.GetDiag(Md)
+                        Bt.InvScaleRows(Md)
+                        S = mfem.ParMult(B, Bt)
+                        invA0 = mfem.HypreBoomerAMG(S)
+                        invA0.iterative_mode = False
+               else:
+                   cls = SparseSmootherCls[name][0]
+                   invA0 = cls(A0, gui=self.gui[prc])
                
-           invA0.iterative_mode = False
+               invA0.iterative_mode = False
+               return invA0
+           invA0 = self.prc_cache.get(n, prc, of[k+1]-of[k], build, k=k)
            M.SetDiagonalBlock(k, invA0)
            
         '''
@@ -318,21 +346,11 @@ class GMRESSolver(LinearSolver):
               #   dprint1(x.GetBlock(j).GetDataArray())
               #assert False, "must implement this"
            solver.Mult(bb, xx)
-           s = []
-           for i in range(offset.Size()-1):
-               v = xx.GetBlock(i).GetDataArray()
-               vv = gather_vector(v)
-               if myid == 0:
-                   s.append(vv)
-               else:
-                   pass
-           if myid == 0:               
-               sol.append(np.hstack(s))
-        if myid == 0:                              
-            sol = np.transpose(np.vstack(sol))
-            return sol
-        else:
-            return None
+           self.prc_cache.record_iterations(solver.GetNumIterations())
+           # solution is kept distributed
+           sol.append([xx.GetBlock(i).GetDataArray().copy()
+                       for i in range(offset.Size()-1)])
+        return DistributedSol(sol)
         
     def solve_serial(self, A, b, x=None):
 
@@ -357,6 +375,8 @@ class GMRESSolver(LinearSolver):
                  v.Print('rhs_'+str(i)+'_'+str(j))
 
         M = mfem.BlockDiagonalPreconditioner(offset)
+        self.prc_cache.set_operator(A)
+        of = offset.ToList()
 
         prcs = dict(self.gui.preconditioners)
         name = self.Aname
@@ -377,13 +397,20 @@ class GMRESSolver(LinearSolver):
            if prc == "None": continue
            name = "".join([tmp for tmp in prc if not tmp.isdigit()])
            A0 = get_block(A, k, k)
-           cls = SparseSmootherCls[name][0]
-           arg = SparseSmootherCls[name][1]
-           if name == 'MUMPS':
-               invA0 = cls(A0, gui=self.gui[prc], engine=self.engine)
-           else:
-               invA0 = cls(A0, arg)
-           invA0.iterative_mode = False
+           def build(k=k, prc=prc, name=name, A0=A0):
+               cls = SparseSmootherCls[name][0]
+               arg = SparseSmootherCls[name][1]
+               if isinstance(A0, PAOperator):
+                   # matrix-free block. only diagonal is available
+                   dprint1(prc + " is replaced by diagonal scaling (partial assembly)")
+                   invA0 = A0.diagonal_inverse()
+               elif name == 'MUMPS':
+                   invA0 = cls(A0, gui=self.gui[prc], engine=self.engine)
+               else:
+                   invA0 = cls(A0, arg)
+               invA0.iterative_mode = False
+               return invA0
+           invA0 = self.prc_cache.get(n, prc, of[k+1]-of[k], build, k=k)
            M.SetDiagonalBlock(k, invA0)
 
         '''
@@ -439,6 +466,7 @@ class GMRESSolver(LinearSolver):
               #   print x.GetBlock(j).GetDataArray()                 
               #assert False, "must implement this"
            solver.Mult(bb, xx)
+           self.prc_cache.record_iterations(solver.GetNumIterations())
            sol.append(xx.GetDataArray().copy())
         sol = np.transpose(np.vstack(sol))
         return sol
@@ -6,6 +6,7 @@ from .solver_model import LinearSolverModel, LinearSolver
 
 import petram.debug as debug
 dprint1, dprint2, dprint3 = debug.init_dprints('IterativeSolverModel')
+from petram.helper.stage_trace import trace_stage
 
 from petram.mfem_config import use_parallel
 if use_parallel:
@@ -25,6 +26,7 @@ else:
    default_kind = 'scipy'
 
 from petram.solver.mumps_model import MUMPSPreconditioner   
+from petram.helper.block_matrix import DistributedSol
 SparseSmootherCls = {"Jacobi": (mfem.DSmoother, 0),
                      "l1Jacobi": (mfem.DSmoother, 1),
                      "lumpedJacobi": (mfem.DSmoother, 2),
@@ -67,7 +69,11 @@ class Iterative(LinearSolverModel, NS_mixin):
                 [None, self.assert_no_convergence,  3, {"text":"check converegence"}],
                 [None, self.use_ls_reducer,  3, {"text":"Reduce linear system when possible"}],
                 [None, (self.merge_real_imag,(self.use_block_symmetric,)),
-                 27, ({"text":"Use ComplexOperator"}, {"elp":mm},)],]          
+                 27, ({"text":"Use ComplexOperator"}, {"elp":mm},)],
+                [None, self.use_partial_assembly,  3,
+                 {"text":"partial assembly (matrix-free, real only)"}],
+                ["recycle guess(#vec)", self.recycle_nvec, 400, {}],
+                ["prc. reuse", self.prc_reuse, 0, {}],]          
      
     
     def get_panel1_value(self):
@@ -97,7 +103,9 @@ class Iterative(LinearSolverModel, NS_mixin):
                 [self.adv_mode, [self.adv_prc, ], [self.preconditioners,]],
                 self.write_mat, self.assert_no_convergence,
                 self.use_ls_reducer,
-                (self.merge_real_imag, (self.use_block_symmetric,)), )
+                (self.merge_real_imag, (self.use_block_symmetric,)),
+                self.use_partial_assembly, int(self.recycle_nvec),
+                self.prc_reuse, )
     
     def import_panel1_value(self, v):
         self.solver_type = str(v[0])
@@ -114,6 +122,9 @@ class Iterative(LinearSolverModel, NS_mixin):
         self.adv_prc = v[6][1][0]
         self.merge_real_imag = bool(v[10][0])
         self.use_block_symmetric = bool(v[10][1][0])                                
+        self.use_partial_assembly = bool(v[11])
+        self.recycle_nvec = int(v[12])
+        self.prc_reuse = str(v[13])
         
     def attribute_set(self, v):
         v = super(Iterative, self).attribute_set(v)
@@ -133,9 +144,14 @@ class Iterative(LinearSolverModel, NS_mixin):
         v['adv_prc'] = ''
         v['merge_real_imag'] = False
         v['use_block_symmetric'] = False
+        v['use_partial_assembly'] = False
+        v['recycle_nvec'] = 0
+        v['prc_reuse'] = 'none'
         return v
     
     def verify_setting(self):
+        if self.use_partial_assembly and self.use_ls_reducer:
+            return False, "Partial assembly does not support reducer.", "Linear system reducer needs assembled matrix"
         if not self.parent.assemble_real:
             for phys in self.get_phys():
                 if phys.is_complex() and not self.merge_real_imag:
@@ -143,6 +159,8 @@ class Iterative(LinearSolverModel, NS_mixin):
         return True, "", ""
 
     def linear_system_type(self, assemble_real, phys_real):
+        if self.use_partial_assembly and not phys_real:
+            assert False, "partial assembly is only for real value problem"
         if phys_real:
             if assemble_real:
                 dprint1("Use assemble-real is only for complex value problem !!!!")
@@ -164,6 +182,8 @@ class Iterative(LinearSolverModel, NS_mixin):
         #return None
 
     def real_to_complex(self, solall, M):
+        if isinstance(solall, DistributedSol):
+            return solall.to_complex(merged = self.merge_real_imag)
         if self.merge_real_imag:
             return self.real_to_complex_merged(solall, M)
         else:
@@ -244,6 +264,77 @@ class Iterative(LinearSolverModel, NS_mixin):
             pass
         return choice
      
+class GuessRecycler(object):
+    '''
+    initial guess from previously converged solutions (multi RHS)
+
+    keeps up to nvec pairs (x_i, q_i), where q_i = A x_i are
+    orthonormalized. initial guess for b is x0 = sum_i (q_i, b) x_i,
+    which minimizes |b - A x0| in the span of previous solutions.
+    vectors are local (true dof) data. inner products are summed
+    over ranks in parallel.
+    '''
+    def __init__(self, nvec):
+        self.nvec = nvec
+        self.xs = []
+        self.qs = []
+
+    def __len__(self):
+        return len(self.xs)
+
+    def reset(self):
+        self.xs = []
+        self.qs = []
+
+    def _dots(self, v):
+        h = np.array([np.dot(q, v) for q in self.qs])
+        if use_parallel:
+            h = MPI.COMM_WORLD.allreduce(h, op=MPI.SUM)
+        return h
+
+    def _norm(self, v):
+        n = np.dot(v, v)
+        if use_parallel:
+            n = MPI.COMM_WORLD.allreduce(n, op=MPI.SUM)
+        return np.sqrt(n)
+
+    def guess(self, b, x):
+        '''
+        b, x : mfem.Vector. returns False if no guess is made
+        '''
+        if len(self.xs) == 0: return False
+        c = self._dots(b.GetDataArray())
+        x0 = np.zeros(x.Size())
+        for ci, xi in zip(c, self.xs):
+            x0 += ci*xi
+        x.Assign(x0)
+        return True
+
+    def add(self, x, ax):
+        '''
+        x : solution, ax : A*x (numpy array, modified in place)
+        '''
+        if self.nvec <= 0: return
+        x = x.copy()
+        nrm0 = self._norm(ax)
+        if nrm0 == 0.0: return
+        # classical Gram-Schmidt applied twice
+        for k in range(2):
+            if len(self.qs) == 0: break
+            h = self._dots(ax)
+            for hi, qi, xi in zip(h, self.qs, self.xs):
+                ax -= hi*qi
+                x -= hi*xi
+        nrm = self._norm(ax)
+        if nrm < 1e-10*nrm0:
+            dprint2("solution is in the span of recycled vectors")
+            return
+        if len(self.xs) == self.nvec:
+            # q_i stay orthonormal after dropping the oldest one
+            self.xs = self.xs[1:]
+            self.qs = self.qs[1:]
+        self.xs.append(x/nrm)
+        self.qs.append(ax/nrm)
 
 class IterativeSolver(LinearSolver):
     is_iterative = True
@@ -252,11 +343,16 @@ class IterativeSolver(LinearSolver):
         self.abstol = abstol
         self.reltol = reltol
         self.kdim = kdim
+        self.recycler = GuessRecycler(int(getattr(gui, 'recycle_nvec', 0)))
+        from petram.helper.preconditioners import PrcCache
+        self.prc_cache = PrcCache(getattr(gui, 'prc_reuse', 'none'))
         LinearSolver.__init__(self, gui, engine)
 
+    @trace_stage('SetOperator')
     def SetOperator(self, opr, dist=False, name = None):
         self.Aname = name
         self.A = opr
+        self.recycler.reset()
         
         from petram.solver.linearsystem_reducer import LinearSystemReducer
         if use_parallel:
@@ -280,6 +376,7 @@ class IterativeSolver(LinearSolver):
 
             self.reducer = None
                              
+    @trace_stage('Mult')
     def Mult(self, b, x=None, case_base=0):
         if use_parallel:
             return self.solve_parallel(self.A, b, x)
@@ -334,6 +431,8 @@ class IterativeSolver(LinearSolver):
             M = g()
             
             pc_block = {}
+            self.prc_cache.set_operator(A)
+            of = A.RowOffsets().ToList()
             
             for k, n in enumerate(name):
                 prctxt = prcs_gui[n][1] if parallel else prcs_gui[n][0]
@@ -344,7 +443,7 @@ class IterativeSolver(LinearSolver):
                 nn = prctxt.split("(")[0]
 
                 if not n in pc_block:
-                    # make a new one
+                    # make a new one (or take it from cache)
                     dprint1(nn)
                     try:
                         blkgen = getattr(prcs, nn)
@@ -354,8 +453,10 @@ class IterativeSolver(LinearSolver):
                         else:
                             raise
 
-                    blkgen.set_param(g, n)
-                    blk = eval("blkgen("+prcargs)
+                    def build(blkgen=blkgen, n=n, prcargs=prcargs):
+                        blkgen.set_param(g, n)
+                        return eval("blkgen("+prcargs)
+                    blk = self.prc_cache.get(n, prctxt, of[k+1]-of[k], build)
 
                     M.SetDiagonalBlock(k, blk)
                     pc_block[n] = blk
@@ -388,11 +489,28 @@ class IterativeSolver(LinearSolver):
               xx = x.GetBlock(j)
               xx.Print('x_'+str(i)+'_'+str(j)+suffix)
               
+    def recycle_guess(self, solver, bb, xx):
+        '''
+        set initial guess from previous solutions. preconditioner
+        and solver are shared by all RHS (made in SetOperator)
+        '''
+        if self.recycler.guess(bb, xx):
+            solver.iterative_mode = True
+        else:
+            solver.iterative_mode = False
+
+    def recycle_add(self, xx):
+        if self.recycler.nvec <= 0: return
+        ax = mfem.Vector(xx.Size())
+        self.A.Mult(xx, ax)
+        self.recycler.add(xx.GetDataArray(), ax.GetDataArray().copy())
+
     @flush_stdout        
     def call_mult(self, solver, bb, xx):
         solver.Mult(bb, xx)
         max_iter = solver.GetNumIterations();
         tol = solver.GetFinalNorm()
+        self.prc_cache.record_iterations(max_iter)
         
         dprint1("convergence check (max_iter, tol) ", max_iter, " ", tol)
         if self.gui.assert_no_convergence:
@@ -406,14 +524,10 @@ class IterativeSolver(LinearSolver):
             
         sol = []
 
-        # solve the problem and gather solution to head node...
-        # may not be the best approach
-        
-        from petram.helper.mpi_recipes import gather_vector        
+        # solution is kept distributed (DistributedSol.gather makes
+        # central matrix if needed)
         offset = A.RowOffsets()
         for bb in b:
-           rows = MPI.COMM_WORLD.allgather(np.int32(bb.Size()))
-           #rowstarts = np.hstack((0, np.cumsum(rows)))
            dprint1("row offset", offset.ToList())
            if x is None:           
               xx = mfem.BlockVector(offset)
@@ -428,29 +542,14 @@ class IterativeSolver(LinearSolver):
                    self.gui.set_solve_error((True, "No Convergence: " + self.gui.name()))
                    assert False, "No convergence"                   
            else:
+               if x is None and self.recycler.nvec > 0:
+                   self.recycle_guess(self.solver, bb, xx)
                self.call_mult(self.solver, bb, xx)
+               if x is None: self.recycle_add(xx)
 
-           s = []
-           for i in range(offset.Size()-1):
-               v = xx.GetBlock(i).GetDataArray()
-               if self.gui.merge_real_imag:
-                   w = int(len(v)//2)
-                   vv1 = gather_vector(v[:w])
-                   vv2 = gather_vector(v[w:])                   
-                   vv = np.hstack((vv1, vv2))
-               else:
-                   vv = gather_vector(v)
-               if myid == 0:
-                   s.append(vv)
-               else:
-                   pass
-           if myid == 0:               
-               sol.append(np.hstack(s))
-        if myid == 0:                              
-            sol = np.transpose(np.vstack(sol))
-            return sol
-        else:
-            return None
+           sol.append([xx.GetBlock(i).GetDataArray().copy()
+                       for i in range(offset.Size()-1)])
+        return DistributedSol(sol, merged = self.gui.merge_real_imag)
         
     def solve_serial(self, A, b, x=None):
         if self.gui.write_mat:                      
@@ -471,7 +570,10 @@ class IterativeSolver(LinearSolver):
               #   print x.GetBlock(j).Size()
               #   print x.GetBlock(j).GetDataArray()                 
               #assert False, "must implement this"
+           if x is None and self.recycler.nvec > 0:
+               self.recycle_guess(solver, bb, xx)
            self.call_mult(solver, bb, xx)              
+           if x is None: self.recycle_add(xx)
 
            sol.append(xx.GetDataArray().copy())
         sol = np.transpose(np.vstack(sol))
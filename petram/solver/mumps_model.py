@@ -4,6 +4,7 @@ import weakref
 
 import petram.debug as debug
 dprint1, dprint2, dprint3 = debug.init_dprints('MUMPSModel')
+from petram.helper.stage_trace import trace_stage
 
 from petram.helper.matrix_file import write_matrix, write_vector, write_coo_matrix
 
@@ -173,6 +174,9 @@ class MUMPSSolver(LinearSolver):
     def __init__(self, *args, **kwargs):
         super(MUMPSSolver, self).__init__(*args, **kwargs)
         self.silent = False
+        # (key of sparsity pattern, row, col, A.row, A.col) used in
+        # the last analysis
+        self._pattern = None
         
     def set_silent(self, silent):
         self.silent = silent
@@ -275,6 +279,37 @@ class MUMPSSolver(LinearSolver):
             else:
                 return B.astype(np.float64, copy=False)
         
+    def index_arrays(self, A, dtype_int):
+        '''
+        return MUMPS (1-based) row/col and a flag if the sparsity
+        pattern is the same as that of the last analysis (job1).
+        row/col are kept and reused while the pattern is unchanged.
+        '''
+        # read-only row/col given by AssemblyPlan are not modified.
+        # if the same arrays are given, pattern is the same.
+        if (self._pattern is not None and
+            self._pattern[3] is A.row and self._pattern[4] is A.col and
+            not A.row.flags.writeable and not A.col.flags.writeable):
+            return self._pattern[1], self._pattern[2], True
+        
+        import hashlib
+        h = hashlib.sha1()
+        for x in (A.row, A.col):
+            x = np.ascontiguousarray(x)
+            h.update(str((x.dtype.str, x.shape)).encode())
+            h.update(x.view(np.uint8))
+        key = (dtype_int, A.shape, h.hexdigest())
+
+        if self._pattern is not None and self._pattern[0] == key:
+            self._pattern = self._pattern[:3] + (A.row, A.col)
+            return self._pattern[1], self._pattern[2], True
+
+        row = A.row.astype(dtype_int) + 1
+        col = A.col.astype(dtype_int) + 1
+        self._pattern = (key, row, col, A.row, A.col)
+        return row, col, False
+        
+    @trace_stage('SetOperator')
     def SetOperator(self, A, dist, name=None):
         try:
             from mpi4py import MPI
@@ -283,6 +318,8 @@ class MUMPSSolver(LinearSolver):
         myid     = MPI.COMM_WORLD.rank
         nproc    = MPI.COMM_WORLD.size
 
+        same_pattern = False
+
         from petram.ext.mumps.mumps_solve import i_array
         gui = self.gui
         s = self.s
@@ -308,19 +345,18 @@ class MUMPSSolver(LinearSolver):
                 dprint1("NNZ all: ", nnz_array, np.sum(nnz_array))            
                 s.set_n(A.shape[1])
             dtype_int = 'int'+str(mumps_solve.SIZEOF_MUMPS_INT()*8)
-            row = A.row
-            col = A.col
-            row = row.astype(dtype_int) + 1
-            col = col.astype(dtype_int) + 1
+            row, col, same_pattern = self.index_arrays(A, dtype_int)
+            same_pattern = MPI.COMM_WORLD.allreduce(same_pattern, op=MPI.LAND)
             AA = self.make_matrix_entries(A)
 
             if len(col) > 0:
                 dprint1('index data size ' , type(col[0]))
                 dprint1('matrix data type ' , type(AA[0]))
 
-            s.set_nz_loc(len(A.data))
-            s.set_irn_loc(i_array(row))
-            s.set_jcn_loc(i_array(col))
+            if not same_pattern:
+                s.set_nz_loc(len(A.data))
+                s.set_irn_loc(i_array(row))
+                s.set_jcn_loc(i_array(col))
             s.set_a_loc(self.data_array(AA))
 
 
@@ -340,22 +376,22 @@ class MUMPSSolver(LinearSolver):
                 write_coo_matrix('matrix', A.tocsr().tocoo())
             # No outputs
             if myid ==0:
-                row = A.row
-                col = A.col
-                row = row.astype(dtype_int) + 1
-                col = col.astype(dtype_int) + 1
+                row, col, same_pattern = self.index_arrays(A, dtype_int)
                 AA = self.make_matrix_entries(A)                        
                 
                 if len(col) > 0:
                     dprint1('index data size ' , type(col[0]))
                     dprint1('matrix data type ' , type(AA[0]))
 
-                s.set_n(A.shape[0])
-                s.set_nz(len(A.data))
-                s.set_irn(i_array(row))
-                s.set_jcn(i_array(col))
+                if not same_pattern:
+                    s.set_n(A.shape[0])
+                    s.set_nz(len(A.data))
+                    s.set_irn(i_array(row))
+                    s.set_jcn(i_array(col))
                 s.set_a(self.data_array(AA))
                 self.dataset = (A.data, row, col)                
+            if nproc > 1:
+                same_pattern = MPI.COMM_WORLD.bcast(same_pattern, root=0)
 
         # blr
         if gui.use_blr:   
@@ -404,14 +440,18 @@ class MUMPSSolver(LinearSolver):
         self.set_ordering_flag(s)
 
 
-        MPI.COMM_WORLD.Barrier()
-        dprint1("job1")
-        s.set_job(1)
-        s.run()
-        info1 = s.get_info(1)
+        if same_pattern:
+            dprint1("job1 is skipped (sparsity pattern is not changed)")
+        else:
+            MPI.COMM_WORLD.Barrier()
+            dprint1("job1")
+            s.set_job(1)
+            s.run()
+            info1 = s.get_info(1)
 
-        if info1 != 0:
-            assert False, "MUMPS call (job1) faield. Check error log"
+            if info1 != 0:
+                self._pattern = None
+                assert False, "MUMPS call (job1) faield. Check error log"
 
         MPI.COMM_WORLD.Barrier()
         dprint1("job2")
@@ -423,6 +463,7 @@ class MUMPSSolver(LinearSolver):
             assert False, "MUMPS call (job2) faield. Check error log"
     
 
+    @trace_stage('Mult')
     def Mult(self, b, x=None, case_base=0):
         try:
             from mpi4py import MPI
@@ -503,6 +544,7 @@ class MUMPSPreconditioner(mfem.PyOperator):
         self.SetOperator(A0)
 
     def SetOperator(self, opr):
+        self._layout = None
         def isSparseMatrix(opr):
             return isinstance(opr, mfem.SparseMatrix)
         
@@ -581,8 +623,11 @@ class MUMPSPreconditioner(mfem.PyOperator):
         else:
             from mpi4py import MPI
             comm = MPI.COMM_WORLD
-            from petram.helper.mpi_recipes import gather_vector
-            xx = gather_vector(vec)
+            from petram.helper.mpi_recipes import gather_vector, get_layout
+            # distribution of x does not change. counts are exchanged once
+            if getattr(self, '_layout', None) is None:
+                self._layout = get_layout(vec.shape)
+            xx = gather_vector(vec, layout = self._layout)
             if myid == 0:
                 xx = np.atleast_2d(xx).transpose()
                 
@@ -1,6 +1,10 @@
 import os
+import time
+import json
 import traceback
+import threading
 import gc
+from six.moves import queue
 
 from petram.model import Model
 from petram.solver.solver_model import Solver, SolveStep
@@ -10,7 +14,60 @@ dprint1, dprint2, dprint3 = debug.init_dprints('Parametric')
 format_memory_usage = debug.format_memory_usage
 
 assembly_methods = {'Full assemble': 0,
-                    'Reuse matrix' : 1}
+                    'Reuse matrix' : 1,
+                    'Update dependent' : 2}
+
+
+def accepts_update(solver):
+    '''
+    True if solver.run takes update keyword (reuse of assembled forms)
+    '''
+    return getattr(solver, 'supports_update', False)
+
+class SolWriter(object):
+    '''
+    write solution files in background thread
+
+    jobs (function and arguments) are run in the order submitted.
+    submit blocks when maxsize jobs are waiting, so that memory
+    used by solution copies is bounded.
+    '''
+    def __init__(self, maxsize=0):
+        self.queue = queue.Queue(maxsize)
+        self.error = None
+        self.thread = threading.Thread(target = self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None: break
+            if self.error is not None: continue
+            try:
+                job[0](*job[1])
+            except:
+                self.error = traceback.format_exc()
+
+    def check(self):
+        if self.error is not None:
+            assert False, "writing solution failed \n" + self.error
+
+    def submit(self, func, *args):
+        self.check()
+        self.queue.put((func, args))
+
+    def close(self, check=True):
+        '''
+        wait for all jobs. check=False is used when an exception is
+        propagating, so that it is not replaced by the writer error.
+        '''
+        self.queue.put(None)
+        self.thread.join()
+        if check:
+            self.check()
+        elif self.error is not None:
+            dprint1("writing solution failed \n" + self.error)
 
 class Parametric(SolveStep, NS_mixin):
     '''
@@ -39,6 +96,9 @@ class Parametric(SolveStep, NS_mixin):
                 ["clear working dir.", False, 3, {"text":""}],
                 [None,  self.use_geom_gen,  3, {"text":"run geometry generator"}],
                 [None,  self.use_mesh_gen,  3, {"text":"run mesh generator"}],
+                ["case workers",  self.case_workers,  400, {}],
+                [None,  self.use_store,  3, {"text":"save results in parametric store"}],
+                ["RHS batch size (0: all)",  self.rhs_batch,  400, {}],
                 ]
     
     def get_panel1_value(self):
@@ -54,18 +114,24 @@ class Parametric(SolveStep, NS_mixin):
                 self.get_inner_solver_names(),
                 self.clear_wdir, 
                 self.use_geom_gen,
-                self.use_mesh_gen,)
+                self.use_mesh_gen,
+                self.case_workers,
+                self.use_store,
+                self.rhs_batch,)
 
 
     def import_panel1_value(self, v):
         self.init_setting = str(v[0])                        
         self.phys_model = str(v[1])
-        self.assembly_method = assembly_methods[v[-7]]
-        self.scanner = v[-6]
-        self.save_separate_mesh = v[-5]
-        self.clear_wdir = v[-3]
-        self.use_geom_gen = v[-2]        
-        self.use_mesh_gen = v[-1]
+        self.assembly_method = assembly_methods[v[-10]]
+        self.scanner = v[-9]
+        self.save_separate_mesh = v[-8]
+        self.clear_wdir = v[-6]
+        self.use_geom_gen = v[-5]        
+        self.use_mesh_gen = v[-4]
+        self.case_workers = max(int(v[-3]), 1)
+        self.use_store = bool(v[-2])
+        self.rhs_batch = max(int(v[-1]), 0)
         if self.use_geom_gen:
             self.use_mesh_gen = True
         if self.use_mesh_gen: self.assembly_method = 0
@@ -84,6 +150,9 @@ class Parametric(SolveStep, NS_mixin):
         v['scanner'] = 'Scan("a", [1,2,3])'
         v['save_separate_mesh'] = False
         v['clear_wdir'] = True                      
+        v['case_workers'] = 1       # number of processes (full assembly)
+        v['use_store'] = False      # mesh/solutions in parametric_store
+        v['rhs_batch'] = 0          # number of RHS solved at once (0: all)
 
         return v
     
@@ -124,18 +193,26 @@ class Parametric(SolveStep, NS_mixin):
         for n in files:
              engine.symlink(os.path.join('../',n), n)
         self.case_dirs.append(path)
+        if self._store is not None:
+            engine.sol_store = (self._store, ksol)
         return od
 
-    def _run_full_assembly(self, engine, solvers, scanner, is_first=True):
+    def _run_case(self, engine, solvers, kcase, is_first_case,
+                  catch_error=False):
+        '''
+        run one case in case directory. returns status
+        (status is also written in case_status.json)
+        '''
+        status = {'case': kcase, 'status': 'done', 'error': '',
+                  'pid': os.getpid()}
+        t0 = time.time()
+        is_first = True
         
-        for kcase, case in enumerate(scanner):
-            is_first = True
-            
-            od = self.go_case_dir(engine, kcase, True)
-            
+        od = self.go_case_dir(engine, kcase, True)
+        try:
             is_new_mesh = self.check_and_run_geom_mesh_gens(engine)
 
-            if is_new_mesh or kcase == 0:
+            if is_new_mesh or is_first_case:
                engine.preprocess_modeldata()
             
             self.prepare_form_sol_variables(engine)
@@ -149,21 +226,194 @@ class Parametric(SolveStep, NS_mixin):
                 if self.solve_error[0]:
                     dprint1("Parametric failed " + self.name() + ":"  +
                             self.solve_error[1])
+                    status['status'] = 'failed'
+                    status['error'] = str(self.solve_error[1])
+        except:
+            status['status'] = 'failed'
+            status['error'] = traceback.format_exc()
+            if not catch_error: raise
+        finally:
+            status['time'] = time.time() - t0
+            with open('case_status.json', 'w') as fid:
+                json.dump(status, fid)
             os.chdir(od)
+        return status
+            
+    def _run_full_assembly(self, engine, solvers, scanner, is_first=True):
+        
+        from petram.mfem_config import use_parallel
+        if self.case_workers > 1 and use_parallel:
+            dprint1("case workers is not used in parallel run (running cases sequentially)")
+        if self.case_workers > 1 and not use_parallel:
+            return self._run_full_assembly_mp(engine, solvers, scanner)
+
+        for kcase, case in enumerate(scanner):
+            self._run_case(engine, solvers, kcase, kcase == 0)
+        self.write_case_manifest(scanner, 1)
+
+    def _run_full_assembly_mp(self, engine, solvers, scanner):
+        '''
+        run cases using case_workers processes. each worker is forked
+        from this process (sharing model data) and takes cases in
+        round-robin manner.
+        '''
+        import multiprocessing as mp
+        if hasattr(mp, 'get_context'):
+            mp = mp.get_context('fork')
+
+        l_scan = len(scanner)
+        nworkers = min(self.case_workers, l_scan)
+
+        def worker(wid):
+            is_first_case = True
+            for kcase in range(wid, l_scan, nworkers):
+                scanner.set_case(kcase)
+                self._run_case(engine, solvers, kcase, is_first_case,
+                               catch_error=True)
+                is_first_case = False
+
+        od = os.getcwd()
+        for kcase in range(l_scan):
+            self.case_dirs.append(os.path.join(od, 'case' + str(kcase)))
+        
+        dprint1("Parametric: running " + str(l_scan) + " cases using " +
+                str(nworkers) + " workers")
+        workers = [mp.Process(target = worker, args = (wid,))
+                   for wid in range(nworkers)]
+        for w in workers: w.start()
+        for w in workers: w.join()
+        
+        self.write_case_manifest(scanner, nworkers)
+
+    def read_case_status(self, path, kcase, default='not finished'):
+        fname = os.path.join(path, 'case_status.json')
+        if os.path.exists(fname):
+            with open(fname, 'r') as fid:
+                return json.load(fid)
+        if default == 'done':
+            return {'case': kcase, 'status': 'done', 'error': ''}
+        return {'case': kcase, 'status': default,
+                'error': 'no status is written', 'time': -1}
+
+    def make_store(self, engine, scanner):
+        '''
+        mesh and solutions of all cases are written in one
+        container (parametric_store) instead of case directories
+        '''
+        if self.use_mesh_gen:
+            dprint1("parametric store is not used (mesh is generated for each case)")
+            return None
+        from petram.sol.parametric_store import StoreWriter, STORE_DIR
+        path = os.path.join(os.getcwd(), STORE_DIR)
+        engine.mkdir(path)
+        return StoreWriter(path, len(scanner), scanner.names)
+
+    def write_store_manifest(self, scanner):
+        from petram.mfem_config import use_parallel
+        if use_parallel:
+            from mpi4py import MPI
+            MPI.COMM_WORLD.Barrier()
+            if MPI.COMM_WORLD.rank != 0: return
+
+        od = os.getcwd()
+        status = [self.read_case_status(os.path.join(od, 'case' + str(k)),
+                                        k, default='done')
+                  for k in range(len(scanner))]
+        self._store.write_manifest(scanner.list_data(), status)
+
+    def write_case_manifest(self, scanner, nworkers):
+        '''
+        collect case_status.json and write parametric_manifest.json
+        '''
+        from petram.mfem_config import use_parallel
+        if use_parallel:
+            from mpi4py import MPI
+            if MPI.COMM_WORLD.rank != 0: return
+
+        params = scanner.list_data()
+        cases = []
+        for kcase, param in enumerate(params):
+            path = os.path.join(os.getcwd(), 'case' + str(kcase))
+            status = self.read_case_status(path, kcase)
+            status['param'] = [str(x) for x in param]
+            status['dir'] = path
+            cases.append(status)
+            if status['status'] != 'done':
+                dprint1("Parametric case " + str(kcase) + " : " +
+                        status['status'] + "\n" + status['error'])
+
+        manifest = {'names': list(scanner.names),
+                    'workers': nworkers,
+                    'cases': cases}
+        with open('parametric_manifest.json', 'w') as fid:
+            json.dump(manifest, fid, indent=1)
                         
+    def _run_dependency_assembly(self, engine, solvers, scanner):
+        '''
+        the first case is fully assembled. for the following cases,
+        only models which depend on scanned parameters are updated
+        and other forms are reused.
+        '''
+        names = list(scanner.names)
+        
+        self.prepare_form_sol_variables(engine)
+        self.init(engine)
+
+        for kcase, case in enumerate(scanner):
+            od = self.go_case_dir(engine, kcase, True)
+            update = kcase > 0
+            if update:
+                engine.set_update_flag('Dependency', changed=names)
+                for phys in self.get_phys():
+                    for mm in phys.walk():
+                        if mm.enabled and mm.update_flag:
+                            mm.preprocess_params(engine)
+                
+            is_first = True
+            for ksolver, s in enumerate(solvers):
+                if update and accepts_update(s):
+                    is_first = s.run(engine, is_first=is_first, update=True)
+                else:
+                    if update:
+                        dprint1(s.name() + " does not support update. " +
+                                "full assembly is used")
+                    is_first = s.run(engine, is_first=is_first)
+                engine.add_FESvariable_to_NS(self.get_phys()) 
+                engine.store_x()
+                if self.solve_error[0]:
+                    dprint1("Parametric failed " + self.name() + ":"  +
+                            self.solve_error[1])
+            os.chdir(od)
+
     def _run_rhs_assembly(self, engine, solvers, scanner, is_first=True):
+        '''
+        matrix is assembled and factorized once. RHS is assembled
+        for each case and solved in batches of rhs_batch cases (0:
+        all cases at once). solution files are written by background
+        thread while the next batch is assembled and solved.
 
+        mesh is saved once in the working directory and case
+        directories have symbolic links to it, unless "save separate
+        mesh" is set (then each case directory has its own copy).
+        '''
         self.prepare_form_sol_variables(engine)
         self.init(engine)
         
         l_scan = len(scanner)
+        batch = l_scan if self.rhs_batch <= 0 else min(int(self.rhs_batch), l_scan)
+        dprint1("Parametric (RHS only): " + str(l_scan) + " cases, " +
+                "batch size = " + str(batch))
 
-        all_phys = self.get_phys()        
         phys_target = self.get_target_phys()
         
         linearsolver = None
-        for ksolver, s in enumerate(solvers):
+        engine.sol_writer = SolWriter(maxsize = 2*batch)
+        success = False
+        try:
+          for ksolver, s in enumerate(solvers):
             RHS_ALL=[]
+            kbase = 0
+            mesh_names = None
             instance = s.allocate_solver_instance(engine)
 
             phys_target = self.get_phys()
@@ -195,50 +445,79 @@ class Parametric(SolveStep, NS_mixin):
                     phys_real = not s.is_complex()                     
                     AA = engine.finalize_matrix(A, mask, not phys_real,
                                     format = ls_type)
-                    
-                RHS_ALL.append(RHS)
-
-                 
-                if kcase == l_scan-1:
-                    BB = engine.finalize_rhs(RHS_ALL, A ,X[0], mask,
-                                             not phys_real,
-                                             format = ls_type)
-
                     if linearsolver is None:
                         linearsolver = instance.allocate_linearsolver(s.is_complex(),
                                                                       engine)
                     linearsolver.SetOperator(AA,
                                  dist = engine.is_matrix_distributed,
                                  name = depvars)
-        
-                    XX = None
-                    solall = linearsolver.Mult(BB, x=XX, case_base=0)
-                    if not phys_real and s.assemble_real:
-                        oprt = linearsolver.oprt
-                        solall = instance.linearsolver_model.real_to_complex(solall,
-                                                                         oprt)
-
-                    for ksol in range(l_scan):
-                        instance.configure_probes('')                        
-                        if ksol == 0:
-                            instance.save_solution(mesh_only = True,
+                    if self._store is None:
+                        mesh_names = instance.save_solution(mesh_only = True,
                                                    save_parmesh = s.save_parmesh )
-                        A.reformat_central_mat(solall, ksol, X[0], mask)
-                        instance.sol = X[0]
-                        for p in instance.probe:
-                             p.append_sol(X[0])
-                        
-                        od = self.go_case_dir(engine,
-                                              ksol,
-                                              ksolver == 0)
-                        instance.save_solution(ksol = ksol,
-                                               skip_mesh = False, 
-                                               mesh_only = False,
-                                               save_parmesh=s.save_parmesh)
-                        engine.sol = instance.sol
-                        instance.save_probe()
-                        
-                        os.chdir(od)
+                        if (self.save_separate_mesh or
+                            not hasattr(os, 'symlink')):
+                            # mesh is saved in each case directory
+                            mesh_names = None
+                    
+                RHS_ALL.append(RHS)
+
+                if len(RHS_ALL) < batch and kcase != l_scan-1: continue
+
+                BB = engine.finalize_rhs(RHS_ALL, A ,X[0], mask,
+                                         not phys_real,
+                                         format = ls_type)
+                XX = None
+                solall = linearsolver.Mult(BB, x=XX, case_base=kbase)
+                if not phys_real and s.assemble_real:
+                    oprt = linearsolver.oprt
+                    solall = instance.linearsolver_model.real_to_complex(solall,
+                                                                     oprt)
+                self._save_rhs_batch(engine, instance, s, solall, kbase,
+                                     len(RHS_ALL), A, X, mask,
+                                     ksolver == 0, mesh_names)
+                kbase = kbase + len(RHS_ALL)
+                RHS_ALL = []
+          success = True
+        finally:
+            engine.sol_writer.close(check = success)
+            engine.sol_writer = None
+
+    def _save_rhs_batch(self, engine, instance, s, solall, kbase, nrhs,
+                        A, X, mask, mkdir, mesh_names):
+        '''
+        split solution of a batch into cases and save them. solution
+        is broadcasted once (unless it is kept distributed by the
+        solver) so that cases are extracted without communication.
+        if mesh_names is given, mesh in case directory is a link to
+        the mesh saved in the parent directory.
+        '''
+        from petram.mfem_config import use_parallel
+        from petram.helper.block_matrix import DistributedSol
+        if use_parallel and not isinstance(solall, DistributedSol):
+            from mpi4py import MPI
+            solall = MPI.COMM_WORLD.bcast(solall)
+
+        for k in range(nrhs):
+            ksol = kbase + k
+            A.reformat_central_mat(solall, k, X[0], mask, bcast=False)
+            instance.sol = X[0]
+            instance.configure_probes('')
+            for p in instance.probe:
+                 p.append_sol(X[0])
+
+            od = self.go_case_dir(engine, ksol, mkdir)
+            if mesh_names is not None:
+                for n in mesh_names:
+                    if not os.path.exists(n):
+                        os.symlink(os.path.join('..', n), n)
+            instance.save_solution(ksol = ksol,
+                                   skip_mesh = mesh_names is not None,
+                                   mesh_only = False,
+                                   save_parmesh=s.save_parmesh)
+            engine.sol = instance.sol
+            instance.save_probe()
+            
+            os.chdir(od)
                    
     def collect_probe_signals(self, dirs, scanner):
         from petram.sol.probe import list_probes, load_probe,  Probe
@@ -283,13 +562,26 @@ class Parametric(SolveStep, NS_mixin):
         scanner.set_phys_models(phys_models)
         
         self.case_dirs = []
-        if self.assembly_method == 0: 
-            self._run_full_assembly(engine, solvers, scanner, is_first=is_first)
-        else:
-            is_new_mesh = self.check_and_run_geom_mesh_gens(engine)
-            if is_first or is_new_mesh:        
-                engine.preprocess_modeldata()
-            self._run_rhs_assembly(engine, solvers, scanner, is_first=is_first)
+        self._store = self.make_store(engine, scanner) if self.use_store else None
+        try:
+            if self.assembly_method == 0: 
+                self._run_full_assembly(engine, solvers, scanner, is_first=is_first)
+            else:
+                is_new_mesh = self.check_and_run_geom_mesh_gens(engine)
+                if is_first or is_new_mesh:        
+                    engine.preprocess_modeldata()
+                if self.assembly_method == 2:
+                    self._run_dependency_assembly(engine, solvers, scanner)
+                else:
+                    self._run_rhs_assembly(engine, solvers, scanner, is_first=is_first)
+
+            if self._store is not None:
+                engine.sol_store = None
+                self.write_store_manifest(scanner)
+        finally:
+            # engine should not write to the store after this scan
+            engine.sol_store = None
+            self._store = None
 
         self.collect_probe_signals(self.case_dirs, scanner)
             
@@ -33,6 +33,14 @@ class DefaultParametricScanner(object):
 
     def list_data(self):
         return list(self._data)
+
+    def set_case(self, idx):
+        '''
+        apply parameter of idx-th case (used when cases are run
+        out of order)
+        '''
+        self.idx = idx
+        return self.__next__()
     
     def set_phys_models(self, targets):
         '''
@@ -14,6 +14,10 @@ dprint1, dprint2, dprint3 = debug.init_dprints('Solver')
 
 '''
 class SolverBase(Model):
+    # True if run takes update keyword (reassemble only models whose
+    # update_flag is set). used by Parametric ('Update dependent')
+    supports_update = False
+
     def onItemSelChanged(self, evt):
         '''
         GUI response when model object is selected in
@@ -294,6 +298,7 @@ class Solver(SolverBase):
         v['init_only'] = False   
         v['assemble_real'] = False
         v['save_parmesh'] = False        
+        v['save_binary'] = False
         v['phys_model']   = ''
         #v['init_setting']   = ''
         v['use_profiler'] = False
@@ -428,15 +433,21 @@ class SolverInstance(object):
         self.engine._matrix_blk_mask = self.blk_mask
         
     def save_solution(self, ksol = 0, skip_mesh = False, 
-                      mesh_only = False, save_parmesh=False):
-                      
+                      mesh_only = False, save_parmesh=False,
+                      use_store=True):
+        '''
+        use_store : False not to save in parametric store (engine.sol_store)
+        '''
         engine = self.engine
         phys_target = self.get_phys()
 
+        engine.sol_format = ('binary' if getattr(self.gui, 'save_binary', False)
+                             else 'ascii')
         if mesh_only:
-            engine.save_sol_to_file(phys_target,
-                                     mesh_only = True,
-                                     save_parmesh = save_parmesh)
+            return engine.save_sol_to_file(phys_target,
+                                           mesh_only = True,
+                                           save_parmesh = save_parmesh,
+                                           use_store = use_store)
         else:
             sol, sol_extra = engine.split_sol_array(self.sol)
             engine.recover_sol(sol)
@@ -446,7 +457,8 @@ class SolverInstance(object):
             engine.save_sol_to_file(phys_target, 
                                 skip_mesh = skip_mesh,
                                 mesh_only = False,
-                                save_parmesh = save_parmesh)
+                                save_parmesh = save_parmesh,
+                                use_store = use_store)
             engine.save_extra_to_file(extra_data)
         #engine.is_initialzied = False
         
@@ -463,6 +475,11 @@ class SolverInstance(object):
         
         self.linearsolver_model = solver
         self.phys_real = all([not p.is_complex() for p in phys_target])        
+        # forms are made matrix-free if linear solver asks for it
+        if getattr(solver, 'use_partial_assembly', False):
+            self.engine.assembly_level = 'partial'
+        else:
+            self.engine.assembly_level = 'full'
         self.ls_type = solver.linear_system_type(self.gui.assemble_real,
                                                  self.phys_real)
 
@@ -510,6 +527,7 @@ class TimeDependentSolverInstance(SolverInstance):
         self._icheckpoint = 0        
         self._time = 0.0
         self.child_instance = []
+        self.probe_flush = 0        
         SolverInstance.__init__(self, gui, engine)
 
     @property
@@ -546,6 +564,18 @@ class TimeDependentSolverInstance(SolverInstance):
     def set_checkpoint(self, checkpoint):
         self.checkpoint = checkpoint
 
+    def set_probe_flush(self, probe_flush):
+        '''
+        probe data is written when probe_flush steps are accumulated.
+        (0: only at checkpoint)
+        '''
+        self.probe_flush = probe_flush
+
+    def flush_probes(self):
+        if self.probe_flush <= 0: return
+        if any([p.pending() >= self.probe_flush for p in self.probe]):
+            self.save_probe()
+
     def add_child_instance(self, instance):
         self.child_instance.append(instance)
         
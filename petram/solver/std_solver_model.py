@@ -10,6 +10,7 @@ rprint = debug.regular_print('StdSolver')
 class StdSolver(Solver):
     can_delete = True
     has_2nd_panel = False
+    supports_update = True
 
     def attribute_set(self, v):
         super(StdSolver, self).attribute_set(v)
@@ -26,7 +27,9 @@ class StdSolver(Solver):
                 [None,
                  self.save_parmesh,  3, {"text":"save parallel mesh"}],
                 [None,
-                 self.use_profiler,  3, {"text":"use profiler"}],]
+                 self.use_profiler,  3, {"text":"use profiler"}],
+                [None,
+                 self.save_binary,  3, {"text":"save solution in binary"}],]
 
     def get_panel1_value(self):
         return (#self.init_setting,
@@ -35,7 +38,8 @@ class StdSolver(Solver):
                 self.clear_wdir,
                 self.assemble_real,
                 self.save_parmesh,
-                self.use_profiler,)
+                self.use_profiler,
+                self.save_binary,)
     
     def import_panel1_value(self, v):
         #self.init_setting = str(v[0])        
@@ -45,6 +49,7 @@ class StdSolver(Solver):
         self.assemble_real = v[3]
         self.save_parmesh = v[4]
         self.use_profiler = v[5]
+        self.save_binary = v[6]
 
     def get_editor_menus(self):
         return []
@@ -92,7 +97,12 @@ class StdSolver(Solver):
         
     
     @debug.use_profiler
-    def run(self, engine, is_first = True, return_instance=False):
+    def run(self, engine, is_first = True, return_instance=False,
+            update=False):
+        '''
+        update : reassemble only models whose update_flag is set
+                 (engine.set_update_flag must be called before)
+        '''
         dprint1("Entering run (is_first=", is_first, ")", self.fullpath())
         if self.clear_wdir:
             engine.remove_solfiles()
@@ -108,7 +118,7 @@ class StdSolver(Solver):
             instance.sol = engine.sol
         else:
             if is_first:
-                instance.assemble()            
+                instance.assemble(update=update)
                 is_first=False
             instance.solve()
 
@@ -149,7 +159,7 @@ class StandardSolver(SolverInstance):
         '''
         return B
 
-    def assemble(self, inplace=True):
+    def assemble(self, inplace=True, update=False):
         engine = self.engine
         phys_target = self.get_phys()
         phys_range  = self.get_phys_range()
@@ -157,14 +167,22 @@ class StandardSolver(SolverInstance):
         # use get_phys to apply essential to all phys in solvestep        
         dprint1("in assemble", phys_target, phys_range)
 
-        engine.run_verify_setting(phys_target, self.gui)
-        engine.run_assemble_mat(phys_target, phys_range)
-        engine.run_assemble_b(phys_target)
-        engine.run_fill_X_block()
+        if update:
+            # forms of models whose update_flag is False are reused
+            engine.run_apply_essential(phys_target, phys_range, update=True)
+            engine.run_fill_X_block(update=True)
+            engine.run_assemble_mat(phys_target, phys_range, update=True)
+            engine.run_assemble_b(phys_target, update=True)
+        else:
+            engine.run_verify_setting(phys_target, self.gui)
+            engine.run_assemble_mat(phys_target, phys_range)
+            engine.run_assemble_b(phys_target)
+            engine.run_fill_X_block()
         
         self.engine.run_assemble_blocks(self.compute_A,
                                         self.compute_rhs,
-                                        inplace=inplace)
+                                        inplace=inplace,
+                                        update=update)
         #A, X, RHS, Ae, B, M, names = blocks
         self.assembled = True
         
@@ -14,6 +14,7 @@ except:
 
 import petram.debug as debug
 dprint1, dprint2, dprint3 = debug.init_dprints('StrumpackModel')
+from petram.helper.stage_trace import trace_stage
 
 from petram.namespace_mixin import NS_mixin
 from .solver_model import Solver
@@ -41,6 +42,7 @@ else:
        print(x)
        
 from petram.helper.matrix_file import write_matrix, write_vector, write_coo_matrix
+from petram.helper.block_matrix import DistributedSol
 
 class Strumpack(LinearSolverModel):
     hide_ns_menu = True
@@ -112,6 +114,8 @@ class Strumpack(LinearSolverModel):
            return 'blk_merged'        
        
     def real_to_complex(self, solall, M):
+        if isinstance(solall, DistributedSol):
+            return solall.to_complex()
         if use_parallel:
            from mpi4py import MPI
            myid     = MPI.COMM_WORLD.rank
@@ -155,123 +159,177 @@ def get_block(Op, i, j):
     except KeyError:
         return None
 
-def build_csr_local(A, dtype, is_complex):
+def _index_dtype(n):
+    return np.int32 if n < np.iinfo(np.int32).max else np.int64
+
+class CSRBuilder(object):
     '''
-    build CSR form of A as a single 
-    matrix
+    build CSR form of BlockOperator A as a single matrix (local rows
+    in STRUMPACK ordering).
+
+    index permutation from block entries to CSR slots is computed
+    once. when the operator is refactored with the same sparsity
+    pattern, block data is written into the preallocated CSR data
+    array using the cached permutation.
     '''
-    offset = np.array(A.RowOffsets().ToList(), dtype=int)
-    if is_complex:
-       offset = offset//2
-       
-    rows = A.NumRowBlocks()
-    cols = A.NumColBlocks()
-        
-    local_size = np.diff(offset)
-    #nicePrint("local_size",local_size)
-    
-    if use_parallel:
-        x = allgather_vector(local_size)
-        global_size = np.sum(x.reshape(num_proc,-1), 0)
-        global_offset = np.hstack(([0], np.cumsum(global_size)))
-        global_roffset = global_offset + offset
-        new_offset = np.hstack(([0], np.cumsum(x)))[:-1]
-        new_size =   x.reshape(num_proc, -1)
-        new_offset = new_offset.reshape(num_proc, -1)
-        
-    else:
-        global_size = local_size
-        new_size = local_size.reshape(1,-1)
-        new_offset = offset.reshape(1,-1)
-        
-   #index_mapping
-    def blk_stm_idx_map(i):
-        stm_idx = [new_offset[kk, i]+
-                   np.arange(new_size[kk, i], dtype=int)
-                   for kk in range(len(new_offset))]
-        return np.hstack(stm_idx)
-
-    def sparsemat2csr(m):
-        w, h = m.Width(), m.Height()
-        I = m.GetIArray()
-        J = m.GetJArray()
-        data = m.GetDataArray()
-        m = csr_matrix((data, J, I), shape = (h, w),
-                       dtype = data.dtype)
-        return m
-     
-    def ToScipyCoo(mat):
+    def __init__(self, dtype, is_complex):
+        self.dtype = dtype
+        self.is_complex = is_complex
+        self._struct = None
+
+    def block_terms(self, A):
         '''
-        convert HypreParCSR to Scipy Coo Matrix
+        list of (i, j, part, matrix). part is 'r' or 'i' (real/imag
+        operator of ComplexOperator)
         '''
-        num_rows, ilower, iupper, jlower, jupper, irn, jcn, data = mat.GetCooDataArray()
-        m = iupper - ilower + 1
-        n = mat.N()
-        
-        return coo_matrix((data, (irn-ilower, jcn)), shape = (num_rows, n)), ilower
-     
-    map = [blk_stm_idx_map(i) for i in range(rows)]
-
-    newi = []
-    newj = []
-    newd = []
-    nrows = np.sum(local_size)
-    ncols = np.sum(global_size)
-        
-    for i in range(rows):
-        for j in range(cols):
-            m = get_block(A, i, j)
-            if m is None: continue
-            if use_parallel:
+        terms = []
+        for i in range(A.NumRowBlocks()):
+            for j in range(A.NumColBlocks()):
+                m = get_block(A, i, j)
+                if m is None: continue
                 if isinstance(m, mfem.ComplexOperator):
-                    mr, ilower = ToScipyCoo(m._real_operator)
-                    mi, ilower = ToScipyCoo(m._imag_operator)
-                    m = (mr + 1j*mi).tocoo()
-                    irn = m.row + ilower
-                    jcn = m.col
-                    data = m.data
+                    if m._real_operator is not None:
+                        terms.append((i, j, 'r', m._real_operator))
+                    if m._imag_operator is not None:
+                        terms.append((i, j, 'i', m._imag_operator))
                 else:
-                    num_rows, ilower, iupper, jlower, jupper, irn, jcn, data = m.GetCooDataArray()
-            else:
-                # this is not efficient but for now let's do this...
-                if isinstance(m, mfem.ComplexOperator):
-                    mr = m._real_operator
-                    mi = m._imag_operator
-                    mr = sparsemat2csr(mr)
-                    mi = sparsemat2csr(mi)
-                    m = (mr + 1j*mi).tocoo()
-                else:
-                    m = sparsemat2csr(m).tocoo()
+                    terms.append((i, j, 'r', m))
+        return terms
 
-                irn = m.row
-                jcn = m.col
-                data = m.data
-                
-            irn = irn         #+ global_roffset[i]
-            jcn = jcn         #+ global_offset[j]
+    @staticmethod
+    def block_data(m):
+        '''
+        (rows, cols, data) of a block. rows is local row index
+        (parallel) or CSR row pointer (serial)
+        '''
+        if use_parallel:
+            num_rows, ilower, iupper, jlower, jupper, irn, jcn, data = m.GetCooDataArray()
+            return irn - ilower, jcn, data
+        else:
+            return m.GetIArray(), m.GetJArray(), m.GetDataArray()
+
+    def same_pattern(self, terms, blkdata):
+        st = self._struct
+        if st is None: return False
+        if [t[:3] for t in terms] != st['keys']: return False
+        for (r, c, d), (r0, c0) in zip(blkdata, st['patterns']):
+            if not (np.array_equal(r, r0) and np.array_equal(c, c0)):
+                return False
+        return True
+
+    def make_struct(self, A, terms, blkdata):
+        offset = np.array(A.RowOffsets().ToList(), dtype=int)
+        if self.is_complex:
+            offset = offset//2
 
-            irn2 = map[i][irn]
-            jcn2 = map[j][jcn]
-               
-            newi.append(irn2)
-            newj.append(jcn2)
-            newd.append(data)
+        local_size = np.diff(offset)
+        if use_parallel:
+            x = allgather_vector(local_size)
+            global_size = np.sum(x.reshape(num_proc,-1), 0)
+            new_offset = np.hstack(([0], np.cumsum(x)))[:-1]
+            new_size = x.reshape(num_proc, -1)
+            new_offset = new_offset.reshape(num_proc, -1)
+        else:
+            global_size = local_size
+            new_size = local_size.reshape(1,-1)
+            new_offset = offset.reshape(1,-1)
 
-    newi = np.hstack(newi)
-    newj = np.hstack(newj)
-    newd = np.hstack(newd)
+        nrows = int(np.sum(local_size))
+        ncols = int(np.sum(global_size))
+        # row offset of each block row in local CSR
+        loffset = np.hstack(([0], np.cumsum(local_size)))
 
-    #nicePrint(new_offset)
-    #nicePrint((nrows, ncols),)
-    #nicePrint('newJ', np.min(newj), np.max(newj))
-    #nicePrint('newI', np.min(newi)-new_offset[myid, 0],
-    #                      np.max(newi)-new_offset[myid, 0])
+        #index_mapping
+        def blk_stm_idx_map(i):
+            stm_idx = [new_offset[kk, i]+
+                       np.arange(new_size[kk, i], dtype=int)
+                       for kk in range(len(new_offset))]
+            return np.hstack(stm_idx)
+        map = [blk_stm_idx_map(i) for i in range(A.NumColBlocks())]
+
+        irow = []
+        icol = []
+        for (i, j, part, m), (r, c, d) in zip(terms, blkdata):
+            if not use_parallel:
+                r = np.repeat(np.arange(len(r)-1), np.diff(r))
+            irow.append(loffset[i] + r)
+            icol.append(map[j][c])
+        nnz = [len(x) for x in irow]
+        irow = np.hstack(irow) if len(irow) > 0 else np.array([], dtype=int)
+        icol = np.hstack(icol) if len(icol) > 0 else np.array([], dtype=int)
+
+        # sort by (row, col). entries at the same position (real and
+        # imaginary part) share a slot
+        perm = np.lexsort((icol, irow))
+        srow = irow[perm]
+        scol = icol[perm]
+        first = np.ones(len(perm), dtype=bool)
+        first[1:] = (srow[1:] != srow[:-1]) | (scol[1:] != scol[:-1])
+        dest = np.empty(len(perm), dtype=int)
+        dest[perm] = np.cumsum(first) - 1
+
+        idx_dtype = _index_dtype(max(ncols, len(perm)))
+        indptr = np.zeros(nrows+1, dtype=idx_dtype)
+        indptr[1:] = np.cumsum(np.bincount(srow[first], minlength=nrows))
+        indices = scol[first].astype(idx_dtype)
+
+        seg = np.hstack(([0], np.cumsum(nnz)))
+        dests = [dest[seg[k]:seg[k+1]] for k in range(len(terms))]
+        # a block with duplicated entries is accumulated
+        dups = [len(np.unique(d)) != len(d) for d in dests]
+
+        self._struct = {'keys': [t[:3] for t in terms],
+                        'patterns': [(np.array(r, copy=True),
+                                      np.array(c, copy=True))
+                                     for r, c, d in blkdata],
+                        'dests': dests,
+                        'dups': dups,
+                        'indptr': indptr,
+                        'indices': indices,
+                        'shape': (nrows, ncols),
+                        'data': np.zeros(len(indices), dtype=self.dtype)}
+
+    def fill(self, terms, blkdata):
+        st = self._struct
+        data = st['data']
+        data.fill(0)
+        for (i, j, part, m), (r, c, d), dest, dup in zip(terms, blkdata,
+                                                          st['dests'],
+                                                          st['dups']):
+            if part == 'i':
+                if not np.iscomplexobj(data):
+                    assert False, "complex block in real matrix"
+                target = data.imag
+            else:
+                target = data.real if np.iscomplexobj(data) else data
+            if dup:
+                np.add.at(target, dest, d)
+            else:
+                target[dest] = d
+
+    def build(self, A):
+        terms = self.block_terms(A)
+        blkdata = [self.block_data(t[3]) for t in terms]
+
+        same = self.same_pattern(terms, blkdata)
+        if use_parallel:
+            same = MPI.COMM_WORLD.allreduce(same, op=MPI.LAND)
+        if same:
+            dprint1("reusing CSR structure")
+        else:
+            self.make_struct(A, terms, blkdata)
+        self.fill(terms, blkdata)
 
-    csr_mat = coo_matrix((newd,(newi-new_offset[myid, 0], newj)),
-                      shape=(nrows, ncols),
-                      dtype=dtype).tocsr()
+        st = self._struct
+        return csr_matrix((st['data'], st['indices'], st['indptr']),
+                          shape = st['shape'], copy = False)
 
-    return csr_mat
+def build_csr_local(A, dtype, is_complex):
+    '''
+    build CSR form of A as a single 
+    matrix
+    '''
+    return CSRBuilder(dtype, is_complex).build(A)
  
 class StrumpackSolver(LinearSolver):
     def __init__(self, gui, engine, maxiter, actol, rctol, mc64job,
@@ -311,8 +369,10 @@ class StrumpackSolver(LinearSolver):
         self.dtype = dtype
         self.spss = spss
         self.is_complex = is_complex
+        self.csr_builder = CSRBuilder(dtype, is_complex)
         spss.set_verbose(1)
         
+    @trace_stage('SetOperator')
     def SetOperator(self, A, dist, name=None):
         try:
             from mpi4py import MPI
@@ -323,7 +383,7 @@ class StrumpackSolver(LinearSolver):
 
         self.row_offsets = A.RowOffsets()        
         
-        AA = build_csr_local(A, self.dtype, self.is_complex)
+        AA = self.csr_builder.build(A)
 
         if self.gui.write_mat:
             write_coo_matrix('matrix', AA.tocoo())
@@ -334,6 +394,7 @@ class StrumpackSolver(LinearSolver):
            self.spss.set_csr_matrix(AA)
         self._matrix = AA
         
+    @trace_stage('Mult')
     def Mult(self, b, x=None, case_base=0):
         try:
             from mpi4py import MPI
@@ -404,23 +465,14 @@ class StrumpackSolver(LinearSolver):
                if self.is_complex:
                    r1 = r1//2
                    r2 = r2//2                   
-               xxvv = xxv[r1:r2]
-               
-               if use_parallel:
-                   vv = gather_vector(xxvv)                  
-               else:
-                   vv = xxvv.copy()
-               if myid == 0:
-                   s.append(vv)
-               else:
-                   pass
-           if myid == 0:               
-               sol.append(np.hstack(s))
-        if myid == 0:                              
-            sol = np.transpose(np.vstack(sol))
-            return sol
-        else:
-            return None
+               s.append(xxv[r1:r2].copy())
+           sol.append(s)
+
+        if use_parallel:
+            # solution is kept distributed
+            return DistributedSol(sol)
+        sol = np.transpose(np.vstack([np.hstack(s) for s in sol]))
+        return sol
 
 
 
@@ -45,6 +45,7 @@ class TimeDomain(Solver):
         v['dwc_cp_arg']   = ''      
         v['use_dwc_ts']   = False   # every time step
         v['dwc_ts_arg']   = ''      
+        v['probe_flush']  = 100     # probe is written every 100 steps
         
         super(TimeDomain, self).attribute_set(v)
         return v
@@ -83,7 +84,10 @@ class TimeDomain(Solver):
                 [None,
                  self.save_parmesh,  3, {"text":"save parallel mesh"}],
                 [None,
-                 self.use_profiler,  3, {"text":"use profiler"}],]
+                 self.use_profiler,  3, {"text":"use profiler"}],
+                [None,
+                 self.save_binary,  3, {"text":"save solution in binary"}],
+                ["probe flush (steps)",   self.probe_flush,  400, {},],]
 
     def get_panel1_value(self):
         st_et_nt = ", ".join([str(x) for x in self.st_et_nt])
@@ -103,7 +107,9 @@ class TimeDomain(Solver):
                 self.init_only,               
                 self.assemble_real,
                 self.save_parmesh,
-                self.use_profiler,)
+                self.use_profiler,
+                self.save_binary,
+                self.probe_flush,)
 
     
     def import_panel1_value(self, v):
@@ -118,6 +124,8 @@ class TimeDomain(Solver):
         self.assemble_real = v[8]
         self.save_parmesh = v[9]
         self.use_profiler = v[10]
+        self.save_binary = v[11]
+        self.probe_flush = int(v[12])
         
         self.ts_method = str(v[3][0])
         self.time_step = str(v[3][1][0])
@@ -204,6 +212,7 @@ class TimeDomain(Solver):
         instance.set_start(st)
         instance.set_end(et)
         instance.set_checkpoint(np.linspace(st, et, nt))
+        instance.set_probe_flush(self.probe_flush)
 
         engine.sol = engine.assembled_blocks[1][0]
         instance.sol = engine.sol
@@ -235,6 +244,7 @@ class TimeDomain(Solver):
             while not finished:
                 finished, cp_written = instance.step(is_first)
                 is_first=False
+                instance.flush_probes()
                 
                 if self.use_dwc_ts:
                     engine.call_dwc(self.get_phys_range(),
@@ -446,7 +456,8 @@ class FirstOrderBackwardEuler(TimeDependentSolverInstance):
         self.engine.mkdir(path) 
         os.chdir(path)
         self.engine.cleancwd() 
-        self.save_solution()
+        # checkpoint is not a result of case (parametric store)
+        self.save_solution(use_store = False)
         self.engine.symlink('../model.pmfm', 'model.pmfm')        
         os.chdir(od)
         
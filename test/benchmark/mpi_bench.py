@@ -0,0 +1,146 @@
+'''
+   mpi_bench.py
+
+   micro benchmark of vector collectives in petram.helper.mpi_recipes.
+
+   for each vector size, following patterns are timed (mean of
+   repeated calls, max over ranks).
+
+      allgather_vector     : counts exchanged in each call
+      allgather_layout     : cached layout (no count exchange)
+      gather_vector        : gather to root, counts exchanged
+      gather_layout        : gather to root, cached layout
+      gather_loop          : nvec gathers (different roots) one by one
+      gather_vectors       : the same nvec gathers done concurrently
+      allgather_compute    : allgather followed by local computation
+                             (dot products)
+      iallgather_overlap   : the same with non-blocking allgather
+                             overlapped with the computation
+
+   usage : see README
+'''
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+import argparse
+
+import numpy as np
+
+bench_file = os.path.abspath(__file__)
+
+def timeit(func, repeat, comm):
+    from mpi4py import MPI
+    func()   # warm up
+    comm.Barrier()
+    t0 = time.time()
+    for k in range(repeat):
+        func()
+    t = (time.time() - t0)/repeat
+    return comm.allreduce(t, op=MPI.MAX)
+
+def run_worker(sizes, nvec, repeat):
+    from mpi4py import MPI
+    import petram.helper.mpi_recipes as recipes
+
+    comm = MPI.COMM_WORLD
+    myid = comm.rank
+    nproc = comm.size
+
+    results = []
+    for size in sizes:
+        # slightly unbalanced distribution
+        n = size//nproc + (1 if myid < size % nproc else 0)
+        data = np.random.rand(n)
+        layout = recipes.get_layout(data.shape)
+        datas = [np.random.rand(n) for k in range(nvec)]
+        roots = [k % nproc for k in range(nvec)]
+        work = np.random.rand(n)
+
+        def overlap():
+            p = recipes.iallgather_vector(data, layout = layout)
+            for k in range(10): np.dot(work, work)
+            p.wait()
+
+        def serial():
+            recipes.allgather_vector(data, layout = layout)
+            for k in range(10): np.dot(work, work)
+
+        times = {
+            'allgather_vector':
+                timeit(lambda: recipes.allgather_vector(data), repeat, comm),
+            'allgather_layout':
+                timeit(lambda: recipes.allgather_vector(data, layout = layout),
+                       repeat, comm),
+            'gather_vector':
+                timeit(lambda: recipes.gather_vector(data), repeat, comm),
+            'gather_layout':
+                timeit(lambda: recipes.gather_vector(data, layout = layout),
+                       repeat, comm),
+            'gather_loop':
+                timeit(lambda: [recipes.gather_vector(d, root = r)
+                                for d, r in zip(datas, roots)], repeat, comm),
+            'gather_vectors':
+                timeit(lambda: recipes.gather_vectors(datas, roots),
+                       repeat, comm),
+            'allgather_compute':
+                timeit(serial, repeat, comm),
+            'iallgather_overlap':
+                timeit(overlap, repeat, comm),
+            }
+        results.append({'nproc': nproc, 'size': size, 'nvec': nvec,
+                        'times': times})
+        if myid == 0:
+            print("np=" + str(nproc), "size=" + str(size))
+            for key in sorted(times):
+                print("   %-20s %12.3e" % (key, times[key]))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="PetraM MPI benchmark")
+    parser.add_argument("--nprocs", default = "",
+                        help = "comma separated list of process counts. " +
+                        "benchmark is launched by mpirun for each")
+    parser.add_argument("--mpirun", default = "mpirun")
+    parser.add_argument("--sizes", default = "1000,100000,1000000",
+                        help = "comma separated list of global vector sizes")
+    parser.add_argument("--nvec", default = 16, type = int,
+                        help = "number of vectors in gather_loop/gather_vectors")
+    parser.add_argument("--repeat", default = 20, type = int)
+    parser.add_argument("-o", "--output", default = "mpi_bench.json")
+    args = parser.parse_args()
+
+    if args.nprocs != '':
+        # driver mode
+        results = []
+        for n in [int(x) for x in args.nprocs.split(',')]:
+            out = args.output + '.np' + str(n)
+            command = [args.mpirun, '-np', str(n), sys.executable, bench_file,
+                       '--sizes', args.sizes, '--nvec', str(args.nvec),
+                       '--repeat', str(args.repeat), '-o', out]
+            print(' '.join(command))
+            subprocess.check_call(command)
+            with open(out, 'r') as fid:
+                results.extend(json.load(fid)['results'])
+            os.remove(out)
+    else:
+        from mpi4py import MPI
+        sizes = [int(x) for x in args.sizes.split(',')]
+        results = run_worker(sizes, args.nvec, args.repeat)
+        if MPI.COMM_WORLD.rank != 0: return
+
+    meta = {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'host': platform.node(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'args': vars(args)}
+    with open(args.output, 'w') as fid:
+        json.dump({'meta': meta, 'results': results}, fid, indent=1)
+    print("result is written to " + args.output)
+
+if __name__ == "__main__":
+    main()
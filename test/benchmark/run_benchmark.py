@@ -0,0 +1,313 @@
+'''
+   run_benchmark.py
+
+   benchmark of assembly, solve and post-processing using SerialEngine.
+
+   a problem (-div grad u + c(x) u = 1, u = 0 on boundary) is built
+   using weakform (WF) physics on a synthetic mesh (hex_box_mesh,
+   quad_rectangle_mesh) or a mesh in data/, and solved for each
+   mesh size and element order. Stages recorded by stage_trace
+   (run_mesh, run_assemble_mat, finalize_matrix, SetOperator, Mult, ...)
+   as well as coefficient evaluation and boundary nodal evaluator are
+   timed.
+
+   usage : see README
+'''
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+import argparse
+
+os.environ.setdefault('PetraM_GEOM_CACHE', 'none')
+
+import petram.mfem_config as mfem_config
+mfem_config.use_parallel = False
+
+import numpy as np
+import mfem.ser as mfem
+
+import petram.helper.stage_trace as stage_trace
+from petram.helper.stage_trace import trace_stage
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+data_dir = os.path.join(bench_dir, '..', '..', 'data')
+
+def mesh_dim(path):
+    with open(path, 'r') as fid:
+        for line in fid:
+            if line.strip() == 'dimension':
+                return int(next(fid).strip())
+    assert False, "can not find dimension in " + path
+
+def build_model(mesh, size, order, solver):
+    from petram.mfem_model import (MFEM_ModelRoot, MFEM_MeshRoot,
+                                   MFEM_PhysRoot, MFEM_SolverRoot)
+    from petram.mesh.mesh_model import (MeshGroup, MeshFile, Mesh2D, Mesh3D,
+                                        UniformRefinement)
+    from petram.phys.wf.wf_model import WF, WF_DefDomain, WF_DefBdry
+    from petram.phys.wf.wf_constraints import (WF_WeakDomainBilinConstraint,
+                                               WF_WeakDomainLinConstraint)
+    from petram.phys.wf.wf_essential import WF_Essential
+    from petram.solver.solver_model import SolveStep
+    from petram.solver.std_solver_model import StdSolver
+    from petram.solver.mumps_model import MUMPS
+    from petram.solver.gmres_model import GMRES
+
+    obj1 = MFEM_ModelRoot()
+    obj2 = obj1.add_node(name = "Mesh", cls = MFEM_MeshRoot)
+    obj3 = obj2.add_node(name = "MeshGroup1", cls = MeshGroup)
+    if mesh == 'box':
+        obj4 = obj3.add_node(name = "Mesh3D1", cls = Mesh3D)
+        obj4.xnsegs_txt = str(size)
+        obj4.ynsegs_txt = str(size)
+        obj4.znsegs_txt = str(size)
+        dim = 3
+    elif mesh == 'rect':
+        obj4 = obj3.add_node(name = "Mesh2D1", cls = Mesh2D)
+        obj4.xnsegs_txt = str(size)
+        obj4.ynsegs_txt = str(size)
+        dim = 2
+    else:
+        path = mesh if os.path.isabs(mesh) else os.path.join(data_dir, mesh)
+        obj4 = obj3.add_node(name = "MeshFile1", cls = MeshFile)
+        obj4.path = os.path.abspath(path)
+        obj5 = obj3.add_node(name = "UniformRefinement1",
+                             cls = UniformRefinement)
+        obj5.num_refine = str(size)
+        dim = mesh_dim(path)
+
+    obj6 = obj1.add_node(name = "Phys", cls = MFEM_PhysRoot)
+    obj7 = obj6.add_node(name = "WF1", cls = WF)
+    obj7.order = order
+    obj7.ndim = dim
+    obj7.ind_vars = ', '.join(['x', 'y', 'z'][:dim])
+    obj7.dep_vars_base_txt = 'u'
+    obj7.sel_index = ['all']
+    obj8 = obj7.add_node(name = "Domain", cls = WF_DefDomain)
+    obj9 = obj8.add_node(name = "WeakBilin1",
+                         cls = WF_WeakDomainBilinConstraint)
+    obj9.integrator = 'DiffusionIntegrator'
+    obj9.coeff_lambda = '1.0'
+    obj9.coeff_lambda_txt = '1.0'
+    obj9.sel_index = ['all']
+    obj10 = obj8.add_node(name = "WeakBilin2",
+                          cls = WF_WeakDomainBilinConstraint)
+    obj10.integrator = 'MassIntegrator'
+    obj10.coeff_lambda = '=1.0 + x*x'
+    obj10.coeff_lambda_txt = '=1.0 + x*x'
+    obj10.sel_index = ['all']
+    obj11 = obj8.add_node(name = "WeakLin1",
+                          cls = WF_WeakDomainLinConstraint)
+    obj11.integrator = 'DomainLFIntegrator'
+    obj11.coeff_lambda = '1.0'
+    obj11.coeff_lambda_txt = '1.0'
+    obj11.sel_index = ['all']
+    obj12 = obj7.add_node(name = "Boundary", cls = WF_DefBdry)
+    obj13 = obj12.add_node(name = "Essential1", cls = WF_Essential)
+    obj13.sel_index = ['remaining']
+
+    obj14 = obj1.add_node(name = "Solver", cls = MFEM_SolverRoot)
+    obj15 = obj14.add_node(name = "SolveStep1", cls = SolveStep)
+    obj15.phys_model = 'WF1'
+    obj16 = obj15.add_node(name = "StdSolver1", cls = StdSolver)
+    obj16.phys_model = 'WF1'
+    if solver == 'mumps':
+        obj16.add_node(name = "MUMPS1", cls = MUMPS)
+    elif solver == 'gmres':
+        obj17 = obj16.add_node(name = "GMRES1", cls = GMRES)
+        obj17.preconditioners = [('u', ['GS', 'None'])]
+    else:
+        assert False, "unknown solver " + solver
+    return obj1
+
+def eval_coefficient(mesh, order):
+    '''
+    project an expression (PhysCoefficient) to H1 space
+    '''
+    from petram.phys.coefficient import SCoeff
+    from petram.helper.variables import var_g
+
+    ind_vars = ', '.join(['x', 'y', 'z'][:mesh.SpaceDimension()])
+    fec = mfem.H1_FECollection(order, mesh.Dimension())
+    fes = mfem.FiniteElementSpace(mesh, fec)
+    gf = mfem.GridFunction(fes)
+    coeff = SCoeff('sin(x)*exp(-y) + 1.0', ind_vars, {}, var_g.copy())
+    trace_stage('coefficient_eval')(gf.ProjectCoefficient)(coeff)
+
+def eval_solution(model, mesh, path):
+    '''
+    read solution and evaluate it using BdrNodal evaluator
+    '''
+    from petram.sol.solsets import find_solfiles
+    from petram.sol.evaluators import build_evaluator, def_config
+
+    if mesh.Dimension() == 3:
+        battrs = list(mesh.bdr_attributes.ToList())
+    else:
+        battrs = list(mesh.attributes.ToList())
+    solfiles = find_solfiles(path)
+
+    evaluator = trace_stage('sol_load')(build_evaluator)(battrs, model,
+                                                           solfiles,
+                                                           name = 'BdrNodal',
+                                                           config = def_config,
+                                                           decimate = 1)
+    evaluator.validate_evaluator('BdrNodal', battrs, solfiles,
+                                 isFirst = True, decimate = 1)
+    evaluator.set_phys_path('Phys.WF1')
+    trace_stage('sol_eval')(evaluator.eval)('u', True, False)
+
+def run_case(mesh, size, order, solver):
+    from petram.engine import SerialEngine
+
+    model = build_model(mesh, size, order, solver)
+    stage_trace.reset()
+
+    cwd = os.getcwd()
+    wdir = tempfile.mkdtemp(prefix='petram_bench_')
+    os.chdir(wdir)
+    try:
+        t0 = time.time()
+        engine = SerialEngine(model = model)
+        solvers = engine.run_build_ns(dir = wdir)
+        is_first = True
+        for s in solvers:
+            s.run(engine, is_first = is_first)
+            is_first = False
+        total = time.time() - t0
+
+        emesh = engine.meshes[0]
+        info = {'ndof': int(engine.fespaces['u'].GetTrueVSize()),
+                'nelement': int(emesh.GetNE()),
+                'total': total}
+        eval_coefficient(emesh, order)
+        eval_solution(model, emesh, wdir)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(wdir, ignore_errors=True)
+    return info, stage_trace.local_records()
+
+def run_benchmark(meshes, sizes, orders, solver, repeat):
+    cases = []
+    for mesh in meshes:
+        for size in sizes:
+            for order in orders:
+                print("running", mesh, "size=" + str(size),
+                      "order=" + str(order))
+                stages = {}
+                for k in range(repeat):
+                    info, records = run_case(mesh, size, order, solver)
+                    for r in records:
+                        if not r['stage'] in stages:
+                            stages[r['stage']] = {'count': r['count'],
+                                                  'wall': [], 'cpu': [],
+                                                  'peak_rss_mb': 0.0}
+                        s = stages[r['stage']]
+                        s['wall'].append(r['wall'])
+                        s['cpu'].append(r['cpu'])
+                        s['peak_rss_mb'] = max(s['peak_rss_mb'],
+                                               r['peak_rss_mb'])
+                for s in stages.values():
+                    s['wall_min'] = min(s['wall'])
+                    s['wall_mean'] = float(np.mean(s['wall']))
+                    s['cpu_min'] = min(s['cpu'])
+                case = {'mesh': mesh, 'size': size, 'order': order,
+                        'solver': solver, 'stages': stages}
+                case.update(info)
+                cases.append(case)
+                print("   ndof=" + str(info['ndof']),
+                      "total=%.3fs" % info['total'])
+    return cases
+
+def git_revision():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                      cwd = bench_dir,
+                                      stderr = subprocess.STDOUT)
+        return out.decode().strip()
+    except Exception:
+        return ''
+
+def metadata(args):
+    return {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'host': platform.node(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'mfem': getattr(mfem, '__version__', ''),
+            'petram_revision': git_revision(),
+            'args': vars(args)}
+
+def case_key(case):
+    return (case['mesh'], case['size'], case['order'], case['solver'])
+
+def compare(cases, reference, threshold):
+    with open(reference, 'r') as fid:
+        ref = json.load(fid)
+    ref_cases = {case_key(c): c for c in ref['cases']}
+
+    print("comparison with " + reference)
+    nslow = 0
+    for case in cases:
+        key = case_key(case)
+        if not key in ref_cases: continue
+        ref_stages = ref_cases[key]['stages']
+        for name in case['stages']:
+            if not name in ref_stages: continue
+            t1 = case['stages'][name]['wall_min']
+            t0 = ref_stages[name]['wall_min']
+            if t0 <= 0: continue
+            ratio = t1/t0
+            flag = ''
+            if ratio > 1 + threshold:
+                flag = '  <-- slower'
+                nslow = nslow + 1
+            print("%-30s %-20s %10.4f %10.4f %6.2f%s" %
+                  (str(key), name, t0, t1, ratio, flag))
+    return nslow
+
+def main():
+    parser = argparse.ArgumentParser(description="PetraM benchmark")
+    parser.add_argument("--mesh", default = "box,rect",
+                        help = "comma separated list of box, rect or mesh file")
+    parser.add_argument("--sizes", default = "4,8",
+                        help = "comma separated list of mesh sizes")
+    parser.add_argument("--orders", default = "1,2",
+                        help = "comma separated list of element orders")
+    parser.add_argument("--solver", default = "mumps",
+                        choices = ["mumps", "gmres"])
+    parser.add_argument("--repeat", default = 1, type = int)
+    parser.add_argument("-o", "--output", default = "bench.json")
+    parser.add_argument("--compare", default = "",
+                        help = "previous result to compare with")
+    parser.add_argument("--threshold", default = 0.2, type = float,
+                        help = "relative slow down reported in comparison")
+    args = parser.parse_args()
+
+    import petram.debug as debug
+    debug.set_debug_level(0)
+    stage_trace.enable()
+
+    meshes = [x.strip() for x in args.mesh.split(',')]
+    sizes = [int(x) for x in args.sizes.split(',')]
+    orders = [int(x) for x in args.orders.split(',')]
+
+    cases = run_benchmark(meshes, sizes, orders, args.solver, args.repeat)
+
+    with open(args.output, 'w') as fid:
+        json.dump({'meta': metadata(args), 'cases': cases}, fid, indent=1)
+    print("result is written to " + args.output)
+
+    if args.compare != '':
+        nslow = compare(cases, args.compare, args.threshold)
+        if nslow > 0: sys.exit(1)
+
+if __name__ == "__main__":
+    main()
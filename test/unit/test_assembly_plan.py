@@ -0,0 +1,63 @@
+'''
+   global coo matrix made from BlockMatrix with AssemblyPlan
+'''
+import pytest
+
+np = pytest.importorskip('numpy')
+scipy_sparse = pytest.importorskip('scipy.sparse')
+pytest.importorskip('mfem.ser', exc_type=ImportError)
+pytest.importorskip('petram.helper.block_matrix', exc_type=ImportError)
+
+from petram.helper.block_matrix import (BlockMatrix, AssemblyPlan,
+                                        convert_to_ScipyCoo)
+
+
+def assemble(mats, plan):
+    M = BlockMatrix((2, 2), kind='scipy')
+    for (i, j), m in mats.items():
+        M[i, j] = convert_to_ScipyCoo(scipy_sparse.coo_matrix(m))
+    return M.get_global_coo(dtype='float', plan=plan)
+
+def dense(mats):
+    return np.vstack([np.hstack([mats.get((i, j), np.zeros((2, 2)))
+                                 for j in range(2)]) for i in range(2)])
+
+def make_plan():
+    plan = AssemblyPlan()
+    plan.stamp = 0
+    return plan
+
+def test_reuse_pattern():
+    plan = make_plan()
+    mats = {(0, 0): np.eye(2), (1, 1): np.array([[1., 2.], [0., 3.]])}
+    g1 = assemble(mats, plan)
+    mats = {(0, 0): 2*np.eye(2), (1, 1): np.array([[4., 5.], [0., 6.]])}
+    g2 = assemble(mats, plan)
+    assert g2.row is g1.row and g2.col is g1.col
+    # data is not shared unless consumer opts in
+    assert g2.data is not g1.data
+    assert np.allclose(g1.toarray(), dense({(0, 0): np.eye(2),
+                                            (1, 1): [[1., 2.], [0., 3.]]}))
+    assert np.allclose(g2.toarray(), dense(mats))
+
+def test_pattern_change_same_nnz():
+    plan = make_plan()
+    mats = {(0, 0): np.eye(2), (1, 1): np.array([[1., 2.], [0., 3.]])}
+    g1 = assemble(mats, plan)
+    # the same nnz in each block, but different pattern
+    mats = {(0, 0): np.eye(2), (1, 1): np.array([[1., 0.], [2., 3.]])}
+    g2 = assemble(mats, plan)
+    assert g2.row is not g1.row
+    assert np.allclose(g2.toarray(), dense(mats))
+
+def test_reuse_data():
+    plan = make_plan()
+    plan.reuse_data = True
+    mats = {(0, 0): np.eye(2), (1, 1): np.eye(2)}
+    g = assemble(mats, plan)
+    ptr = g.data.__array_interface__['data'][0]
+    del g
+    mats = {(0, 0): 3*np.eye(2), (1, 1): np.eye(2)}
+    g = assemble(mats, plan)
+    assert g.data.__array_interface__['data'][0] == ptr
+    assert np.allclose(g.toarray(), dense(mats))
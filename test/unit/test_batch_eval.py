@@ -0,0 +1,80 @@
+'''
+   batch (per element) evaluation of PhysCoefficient compared with
+   pointwise evaluation
+'''
+import pytest
+
+np = pytest.importorskip('numpy')
+mfem = pytest.importorskip('mfem.ser', exc_type=ImportError)
+
+from petram.mfem_config import use_parallel
+if use_parallel:
+    pytest.skip("serial test", allow_module_level=True)
+
+pytest.importorskip('petram.phys.phys_model', exc_type=ImportError)
+
+from petram.phys.phys_model import PhysCoefficient
+
+
+def make_mesh():
+    if hasattr(mfem.Mesh, 'MakeCartesian2D'):
+        return mfem.Mesh.MakeCartesian2D(3, 3, mfem.Element.QUADRILATERAL)
+    return mfem.Mesh(3, 3, "QUADRILATERAL")
+
+def eval_element(coeff, mesh, i, order=4):
+    T = mesh.GetElementTransformation(i)
+    ir = mfem.IntRules.Get(T.GetGeometryType(), order)
+    val = []
+    for j in range(ir.GetNPoints()):
+        ip = ir.IntPoint(j)
+        T.SetIntPoint(ip)
+        val.append(coeff.Eval(T, ip))
+    return np.array(val)
+
+def points(mesh, i, order=4):
+    T = mesh.GetElementTransformation(i)
+    ir = mfem.IntRules.Get(T.GetGeometryType(), order)
+    return np.vstack([T.Transform(ir.IntPoint(j))
+                      for j in range(ir.GetNPoints())])
+
+def test_batch_agrees_with_pointwise():
+    mesh = make_mesh()
+    g = {'sin': np.sin, 'a': 2.0}
+    c1 = PhysCoefficient('a*sin(x)+y*y', 'x, y', {}, g)
+    c2 = PhysCoefficient('a*sin(x)+y*y', 'x, y', {}, dict(g))
+    c2._batch_ok = False
+    for i in range(mesh.GetNE()):
+        v1 = eval_element(c1, mesh, i)
+        v2 = eval_element(c2, mesh, i)
+        assert np.allclose(v1, v2)
+        ptx = points(mesh, i)
+        assert np.allclose(v1, 2.0*np.sin(ptx[:, 0]) + ptx[:, 1]**2)
+    assert c1._batch_ok
+
+def test_namespace_change():
+    mesh = make_mesh()
+    g = {'t': 0.0}
+    c = PhysCoefficient('x + t', 'x, y', {}, g)
+    x = points(mesh, 0)[:, 0]
+
+    assert np.allclose(eval_element(c, mesh, 0), x)
+    # the same element is evaluated again after time is advanced
+    g['t'] = 1.5
+    assert np.allclose(eval_element(c, mesh, 0), x + 1.5)
+    assert c._batch_ok
+
+def test_mesh_change():
+    g = {}
+    c = PhysCoefficient('x*y', 'x, y', {}, g)
+    mesh1 = make_mesh()
+    p1 = points(mesh1, 0)
+    assert np.allclose(eval_element(c, mesh1, 0), p1[:, 0]*p1[:, 1])
+
+    # element 0 of a different mesh
+    if hasattr(mfem.Mesh, 'MakeCartesian2D'):
+        mesh2 = mfem.Mesh.MakeCartesian2D(2, 2, mfem.Element.QUADRILATERAL,
+                                          sx=3.0, sy=3.0)
+    else:
+        mesh2 = mfem.Mesh(2, 2, "QUADRILATERAL", False, 3.0, 3.0)
+    p2 = points(mesh2, 0)
+    assert np.allclose(eval_element(c, mesh2, 0), p2[:, 0]*p2[:, 1])
@@ -0,0 +1,67 @@
+'''
+   binary solution file (sol.binary_solfile) and its index
+'''
+import os
+import pytest
+
+np = pytest.importorskip('numpy')
+mfem = pytest.importorskip('mfem.ser', exc_type=ImportError)
+
+from petram.sol.binary_solfile import (write_gridfunction, read_gridfunction,
+                                       gridfunction_header, is_binary_solfile,
+                                       write_index, read_index, read_array)
+
+
+def make_gf(order, vdim=1, ordering=0, fec='H1'):
+    if hasattr(mfem.Mesh, 'MakeCartesian2D'):
+        mesh = mfem.Mesh.MakeCartesian2D(3, 2, mfem.Element.TRIANGLE)
+    else:
+        mesh = mfem.Mesh(3, 2, "TRIANGLE")
+    fec = getattr(mfem, fec + '_FECollection')(order, 2)
+    fes = mfem.FiniteElementSpace(mesh, fec, vdim, ordering)
+    gf = mfem.GridFunction(fes)
+    gf.Assign(np.random.RandomState(order).rand(fes.GetVSize()))
+    gf._keep = (mesh, fec, fes)
+    return mesh, gf
+
+@pytest.mark.parametrize('order, vdim, ordering, fec',
+                         [(1, 1, 0, 'H1'), (2, 2, 1, 'H1'), (2, 1, 0, 'ND')])
+def test_roundtrip(tmp_path, order, vdim, ordering, fec):
+    mesh, gf = make_gf(order, vdim, ordering, fec)
+    path = str(tmp_path / 'solr_E_0')
+    header = write_gridfunction(path, gf)
+
+    assert is_binary_solfile(path)
+    assert header == gridfunction_header(path, gf)
+    assert header['file'] == 'solr_E_0'
+    assert header['offset'] % 64 == 0
+
+    gf2 = read_gridfunction(mesh, path)
+    fes1, fes2 = gf.FESpace(), gf2.FESpace()
+    assert fes2.FEColl().Name() == fes1.FEColl().Name()
+    assert fes2.GetVDim() == fes1.GetVDim()
+    assert fes2.GetOrdering() == fes1.GetOrdering()
+    assert np.array_equal(gf2.GetDataArray(), gf.GetDataArray())
+    assert np.array_equal(read_array(path, mmap=False), gf.GetDataArray())
+
+def test_index(tmp_path):
+    path = str(tmp_path)
+    mesh, gf = make_gf(1)
+    e1 = write_gridfunction(os.path.join(path, 'solr_u_0'), gf)
+    e2 = write_gridfunction(os.path.join(path, 'soli_u_0'), gf)
+    assert read_index(path) is None
+
+    write_index(path, [e1, e2])
+    assert sorted(read_index(path)['files']) == ['soli_u_0', 'solr_u_0']
+
+    # postprocess adds entries
+    e3 = write_gridfunction(os.path.join(path, 'solr_v_0'), gf)
+    write_index(path, [e3], append=True)
+    index = read_index(path)
+    assert index['format'] == 'binary'
+    assert sorted(index['files']) == ['soli_u_0', 'solr_u_0', 'solr_v_0']
+    assert index['files']['solr_v_0']['size'] == gf.Size()
+
+    # new save replaces index
+    write_index(path, [e1])
+    assert list(read_index(path)['files']) == ['solr_u_0']
@@ -0,0 +1,35 @@
+'''
+   eval_on_points (helper.variables) used by evaluator agents
+'''
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('petram.helper.variables', exc_type=ImportError)
+
+from petram.helper.variables import eval_on_points, var_g
+
+
+def test_vectorized():
+    x = np.linspace(0, 1, 5)
+    co = compile('sin(x)*2', '<string>', 'eval')
+    val = eval_on_points(co, dict(var_g), ['x'], [x], 5)
+    assert np.allclose(val, 2*np.sin(x))
+
+def test_broadcast():
+    co = compile('array([1, 2])', '<string>', 'eval')
+    val = eval_on_points(co, dict(var_g), [], [], 3)
+    assert val.shape == (3, 2)
+    assert np.all(val == [1, 2])
+
+def test_pointwise():
+    # python branch is not vectorizable
+    x = np.array([-1.0, 2.0, 3.0])
+    co = compile('x if x > 0 else 0', '<string>', 'eval')
+    val = eval_on_points(co, {}, ['x'], [x], 3)
+    assert np.allclose(val, [0, 2, 3])
+
+def test_error():
+    co = compile('undefined_name + x', '<string>', 'eval')
+    with pytest.raises(ValueError) as e:
+        eval_on_points(co, {}, ['x'], [np.zeros(2)], 2, expr='undefined_name + x')
+    assert 'undefined_name + x' in str(e.value)
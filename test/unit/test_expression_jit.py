@@ -0,0 +1,72 @@
+'''
+   compiled kernel of expression (helper.expression_jit) compared
+   with eval
+'''
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from petram.helper import expression_jit
+from petram.helper.expression_jit import jit_expression
+
+exprs = ['sin(x)*exp(-a*y)',
+         'x**2 + 3*y - a/2.',
+         'sqrt(abs(x - y)) + cosd(a*x)',
+         'arctan2(y, x+1) + (1+2j)*x']
+
+def reference(expr, g, x, y):
+    from petram.helper.variables import var_g
+    ns = dict(var_g)
+    ns.update(g)
+    return np.array([eval(expr, ns, {'x': xx, 'y': yy})
+                     for xx, yy in zip(x, y)])
+
+@pytest.mark.parametrize('expr', exprs)
+def test_kernel_agrees_with_eval(expr):
+    pytest.importorskip('numba')
+    pytest.importorskip('petram.helper.variables', exc_type=ImportError)
+    if not expression_jit.enabled:
+        pytest.skip("jit is turned off")
+
+    g = {'a': 0.7}
+    kernel = jit_expression(expr, ['x', 'y'], g)
+    assert kernel is not None
+    x = np.linspace(-1, 1, 11)
+    y = np.linspace(0, 2, 11)
+    assert np.allclose(kernel(x, y), reference(expr, g, x, y))
+
+    # namespace value is read when kernel is called
+    g['a'] = 1.3
+    assert np.allclose(kernel(x, y), reference(expr, g, x, y))
+
+def test_not_supported():
+    g = {'a': [1, 2]}
+    assert jit_expression('a[0]*x', ['x'], g) is None
+    assert jit_expression('foo(x)', ['x'], {}) is None
+
+def test_fallback_without_numba(monkeypatch):
+    monkeypatch.setattr(expression_jit, 'enabled', False)
+    assert jit_expression('sin(x)', ['x'], {}) is None
+
+    pytest.importorskip('mfem.ser', exc_type=ImportError)
+    pytest.importorskip('petram.phys.phys_model', exc_type=ImportError)
+    from petram.phys.phys_model import Coefficient_Evaluator
+    from petram.helper.variables import var_g
+
+    c = Coefficient_Evaluator('sin(x)*y', 'x, y', {}, dict(var_g))
+    assert c.kernels == [None]
+    x = np.array([[0.1, 0.2], [0.3, 0.4]])
+    assert np.allclose(c.EvalValueBatch(x)[:, 0], np.sin(x[:, 0])*x[:, 1])
+    assert np.allclose(c.EvalValue(x[1]), np.sin(0.3)*0.4)
+
+def test_pointwise_uses_eval():
+    pytest.importorskip('mfem.ser', exc_type=ImportError)
+    pytest.importorskip('petram.phys.phys_model', exc_type=ImportError)
+    from petram.phys.phys_model import Coefficient_Evaluator
+    from petram.helper.variables import var_g
+
+    c = Coefficient_Evaluator('sin(x)*y', 'x, y', {}, dict(var_g))
+    def kernel(*args):
+        raise AssertionError("kernel is called for a point")
+    c.kernels = [kernel]
+    assert np.allclose(c.EvalValue(np.array([0.3, 0.4])), np.sin(0.3)*0.4)
@@ -0,0 +1,59 @@
+'''
+   persistent geometry cache (sol.geometry_cache)
+'''
+import os
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from petram.sol import geometry_cache as gc
+
+
+class FakeMesh(object):
+    def __init__(self, solfile):
+        self._solfile = solfile
+        self._refine = 0
+
+@pytest.fixture
+def mesh(tmp_path):
+    solfile = tmp_path / 'solmesh_0'
+    solfile.write_text(u'mesh')
+    return FakeMesh(str(solfile))
+
+def test_off_by_default(mesh, monkeypatch):
+    monkeypatch.delenv('PetraM_GEOM_CACHE', raising=False)
+    gc.save_geometry(mesh, 'Test', (1,), {'a': np.arange(3)})
+    assert gc.load_geometry(mesh, 'Test', (1,)) is None
+    assert not os.path.exists(os.path.join(os.path.dirname(mesh._solfile),
+                                           '.geom_cache'))
+
+def test_soldir(mesh, monkeypatch):
+    monkeypatch.setenv('PetraM_GEOM_CACHE', 'soldir')
+    gc.save_geometry(mesh, 'Test', (1,), {'a': np.arange(3), 'b': [1, 2]})
+    data = gc.load_geometry(mesh, 'Test', (1,))
+    assert np.all(data['a'] == np.arange(3))
+    assert data['b'] == [1, 2]
+    assert gc.load_geometry(mesh, 'Test', (2,)) is None
+
+def test_eviction(mesh, tmp_path, monkeypatch):
+    top = str(tmp_path / 'cache')
+    monkeypatch.setenv('PetraM_GEOM_CACHE', top)
+    # room for about two entries
+    monkeypatch.setenv('PetraM_GEOM_CACHE_MB', str(2.5*8000/1024/1024))
+    for k in range(4):
+        gc.save_geometry(mesh, 'Test', (k,), {'a': np.zeros(1000)})
+        path = os.path.join(top, gc.cache_key(mesh, 'Test', (k,)), 'index')
+        if os.path.exists(path):
+            os.utime(path, (k, k))
+    assert len(os.listdir(top)) == 2
+    assert gc.load_geometry(mesh, 'Test', (3,)) is not None
+    assert gc.load_geometry(mesh, 'Test', (0,)) is None
+
+@pytest.mark.skipif(not hasattr(os, 'getuid'), reason='POSIX only')
+def test_not_private(mesh, tmp_path, monkeypatch):
+    top = str(tmp_path / 'cache')
+    monkeypatch.setenv('PetraM_GEOM_CACHE', top)
+    gc.save_geometry(mesh, 'Test', (1,), {'a': np.arange(3)})
+    assert gc.load_geometry(mesh, 'Test', (1,)) is not None
+    os.chmod(top, 0o777)
+    assert gc.load_geometry(mesh, 'Test', (1,)) is None
@@ -0,0 +1,19 @@
+'''
+   Parametric ('Update dependent') runs solvers with update=True
+   only when they support it
+'''
+import pytest
+
+parametric = pytest.importorskip('petram.solver.parametric',
+                                 exc_type=ImportError)
+std_solver_model = pytest.importorskip('petram.solver.std_solver_model',
+                                       exc_type=ImportError)
+
+
+def test_accepts_update():
+    from petram.solver.solver_model import Solver
+    from petram.solver.timedomain_solver_model import TimeDomain
+
+    assert parametric.accepts_update(std_solver_model.StdSolver)
+    assert not parametric.accepts_update(Solver)
+    assert not parametric.accepts_update(TimeDomain)
@@ -0,0 +1,58 @@
+'''
+   parametric store written by StoreWriter and read by
+   ParametricStore
+'''
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from petram.sol.parametric_store import StoreWriter, ParametricStore
+
+
+class FakeFEColl(object):
+    def Name(self):
+        return 'H1_3D_P1'
+
+class FakeFESpace(object):
+    def FEColl(self):
+        return FakeFEColl()
+    def GetVDim(self):
+        return 1
+    def GetOrdering(self):
+        return 0
+
+class FakeGF(object):
+    '''
+    part of GridFunction used by StoreWriter
+    '''
+    def __init__(self, data):
+        self.data = np.array(data, dtype=float)
+    def Size(self):
+        return len(self.data)
+    def GetDataArray(self):
+        return self.data
+    def FESpace(self):
+        return FakeFESpace()
+
+
+def test_solve_steps_with_different_variables(tmp_path):
+    path = str(tmp_path)
+    ncase = 3
+    writer = StoreWriter(path, ncase, ['a'])
+    for k in range(ncase):
+        # step 1 : E
+        writer.write_case(k, [('solr_E_0', FakeGF([k, k]))])
+        # step 2 : E (again) and psi
+        writer.write_case(k, [('solr_E_0', FakeGF([10+k, 10+k])),
+                              ('solr_psi_0', FakeGF([k, k, k]))])
+    writer.write_manifest([[float(k)] for k in range(ncase)])
+
+    store = ParametricStore(path)
+    assert store.suffixes == ['']
+    assert store.keys() == ['solr_E_0', 'solr_psi_0']
+    # vector saved by the later step is used
+    assert np.allclose(store.case(2, 'solr_E_0'), [12, 12])
+    assert np.allclose(store.array('solr_psi_0')[:, 0], [0, 1, 2])
+
+    solfiles = store.solfiles(1)
+    assert sorted(solfiles[0][1]) == ['E_0', 'psi_0']
@@ -0,0 +1,101 @@
+'''
+   ActionOperator (partial assembly) compared with fully assembled
+   matrix (serial)
+'''
+import pytest
+
+np = pytest.importorskip('numpy')
+scipy_sparse = pytest.importorskip('scipy.sparse')
+mfem = pytest.importorskip('mfem.ser', exc_type=ImportError)
+
+from petram.mfem_config import use_parallel
+if use_parallel:
+    pytest.skip("serial test", allow_module_level=True)
+
+pytest.importorskip('petram.helper.block_matrix', exc_type=ImportError)
+
+from petram.helper.partial_assembly import (ActionOperator,
+                                            set_partial_assembly)
+from petram.helper.block_matrix import convert_to_ScipyCoo
+
+
+def make_fespace():
+    if hasattr(mfem.Mesh, 'MakeCartesian2D'):
+        mesh = mfem.Mesh.MakeCartesian2D(4, 4, mfem.Element.QUADRILATERAL)
+    else:
+        mesh = mfem.Mesh(4, 4, "QUADRILATERAL")
+    fec = mfem.H1_FECollection(2, 2)
+    fes = mfem.FiniteElementSpace(mesh, fec)
+    fes._keep = (mesh, fec)
+    return fes
+
+def make_form(fes, partial):
+    one = mfem.ConstantCoefficient(1.0)
+    a = mfem.BilinearForm(fes)
+    if partial:
+        set_partial_assembly(a)
+    a.AddDomainIntegrator(mfem.DiffusionIntegrator(one))
+    a.AddDomainIntegrator(mfem.MassIntegrator(one))
+    a.Assemble()
+    if not partial:
+        a.Finalize()
+    a._keep = one
+    return a
+
+def to_scipy(m):
+    return scipy_sparse.csr_matrix((m.GetDataArray().copy(),
+                                    m.GetJArray().copy(),
+                                    m.GetIArray().copy()),
+                                   shape=(m.Height(), m.Width()))
+
+def apply(A, x):
+    return A.dot(x.reshape(-1, 1)).toarray().flatten()
+
+@pytest.fixture(scope='module')
+def forms():
+    fes = make_fespace()
+    a_pa = make_form(fes, True)
+    a_fa = make_form(fes, False)
+    K = to_scipy(a_fa.SpMat())
+    return fes, a_pa, a_fa, K
+
+def test_action(forms):
+    fes, a_pa, a_fa, K = forms
+    A = ActionOperator.from_form(a_pa)
+    x = np.random.RandomState(0).rand(K.shape[0])
+    assert np.allclose(apply(A, x), K.dot(x))
+    assert np.allclose(A.diagonal(), K.diagonal())
+
+def test_arithmetic(forms):
+    fes, a_pa, a_fa, K = forms
+    A = ActionOperator.from_form(a_pa)
+    x = np.random.RandomState(1).rand(K.shape[0])
+
+    B = 3.0*A - A
+    assert np.allclose(apply(B, x), 2.0*K.dot(x))
+    assert np.allclose(B.diagonal(), 2.0*K.diagonal())
+
+    # assembled matrix added as a term
+    C = A + convert_to_ScipyCoo(K*0.5)
+    assert np.allclose(apply(C, x), 1.5*K.dot(x))
+
+def test_elimination(forms):
+    fes, a_pa, a_fa, K = forms
+    A = ActionOperator.from_form(a_pa)
+    n = K.shape[0]
+    x = np.random.RandomState(2).rand(n)
+    tdof = np.array([0, 3, n//2, n-1])
+
+    Ae, A2 = A.eliminate_RowsCols(tdof)
+
+    # reference : rows/cols of tdof replaced by identity
+    keep = np.ones(n)
+    keep[tdof] = 0.0
+    P = scipy_sparse.diags(keep)
+    K2 = P.dot(K).dot(P) + scipy_sparse.diags(1.0 - keep)
+    assert np.allclose(apply(A2, x), K2.dot(x))
+
+    # lifting : A x where x is restricted on tdof
+    xe = np.zeros(n)
+    xe[tdof] = x[tdof]
+    assert np.allclose(apply(Ae, x), K.dot(xe))
@@ -0,0 +1,42 @@
+'''
+   probe file (format 2) written by Probe.write_file and read
+   by load_probe
+'''
+import os
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from petram.sol.probe import Probe, load_probe
+
+
+def test_format2_roundtrip(tmp_path):
+    fname = str(tmp_path / 'probe_a')
+    p = Probe('a')
+    for k in range(3):
+        p.append_value(np.array([k, 2.0*k]), t=0.1*k)
+    p.write_file(fname)
+    for k in range(3, 5):
+        p.append_value(np.array([k, 2.0*k]), t=0.1*k)
+    p.write_file(fname)
+
+    xdata, ydata = load_probe(fname)
+    assert list(xdata.keys()) == ['time']
+    assert np.allclose(xdata['time'], 0.1*np.arange(5))
+    assert ydata.shape == (2, 5)
+    assert np.allclose(ydata[0], np.arange(5))
+    assert np.allclose(ydata[1], 2.0*np.arange(5))
+
+
+def test_format2_promote_to_complex(tmp_path):
+    fname = str(tmp_path / 'probe_b')
+    p = Probe('b')
+    p.append_value(np.array([1.0]), t=0.0)
+    p.write_file(fname)
+    p.append_value(np.array([1.0+2.0j]), t=1.0)
+    p.write_file(fname)
+
+    xdata, ydata = load_probe(fname)
+    assert np.iscomplexobj(ydata)
+    assert np.allclose(ydata[0], [1.0, 1.0+2.0j])
+    assert np.allclose(xdata['time'], [0.0, 1.0])
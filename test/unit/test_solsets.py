@@ -0,0 +1,73 @@
+'''
+   LazyGridFunction (sol.solsets) read from a solution file
+'''
+import os
+import pytest
+
+np = pytest.importorskip('numpy')
+mfem = pytest.importorskip('mfem.ser', exc_type=ImportError)
+
+import petram.sol.solsets as solsets
+from petram.sol.solsets import MeshDict, LazyGridFunction, load_mesh
+
+
+@pytest.fixture
+def solfile(tmp_path):
+    if hasattr(mfem.Mesh, 'MakeCartesian2D'):
+        mesh = mfem.Mesh.MakeCartesian2D(2, 2, mfem.Element.QUADRILATERAL)
+    else:
+        mesh = mfem.Mesh(2, 2, "QUADRILATERAL")
+    fec = mfem.H1_FECollection(1, 2)
+    fes = mfem.FiniteElementSpace(mesh, fec)
+    gf = mfem.GridFunction(fes)
+    gf.Assign(1.0)
+
+    mfile = str(tmp_path / 'solmesh_0')
+    gfile = str(tmp_path / 'solr_u_0')
+    mesh.Print(mfile, 8)
+    gf.Save(gfile, 8)
+
+    meshes = MeshDict()
+    meshes.set_loader(0, lambda: load_mesh(mfile, 0))
+    return meshes, gfile
+
+def test_stat_once(solfile, monkeypatch):
+    meshes, gfile = solfile
+    count = [0]
+    getmtime = os.path.getmtime
+    def counted(path):
+        count[0] += 1
+        return getmtime(path)
+    monkeypatch.setattr(solsets.os.path, 'getmtime', counted)
+
+    lz = LazyGridFunction(meshes, 0, gfile)
+    gf = lz.resolve()
+    assert count[0] == 1
+    # forwarded access uses the resolved GridFunction
+    assert lz.Size() == gf.Size()
+    assert lz.VectorDim() == 1
+    assert count[0] == 1
+
+def test_pin_by_this(solfile):
+    meshes, gfile = solfile
+    lz = LazyGridFunction(meshes, 0, gfile)
+    coeff = mfem.GridFunctionCoefficient(lz)
+    solsets.gf_cache.clear()
+    assert lz._pinned is not None
+
+    mesh = meshes[0]
+    T = mesh.GetElementTransformation(0)
+    ip = mfem.IntRules.Get(T.GetGeometryType(), 1).IntPoint(0)
+    T.SetIntPoint(ip)
+    assert abs(coeff.Eval(T, ip) - 1.0) < 1e-12
+
+def test_variable_holds_gf(solfile):
+    pytest.importorskip('petram.helper.variables', exc_type=ImportError)
+    from petram.helper.variables import GFScalarVariable
+
+    meshes, gfile = solfile
+    v = GFScalarVariable(LazyGridFunction(meshes, 0, gfile))
+    fes = v.FESpace()
+    solsets.gf_cache.clear()
+    assert v.resolved_args()[0].FESpace().GetVSize() == fes.GetVSize()
+    assert fes.GetVSize() == 9